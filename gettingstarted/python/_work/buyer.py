@@ -1,13 +1,9 @@
 # coding=utf8
 
+import os
 import sys
 import binascii
 import argparse
-from uuid import UUID
-from pprint import pformat
-
-import eth_keys
-import web3
 
 import txaio
 txaio.use_twisted()
@@ -20,7 +16,12 @@ from autobahn.wamp.types import SubscribeOptions
 from autobahn.wamp.serializer import CBORSerializer
 
 from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
-from autobahn.twisted.xbr import SimpleBuyer
+
+# helpers shared by the examples (common/) are imported from the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.eventlog import add_eventlog_arguments, open_eventlog
+from common.keyindex import KeyIndex, add_keyindex_arguments, get_address
 
 
 class XbrDelegate(ApplicationSession):
@@ -31,8 +32,9 @@ class XbrDelegate(ApplicationSession):
         ApplicationSession.__init__(self, config)
 
         self._ethkey_raw = config.extra['ethkey']
-        self._ethkey = eth_keys.keys.PrivateKey(self._ethkey_raw)
-        self._ethadr = web3.Web3.toChecksumAddress(self._ethkey.public_key.to_canonical_address())
+        # the address is derived once per key, and then looked up in the key index
+        self._ethadr_raw, self._ethadr = get_address(self._ethkey_raw,
+                                                     config.extra.get('keyindex', KeyIndex.DEFAULT_PATH))
 
         self.log.info("Client (delegate) Ethereum key loaded (adr=0x{adr})",
                       adr=self._ethadr)
@@ -42,6 +44,7 @@ class XbrDelegate(ApplicationSession):
                       pubkey=self._key.public_key())
 
         self._running = True
+        self._stopping = False
 
     def onUserError(self, fail, msg):
         self.log.error(msg)
@@ -51,28 +54,35 @@ class XbrDelegate(ApplicationSession):
         print('Buyer session joined', details)
         try:
             delegate_key = self._ethkey_raw
-            delegate_adr = self._ethkey.public_key.to_canonical_address()
+            delegate_adr = self._ethadr_raw
             print('Using delegate adr:', delegate_adr)
 
             config = await self.call('xbr.marketmaker.get_config')
             print('Using market maker adr:', config['marketmaker'])
 
             market_maker_adr = binascii.a2b_hex(config['marketmaker'][2:])
+            # imported only now, as autobahn.twisted.xbr imports web3 and eth_keys (which takes seconds)
+            from autobahn.twisted.xbr import SimpleBuyer
+
             max_price = 100 * 10 ** 18
             buyer = SimpleBuyer(market_maker_adr, delegate_key, max_price)
             balance = await buyer.start(self, details.authid)
             balance = int(balance / 10 ** 18)
             print("Remaining balance in active payment channel: {} XBR".format(balance))
 
+            # events received are logged (sampled) off the reactor, rather than printed one by one
+            eventlog = self.config.extra.get('eventlog', None)
+
             async def on_event(key_id, enc_ser, ciphertext, details=None):
-                print('Received event {}, encrypted with key_id={}'.format(details.publication, UUID(bytes=key_id)))
                 try:
                     payload = await buyer.unwrap(key_id, enc_ser, ciphertext)
                 except:
                     self.log.failure()
                     self.leave()
                 else:
-                    print('Unencrypted event payload: {}'.format(pformat(payload)))
+                    if eventlog:
+                        eventlog.event('received', publication=details.publication, topic='io.crossbar.example',
+                                     key_id=key_id, payload=payload)
 
             await self.subscribe(on_event, "io.crossbar.example", options=SubscribeOptions(details=True))
         except:
@@ -88,6 +98,7 @@ class XbrDelegate(ApplicationSession):
 
         if details.reason == 'wamp.close.normal':
             self.log.info('Shutting down ..')
+            self._stopping = True
             # user initiated leave => end the program
             self.config.runner.stop()
             self.disconnect()
@@ -98,10 +109,12 @@ class XbrDelegate(ApplicationSession):
     def onDisconnect(self):
         self.log.info('{klass}.onDisconnect()', klass=self.__class__.__name__)
 
-        try:
-            reactor.stop()
-        except ReactorNotRunning:
-            pass
+        # only stop when leaving (normally): when the connection was lost, ApplicationRunner reconnects
+        if self._stopping:
+            try:
+                reactor.stop()
+            except ReactorNotRunning:
+                pass
 
 
 if __name__ == '__main__':
@@ -135,6 +148,10 @@ if __name__ == '__main__':
                         type=str,
                         help='Member client private WAMP-cryptosign authentication key (32 bytes as HEX encoded string)')
 
+    add_keyindex_arguments(parser, qrcode=False)
+
+    add_eventlog_arguments(parser)
+
     args = parser.parse_args()
 
     if args.debug:
@@ -145,8 +162,13 @@ if __name__ == '__main__':
     extra = {
         'ethkey': binascii.a2b_hex(args.ethkey),
         'cskey': binascii.a2b_hex(args.cskey),
+        'keyindex': args.keyindex or None,
     }
 
+    eventlog = open_eventlog(args, reactor)
+    if eventlog:
+        extra['eventlog'] = eventlog
+
     runner = ApplicationRunner(url=args.url, realm=args.realm, extra=extra, serializers=[CBORSerializer()])
 
     try:
@@ -3,9 +3,232 @@ txaio.use_twisted()
 
 from txaio import time_ns, make_logger
 
+import sys
+import math
+import heapq
+import random
 import argparse
 import treq
 
+from urllib.parse import urlsplit
+
+from zope.interface import implementer
+
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.defer import DeferredLock, DeferredSemaphore, FirstError, ensureDeferred, gatherResults
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP6ClientEndpoint
+from twisted.internet.interfaces import IHandshakeListener, IStreamClientEndpoint
+from twisted.internet.task import deferLater, react
+from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.web.client import Agent, BrowserLikePolicyForHTTPS, HTTPConnectionPool
+from twisted.web.iweb import IAgentEndpointFactory
+
+from treq.client import HTTPClient
+
+# request phases timed by the probe, in order (see HttpProbe._do_request)
+PHASES = ['dns', 'connect', 'tls', 'ttfb', 'body']
+
+
+def create_pool(reactor=None, persistent=False, maxsize=1):
+    """
+    Create a HTTP connection pool that can be shared between (many) probes.
+
+    :param reactor: Twisted reactor to run under.
+    :param persistent: Keep HTTP connections open between requests (warm connections).
+    :param maxsize: Maximum number of idle connections kept open per host.
+    :return: The new connection pool.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    pool = HTTPConnectionPool(reactor, persistent=persistent)
+    pool.maxPersistentPerHost = maxsize
+    pool.retryAutomatically = False
+    return pool
+
+
+class LatencyHistogram(object):
+    """
+    Log-bucketed (HDR-style) histogram of non-negative integer values, e.g. durations in nanoseconds.
+
+    Memory is bounded (independent of the number of values recorded), and each recorded value is
+    accounted to a bucket no wider than ``2 ** -(precision - 1)`` relative to the value. Only buckets
+    holding values are stored, so the histograms of (thousands of) probes running few requests stay small.
+    """
+
+    def __init__(self, precision=7, max_bits=64):
+        """
+
+        :param precision: Number of significant bits kept per value (7 bits is ~1.6% relative precision).
+        :param max_bits: Bit size of the largest value that can be recorded (larger values are clamped).
+        """
+        assert 1 < precision < max_bits
+        self._precision = precision
+        self._sub = 1 << precision
+        self._half = self._sub >> 1
+        self._max_value = (1 << max_bits) - 1
+        # bucket index -> count (of buckets holding values)
+        self._counts = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all recorded values.
+        """
+        self._counts.clear()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value, count=1):
+        """
+        Record a value (``count`` times).
+
+        :param value: The value to record.
+        :param count: Number of times to record the value.
+        """
+        value = min(value, self._max_value)
+        index = self._index(value)
+        self._counts[index] = self._counts.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add all values recorded in another histogram (of identical precision) to this histogram.
+
+        :param other: The histogram to merge.
+        """
+        assert other._precision == self._precision
+        for i, count in other._counts.items():
+            self._counts[i] = self._counts.get(i, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        """
+        The arithmetic mean of all values recorded (or ``None`` if empty).
+        """
+        return self.total / self.count if self.count else None
+
+    def percentile(self, q):
+        """
+        Query a percentile of the values recorded. The cost of a query only depends on the number of
+        buckets holding values (bounded by the histogram precision), not the number of values recorded.
+
+        :param q: Percentile to query, from 0 to 100 (e.g. 99.9).
+        :return: The (bucket upper bound) value at the percentile, or ``None`` if empty.
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q / 100. * self.count))
+        seen = 0
+        for i, count in sorted(self._counts.items()):
+            seen += count
+            if seen >= rank:
+                return min(self._value(i), self.max)
+        return self.max
+
+    def _index(self, value):
+        if value < self._sub:
+            return value
+        shift = value.bit_length() - self._precision
+        return self._sub + (shift - 1) * self._half + ((value >> shift) - self._half)
+
+    def _value(self, index):
+        if index < self._sub:
+            return index
+        shift, offset = divmod(index - self._sub, self._half)
+        return ((offset + self._half + 1) << (shift + 1)) - 1
+
+
+@implementer(IHandshakeListener)
+class _HandshakeTimingProtocol(ProtocolWrapper):
+    """
+    Protocol wrapper stamping the time the TLS handshake completed into a request result.
+    """
+
+    def handshakeCompleted(self):
+        self.factory.res['handshaked'] = time_ns()
+
+
+class _HandshakeTimingFactory(WrappingFactory):
+    protocol = _HandshakeTimingProtocol
+
+    def __init__(self, wrappedFactory, res):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.res = res
+
+
+@implementer(IStreamClientEndpoint)
+class _TimingEndpoint(object):
+    """
+    Client endpoint that resolves the host name, connects over TCP and starts TLS as separate
+    steps, stamping the time each step completed into a request result.
+    """
+
+    def __init__(self, reactor, uri, res, timeout, tls_policy):
+        self._reactor = reactor
+        self._host = uri.host.decode('ascii')
+        self._port = uri.port
+        self._tls = uri.scheme == b'https'
+        self._res = res
+        self._timeout = timeout
+        self._tls_policy = tls_policy
+
+    def connect(self, protocolFactory):
+        return ensureDeferred(self._connect(protocolFactory))
+
+    async def _connect(self, protocolFactory):
+        res = self._res
+        res['reused'] = False
+
+        # note: reactor.resolve() only resolves IPv4 addresses (IPv6 literals are connected directly)
+        if isIPAddress(self._host) or isIPv6Address(self._host):
+            address = self._host
+        else:
+            address = await self._reactor.resolve(self._host, timeout=(self._timeout,))
+        res['resolved'] = time_ns()
+
+        if isIPv6Address(address):
+            endpoint = TCP6ClientEndpoint(self._reactor, address, self._port, timeout=self._timeout)
+        else:
+            endpoint = TCP4ClientEndpoint(self._reactor, address, self._port, timeout=self._timeout)
+
+        if self._tls:
+            creator = self._tls_policy.creatorForNetloc(self._host.encode('ascii'), self._port)
+            timing_factory = _HandshakeTimingFactory(protocolFactory, res)
+            protocol = await endpoint.connect(TLSMemoryBIOFactory(creator, True, timing_factory))
+            res['connected'] = time_ns()
+            # unwrap TLS and timing wrapper: the connection pool expects the (HTTP) protocol built
+            return protocol.wrappedProtocol.wrappedProtocol
+        else:
+            protocol = await endpoint.connect(protocolFactory)
+            res['connected'] = time_ns()
+            return protocol
+
+
+@implementer(IAgentEndpointFactory)
+class _TimingEndpointFactory(object):
+
+    def __init__(self, reactor, res, timeout, tls_policy):
+        self._reactor = reactor
+        self._res = res
+        self._timeout = timeout
+        self._tls_policy = tls_policy
+
+    def endpointForURI(self, uri):
+        return _TimingEndpoint(self._reactor, uri, self._res, self._timeout, self._tls_policy)
+
 
 class HttpProbe(object):
     """
@@ -13,48 +236,196 @@ class HttpProbe(object):
     """
     log = make_logger()
 
-    def __init__(self, url, reactor=None, headers=None, timeout=5, repeat=5):
+    def __init__(self, url, reactor=None, headers=None, timeout=5, repeat=5, concurrency=1, persistent=False,
+                 warmup=0, pool=None, raw=False, limiter=None):
         """
 
         :param reactor: Twisted reactor to run under.
         :param url: URL of the testee to issue HTTP request to.
         :param headers: optional HTTP header to send when testing the target URL.
         :param timeout: Timeout in seconds for each request.
-        :param repeat: Number of requests to issue (sequentially). Results are collected for all requests.
+        :param repeat: Number of requests to issue. Results are collected for all requests.
+        :param concurrency: Maximum number of requests in flight at the same time.
+        :param persistent: Reuse (keep-alive) connections between requests to measure warm-connection
+            latency, rather than open a new connection for every request (cold-connection latency).
+        :param warmup: Number of requests to issue (and not collect results for) before starting to measure.
+            Use this with ``persistent`` to have connections already open when measuring starts.
+        :param pool: optional connection pool (see :func:`create_pool`) shared with other probes. When
+            not given, the probe creates its own pool (bounded by ``concurrency``).
+        :param raw: Collect (and return) one result dict per request, rather than only feeding results into
+            the (constant memory) latency histogram of the probe.
+        :param limiter: optional :class:`RateLimiter` (shared with other probes) each request must pass.
         """
         if reactor is None:
             from twisted.internet import reactor
+        assert concurrency >= 1
         self._reactor = reactor
         self._url = url
         self._headers = headers
         self._timeout = timeout
         self._repeat = repeat
+        self._concurrency = concurrency
+        self._persistent = persistent
+        self._warmup = warmup
+        self._own_pool = pool is None
+        if pool is None:
+            pool = create_pool(reactor, persistent=persistent, maxsize=concurrency)
+        self._pool = pool
+        self._raw = raw
+        self._limiter = limiter
+        self._host = urlsplit(url).hostname
+        self._tls_policy = BrowserLikePolicyForHTTPS()
+
+        self._histogram = LatencyHistogram()
+        self._phases = {phase: LatencyHistogram() for phase in PHASES}
+        self._received = 0
+        # time (in ns) spent receiving response bodies, summed over all requests
+        self._transfer = 0
+        self._codes = {}
 
     async def run(self):
         """
         Issue the test request setup and collect results.
 
-        :return: Collected results for all requests (the number of requests is determined by ``repeat``).
+        Requests are issued by up to ``concurrency`` workers. All results are fed into the latency
+        histogram of the probe, and in ``raw`` mode also collected in the order requests complete.
+
+        :return: In ``raw`` mode, collected results for all requests (the number of requests is determined
+            by ``repeat``), otherwise the probe statistics (see :meth:`stats`).
+        """
+        if self._warmup:
+            await self._run_workers(self._warmup, None)
+        if self._raw:
+            results = []
+
+            def on_result(res):
+                self._record(res)
+                results.append(res)
+
+            await self._run_workers(self._repeat, on_result)
+            return results
+        else:
+            await self._run_workers(self._repeat, self._record)
+            return self.stats()
+
+    @property
+    def url(self):
+        """
+        The URL of the testee.
+        """
+        return self._url
+
+    @property
+    def histogram(self):
+        """
+        The latency histogram (request durations in ns) for this probe.
         """
-        results = []
-        for i in range(self._repeat):
-            res = await self._do_request()
-            results.append(res)
-        return results
+        return self._histogram
+
+    def stats(self):
+        """
+        Get statistics for all requests completed so far. This is cheap enough to be called while
+        the probe is running.
+
+        :return: Latency percentiles, maximum and mean (in ns), bytes received, throughput (bytes/s while
+            receiving response bodies, so independent of the time between requests), count of responses per
+            HTTP status code, and percentiles per request phase (``dns``, ``connect``, ``tls``, ``ttfb`` and
+            ``body``).
+        """
+        hist = self._histogram
+        return {
+            'count': hist.count,
+            'p50': hist.percentile(50),
+            'p90': hist.percentile(90),
+            'p99': hist.percentile(99),
+            'p999': hist.percentile(99.9),
+            'max': hist.max,
+            'mean': hist.mean,
+            'received': self._received,
+            'throughput': self._received * 10**9 / self._transfer if self._transfer else None,
+            'codes': dict(self._codes),
+            'phases': {
+                phase: {
+                    'count': ph.count,
+                    'p50': ph.percentile(50),
+                    'p99': ph.percentile(99),
+                    'max': ph.max,
+                } for phase, ph in self._phases.items()
+            },
+        }
+
+    def _record(self, res):
+        self._histogram.record(res['duration'])
+        for phase in PHASES:
+            if res[phase] is not None:
+                self._phases[phase].record(res[phase])
+        self._received += res['received']
+        self._transfer += res['body']
+        self._codes[res['code']] = self._codes.get(res['code'], 0) + 1
+
+    async def close(self):
+        """
+        Close any connections kept open in the (own) connection pool of this probe.
+        """
+        if self._own_pool:
+            await self._pool.closeCachedConnections()
+
+    async def _run_workers(self, count, on_result):
+        # all workers pull from the same iterator, so exactly "count" requests are issued
+        requests = iter(range(count))
+
+        async def worker():
+            for _ in requests:
+                res = await self._do_request()
+                if on_result:
+                    on_result(res)
+
+        workers = [ensureDeferred(worker()) for _ in range(min(self._concurrency, count))]
+        try:
+            await gatherResults(workers, consumeErrors=True)
+        except FirstError as e:
+            e.subFailure.raiseException()
 
     async def _do_request(self):
+        """
+        Issue one request, timing each phase of the request separately (in ns):
+
+        * ``dns``: resolving the host name
+        * ``connect``: establishing the TCP connection
+        * ``tls``: the TLS handshake (for HTTPS)
+        * ``ttfb``: from having a connection until the response headers were received
+        * ``body``: receiving the response body, which arrived in ``chunks`` pieces
+
+        When the request was sent over a (warm) connection reused from the pool, ``reused`` is set
+        and ``dns``, ``connect`` and ``tls`` are ``None``.
+        """
+        if self._limiter:
+            await self._limiter.acquire(self._host)
+
         res = {
             'received': 0,
+            'chunks': 0,
+            'reused': True,
             'started': time_ns(),
         }
 
         def collect(data):
             res['received'] += len(data)
+            res['chunks'] += 1
+
+        # the endpoint factory stamps connection phases into this request's results, and is only used when
+        # the (shared) pool has no cached connection for the target
+        agent = Agent.usingEndpointFactory(self._reactor,
+                                           _TimingEndpointFactory(self._reactor, res, self._timeout,
+                                                                  self._tls_policy),
+                                           pool=self._pool)
+        client = HTTPClient(agent)
 
         # https://treq.readthedocs.io/en/release-20.3.0/api.html#treq.request
         # https://twistedmatrix.com/documents/current/api/twisted.web.iweb.IResponse.html
-        response = await treq.get(self._url, reactor=self._reactor, headers=self._headers, timeout=self._timeout,
-                                  persistent=False, allow_redirects=False, browser_like_redirects=False)
+        response = await client.get(self._url, reactor=self._reactor, headers=self._headers, timeout=self._timeout,
+                                    allow_redirects=False, browser_like_redirects=False)
+        res['first_byte'] = time_ns()
 
         res['version'] = 'HTTP/{}.{}'.format(response.version[1], response.version[2])
         res['code'] = response.code
@@ -64,80 +435,279 @@ class HttpProbe(object):
 
         res['ended'] = time_ns()
         res['duration'] = res['ended'] - res['started']
+
+        if res['reused']:
+            res['dns'] = res['connect'] = res['tls'] = None
+            ready = res['started']
+        else:
+            res['dns'] = res['resolved'] - res['started']
+            res['connect'] = res['connected'] - res['resolved']
+            if 'handshaked' in res:
+                res['tls'] = res['handshaked'] - res['connected']
+                ready = res['handshaked']
+            else:
+                res['tls'] = None
+                ready = res['connected']
+        res['ttfb'] = res['first_byte'] - ready
+        res['body'] = res['ended'] - res['first_byte']
         return res
 
 
-if __name__ == '__main__':
+class RateLimiter(object):
+    """
+    Limits the rate of requests, both globally and per target host.
 
-    parser = argparse.ArgumentParser()
+    Requests to a host wait for their slot in the host schedule first, and only then reserve the earliest
+    slot free in the global schedule, so requests held back by a throttled host do not delay requests to
+    other hosts. Requests are paced evenly (no bursts) at no more than the configured rates.
+    """
 
-    parser.add_argument('-d',
-                        '--debug',
-                        action='store_true',
-                        help='Enable debug output.')
+    def __init__(self, reactor=None, rate=100., host_rate=5.):
+        """
 
-    parser.add_argument('--gateway',
-                        dest='gateway',
-                        type=str,
-                        default='http://localhost:1545',
-                        help='Ethereum HTTP gateway URL or None for auto-select.')
+        :param reactor: Twisted reactor to run under.
+        :param rate: Maximum number of requests per second (over all hosts).
+        :param host_rate: Maximum number of requests per second to any single host.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._interval = 1. / rate
+        self._host_interval = 1. / host_rate
+        self._next = 0
+        self._host_next = {}
+        # host -> lock held by the request to the host waiting for its slot (requests to a host take turns)
+        self._host_locks = {}
+
+    async def acquire(self, host):
+        """
+        Wait until a request to the given host is allowed.
 
-    parser.add_argument('--url',
-                        dest='url',
-                        type=str,
-                        default='ws://localhost:8070/ws',
-                        help='The router URL (default: "ws://localhost:8070/ws").')
+        :param host: The host the request goes to.
+        """
+        lock = self._host_locks.get(host, None)
+        if lock is None:
+            lock = self._host_locks[host] = DeferredLock()
+        await lock.acquire()
+        try:
+            now = self._reactor.seconds()
+            host_slot = self._host_next.get(host, 0)
+            if host_slot > now:
+                await deferLater(self._reactor, host_slot - now, lambda: None)
+                now = self._reactor.seconds()
+
+            slot = max(now, self._next)
+            self._next = slot + self._interval
+            self._host_next[host] = slot + self._host_interval
+            if slot > now:
+                await deferLater(self._reactor, slot - now, lambda: None)
+        finally:
+            lock.release()
+            if not lock.locked:
+                del self._host_locks[host]
+
+        # forget hosts with no pending reservations, so memory is bounded by recently probed hosts
+        if len(self._host_next) > 1024:
+            now = self._reactor.seconds()
+            self._host_next = {h: t for h, t in self._host_next.items() if t > now}
+
+
+class ProbeScheduler(object):
+    """
+    Runs many HTTP probes, each on its own interval, with requests rate limited globally and per
+    host (see :class:`RateLimiter`).
 
-    parser.add_argument('--realm',
-                        dest='realm',
-                        type=str,
-                        default='idma',
-                        help='The realm to join (default: "idma").')
+    All probes are kept in one schedule (ordered by next due time) served by a single reactor timer.
+    Probes start at a random offset within their interval, and every later run is jittered, so probes
+    added at the same time do not all hit their targets at once.
+    """
+    log = make_logger()
 
-    parser.add_argument('--ethkey',
-                        dest='ethkey',
-                        type=str,
-                        help='Member private Ethereum key (32 bytes as HEX encoded string)')
+    def __init__(self, reactor=None, rate=100., host_rate=5., jitter=0.1):
+        """
 
-    parser.add_argument('--cskey',
-                        dest='cskey',
-                        type=str,
-                        help='Member client private WAMP-cryptosign authentication key (32 bytes as HEX encoded string)')
+        :param reactor: Twisted reactor to run under.
+        :param rate: Maximum number of requests per second (over all probes).
+        :param host_rate: Maximum number of requests per second to any single host.
+        :param jitter: Relative jitter applied to probe intervals (e.g. ``0.1`` is +/-10%).
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._jitter = jitter
+        self._limiter = RateLimiter(reactor, rate=rate, host_rate=host_rate)
+        self._pools = {
+            False: create_pool(reactor, persistent=False),
+            True: create_pool(reactor, persistent=True),
+        }
+        # probe_id -> probe record
+        self._probes = {}
+        # heap of (due, probe_id)
+        self._schedule = []
+        self._timer = None
+        self._running = False
+
+    def add(self, probe_id, url, interval=60, **kwargs):
+        """
+        Add a probe to the scheduler.
 
-    parser.add_argument('--market',
-                        dest='market',
-                        type=str,
-                        help='Market OID in which to open a channel.')
+        :param probe_id: ID of the probe (any hashable).
+        :param url: URL of the testee.
+        :param interval: Interval in seconds at which the probe is run.
+        :param kwargs: Further :class:`HttpProbe` parameters (``headers``, ``timeout``, ``repeat``, ...).
+        """
+        assert probe_id not in self._probes
+        persistent = kwargs.get('persistent', False)
+        probe = HttpProbe(url, reactor=self._reactor, pool=self._pools[persistent], limiter=self._limiter,
+                          **kwargs)
+        self._probes[probe_id] = {
+            'probe': probe,
+            'interval': interval,
+            'runs': 0,
+            'errors': 0,
+            'last_run': None,
+            'last_error': None,
+            'active': False,
+        }
+        self._push(probe_id, self._reactor.seconds() + random.uniform(0, interval))
 
-    parser.add_argument('--marketmaker',
-                        dest='marketmaker',
-                        type=str,
-                        help='Market maker address for the channel.')
+    def remove(self, probe_id):
+        """
+        Remove a probe from the scheduler. A run in progress is completed, but its results are dropped.
 
-    parser.add_argument('--channel',
-                        dest='channel',
-                        type=str,
-                        help='Channel OID for the new channel.')
+        :param probe_id: ID of the probe to remove.
+        """
+        # the schedule entry is dropped lazily when it becomes due
+        del self._probes[probe_id]
 
-    parser.add_argument('--channel_type',
-                        dest='channel_type',
-                        type=int,
-                        help='Type of channel to open: 1=paying, 2=payment')
+    def list(self):
+        """
+        :return: Map of probe ID to probe URL and interval for all probes.
+        """
+        return {probe_id: {'url': rec['probe'].url, 'interval': rec['interval']}
+                for probe_id, rec in self._probes.items()}
 
-    parser.add_argument('--delegate',
-                        dest='delegate',
-                        type=str,
-                        help='Address of delegate allowed to use the channel for off-chain transactions.')
+    def results(self, probe_id):
+        """
+        :param probe_id: ID of the probe to get results for.
+        :return: Run counters and statistics (see :meth:`HttpProbe.stats`) over all runs of the probe.
+        """
+        rec = self._probes[probe_id]
+        return {
+            'url': rec['probe'].url,
+            'interval': rec['interval'],
+            'runs': rec['runs'],
+            'errors': rec['errors'],
+            'last_run': rec['last_run'],
+            'last_error': rec['last_error'],
+            'stats': rec['probe'].stats(),
+        }
+
+    def start(self):
+        """
+        Start running probes.
+        """
+        assert not self._running
+        self._running = True
+        self._reschedule()
+
+    def stop(self):
+        """
+        Stop running probes (runs in progress are completed).
+        """
+        self._running = False
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        for pool in self._pools.values():
+            pool.closeCachedConnections()
+
+    def _push(self, probe_id, due):
+        heapq.heappush(self._schedule, (due, probe_id))
+        if self._running and self._schedule[0][1] == probe_id:
+            self._reschedule()
+
+    def _reschedule(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if self._running and self._schedule:
+            delay = max(0, self._schedule[0][0] - self._reactor.seconds())
+            self._timer = self._reactor.callLater(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        now = self._reactor.seconds()
+        while self._schedule and self._schedule[0][0] <= now:
+            _, probe_id = heapq.heappop(self._schedule)
+            rec = self._probes.get(probe_id)
+            if rec is None:
+                # probe was removed
+                continue
+            interval = rec['interval']
+            heapq.heappush(self._schedule,
+                           (now + interval * (1 + random.uniform(-self._jitter, self._jitter)), probe_id))
+            if not rec['active']:
+                ensureDeferred(self._run(probe_id, rec))
+        self._reschedule()
+
+    async def _run(self, probe_id, rec):
+        rec['active'] = True
+        try:
+            await rec['probe'].run()
+        except Exception as e:
+            rec['errors'] += 1
+            rec['last_error'] = str(e)
+            self.log.debug('Probe {probe_id} failed: {error}', probe_id=probe_id, error=e)
+        finally:
+            rec['active'] = False
+            rec['runs'] += 1
+            rec['last_run'] = time_ns()
+
+
+if __name__ == '__main__':
 
-    parser.add_argument('--recipient',
-                        dest='recipient',
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d',
+                        '--debug',
+                        action='store_true',
+                        help='Enable debug output.')
+
+    parser.add_argument('--target',
+                        dest='targets',
                         type=str,
-                        help='The address of the beneficiary for any channel payout when the channel is closed.')
+                        action='append',
+                        required=True,
+                        help='URL of a testee to probe (can be given multiple times).')
+
+    parser.add_argument('--repeat',
+                        dest='repeat',
+                        type=int,
+                        default=5,
+                        help='Number of requests to issue per target (default: 5).')
 
-    parser.add_argument('--amount',
-                        dest='amount',
+    parser.add_argument('--concurrency',
+                        dest='concurrency',
                         type=int,
-                        help='Channel amount (in market coins).')
+                        default=1,
+                        help='Number of requests in flight per target (default: 1).')
+
+    parser.add_argument('--parallel',
+                        dest='parallel',
+                        type=int,
+                        default=50,
+                        help='Number of targets probed at the same time (default: 50).')
+
+    parser.add_argument('--persistent',
+                        action='store_true',
+                        help='Keep connections alive and measure warm-connection latency.')
+
+    parser.add_argument('--timeout',
+                        dest='timeout',
+                        type=float,
+                        default=5,
+                        help='Timeout in seconds for each request (default: 5).')
 
     args = parser.parse_args()
 
@@ -146,40 +716,34 @@ if __name__ == '__main__':
     else:
         txaio.start_logging(level='info')
 
-    if args.gateway:
-        w3 = web3.Web3(web3.Web3.HTTPProvider(args.gateway))
-    else:
-        from web3.auto import w3
-
-    if not w3.isConnected():
-        print('Could not connect to Web3/Ethereum at: {}'.format(args.gateway or 'auto'))
-        sys.exit(1)
-    else:
-        print('Using web3.py {}, connected to provider {}'.format(hlid('v' + web3.__version__),
-                                                                  hlid(args.gateway or 'auto')))
-    xbr.setProvider(w3)
-
-    assert args.channel_type in [ActorType.PROVIDER, ActorType.CONSUMER, ActorType.PROVIDER_CONSUMER]
-
-    extra = {
-        'w3': w3,
-        'ethkey': binascii.a2b_hex(args.ethkey),
-        'cskey': binascii.a2b_hex(args.cskey),
-        'market_oid': UUID(args.market),
-        'channel_oid': UUID(args.channel),
-        'channel_type': args.channel_type,
-        'delegate_adr': binascii.a2b_hex(args.delegate[2:]),
-        'marketmaker_adr': binascii.a2b_hex(args.marketmaker[2:]),
-        'recipient_adr': binascii.a2b_hex(args.recipient[2:]),
-        'amount': args.amount * 10**18,
-    }
-
-    runner = ApplicationRunner(url=args.url, realm=args.realm, extra=extra, serializers=[CBORSerializer()])
-
-    try:
-        runner.run(XbrDelegate, auto_reconnect=True)
-    except Exception as e:
-        print(e)
-        sys.exit(1)
-    else:
-        sys.exit(0)
+    async def main(reactor):
+        # one connection pool shared by all probes, bounding idle connections per host
+        pool = create_pool(reactor, persistent=args.persistent, maxsize=args.concurrency)
+        limit = DeferredSemaphore(args.parallel)
+
+        async def probe(url):
+            p = HttpProbe(url, reactor=reactor, timeout=args.timeout, repeat=args.repeat,
+                          concurrency=args.concurrency, persistent=args.persistent,
+                          warmup=args.concurrency if args.persistent else 0, pool=pool)
+            try:
+                stats = await p.run()
+            except Exception as e:
+                print('{}: failed ({})'.format(url, e))
+            else:
+                print('{}: {} requests, p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, p999 {:.1f} ms, '
+                      'max {:.1f} ms, {:.0f} bytes/s'.format(url, stats['count'], stats['p50'] / 10**6,
+                                                             stats['p90'] / 10**6, stats['p99'] / 10**6,
+                                                             stats['p999'] / 10**6, stats['max'] / 10**6,
+                                                             stats['throughput'] or 0))
+                for phase in PHASES:
+                    ph = stats['phases'][phase]
+                    if ph['count']:
+                        print('    {:<8} p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms ({} samples)'.format(
+                            phase, ph['p50'] / 10**6, ph['p99'] / 10**6, ph['max'] / 10**6, ph['count']))
+
+        try:
+            await gatherResults([limit.run(lambda url=url: ensureDeferred(probe(url))) for url in args.targets])
+        finally:
+            await pool.closeCachedConnections()
+
+    react(lambda reactor: ensureDeferred(main(reactor)))
@@ -3,17 +3,11 @@
 import txaio
 txaio.use_twisted()
 
-from txaio import time_ns, make_logger
-
-import argparse
-import treq
-
+import os
 import sys
 import binascii
 import argparse
 
-import eth_keys
-import web3
 import uuid
 
 import txaio
@@ -21,6 +15,7 @@ txaio.use_twisted()
 
 from twisted.internet import reactor
 from twisted.internet.error import ReactorNotRunning
+from twisted.internet.defer import gatherResults
 
 from autobahn.wamp.types import PublishOptions
 from autobahn.wamp.serializer import CBORSerializer
@@ -28,67 +23,14 @@ from autobahn.wamp import cryptosign
 
 from autobahn.twisted.util import sleep
 from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
-from autobahn.twisted.xbr import SimpleSeller
-
-
-class HttpProbe(object):
-    """
-    HTTP test probe able to measure response time and size to a testee URL.
-    """
-    log = make_logger()
-
-    def __init__(self, url, reactor=None, headers=None, timeout=5, repeat=5):
-        """
-
-        :param reactor: Twisted reactor to run under.
-        :param url: URL of the testee to issue HTTP request to.
-        :param headers: optional HTTP header to send when testing the target URL.
-        :param timeout: Timeout in seconds for each request.
-        :param repeat: Number of requests to issue (sequentially). Results are collected for all requests.
-        """
-        if reactor is None:
-            from twisted.internet import reactor
-        self._reactor = reactor
-        self._url = url
-        self._headers = headers
-        self._timeout = timeout
-        self._repeat = repeat
-
-    async def run(self):
-        """
-        Issue the test request setup and collect results.
-
-        :return: Collected results for all requests (the number of requests is determined by ``repeat``).
-        """
-        results = []
-        for i in range(self._repeat):
-            res = await self._do_request()
-            results.append(res)
-        return results
-
-    async def _do_request(self):
-        res = {
-            'received': 0,
-            'started': time_ns(),
-        }
-
-        def collect(data):
-            res['received'] += len(data)
-
-        # https://treq.readthedocs.io/en/release-20.3.0/api.html#treq.request
-        # https://twistedmatrix.com/documents/current/api/twisted.web.iweb.IResponse.html
-        response = await treq.get(self._url, reactor=self._reactor, headers=self._headers, timeout=self._timeout,
-                                  persistent=False, allow_redirects=False, browser_like_redirects=False)
-
-        res['version'] = 'HTTP/{}.{}'.format(response.version[1], response.version[2])
-        res['code'] = response.code
-        res['length'] = response.length
-
-        await treq.collect(response, collect)
-
-        res['ended'] = time_ns()
-        res['duration'] = res['ended'] - res['started']
-        return res
+
+from probe import ProbeScheduler
+
+# helpers shared by the examples (common/) are imported from the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.eventlog import add_eventlog_arguments, open_eventlog
+from common.keyindex import KeyIndex, add_keyindex_arguments, get_address
 
 
 class XbrDelegate(ApplicationSession):
@@ -99,8 +41,9 @@ class XbrDelegate(ApplicationSession):
         ApplicationSession.__init__(self, config)
 
         self._ethkey_raw = config.extra['ethkey']
-        self._ethkey = eth_keys.keys.PrivateKey(self._ethkey_raw)
-        self._ethadr = web3.Web3.toChecksumAddress(self._ethkey.public_key.to_canonical_address())
+        # the address is derived once per key, and then looked up in the key index
+        self._ethadr_raw, self._ethadr = get_address(self._ethkey_raw,
+                                                     config.extra.get('keyindex', KeyIndex.DEFAULT_PATH))
 
         self.log.info("Client (delegate) Ethereum key loaded (adr=0x{adr})",
                       adr=self._ethadr)
@@ -110,14 +53,28 @@ class XbrDelegate(ApplicationSession):
                       pubkey=self._key.public_key())
 
         self._running = True
+        self._stopping = False
 
-        self._probes = {}
+        # the probe scheduler outlives sessions, so probes registered keep running across reconnects
+        self._probes = config.extra['probes']
 
-    def init_probe(self, url):
-        probe_id = uuid.UUID()
-        self._probes[probe_id] = HttpProbe(url, repeat=5)
+    def init_probe(self, url, interval=60, repeat=5, timeout=5, concurrency=1, persistent=False):
+        probe_id = uuid.uuid4()
+        self._probes.add(probe_id.bytes, url, interval=interval, repeat=repeat, timeout=timeout,
+                         concurrency=concurrency, persistent=persistent)
+        self.log.info('Probe {probe_id} registered for {url} (every {interval}s)', probe_id=probe_id, url=url,
+                      interval=interval)
         return probe_id.bytes
 
+    def remove_probe(self, probe_id):
+        self._probes.remove(probe_id)
+
+    def list_probes(self):
+        return [dict(probe_id=probe_id, **probe) for probe_id, probe in self._probes.list().items()]
+
+    def get_probe_results(self, probe_id):
+        return self._probes.results(probe_id)
+
     def onUserError(self, fail, msg):
         self.log.error(msg)
         self.leave('wamp.error', msg)
@@ -126,7 +83,7 @@ class XbrDelegate(ApplicationSession):
         print('Seller session joined', details)
         try:
             delegate_key = self._ethkey_raw
-            delegate_adr = self._ethkey.public_key.to_canonical_address()
+            delegate_adr = self._ethadr_raw
             print('Using delegate adr:', delegate_adr)
 
             config = await self.call('xbr.marketmaker.get_config')
@@ -134,6 +91,13 @@ class XbrDelegate(ApplicationSession):
 
             market_maker_adr = binascii.a2b_hex(config['marketmaker'][2:])
 
+            probe_prefix = 'io.crossbar.example.probe'
+            await gatherResults([self.register(self.init_probe, probe_prefix + '.register'),
+                                 self.register(self.remove_probe, probe_prefix + '.unregister'),
+                                 self.register(self.list_probes, probe_prefix + '.list'),
+                                 self.register(self.get_probe_results, probe_prefix + '.results')],
+                                consumeErrors=True)
+
             api_id = uuid.UUID('627f1b5c-58c2-43b1-8422-a34f7d3f5a04').bytes
             topic = 'io.crossbar.example'
             counter = 1
@@ -142,6 +106,9 @@ class XbrDelegate(ApplicationSession):
             price = 5 * 10 ** 18
             interval = 10
 
+            # imported only now, as autobahn.twisted.xbr imports web3 and eth_keys (which takes seconds)
+            from autobahn.twisted.xbr import SimpleSeller
+
             seller = SimpleSeller(market_maker_adr, delegate_key)
             seller.add(api_id, topic, price, interval, None)
 
@@ -149,6 +116,9 @@ class XbrDelegate(ApplicationSession):
             balance = int(balance / 10 ** 18)
             print("Remaining balance: {} XBR".format(balance))
 
+            # events published are logged (sampled) off the reactor, rather than printed one by one
+            eventlog = self.config.extra.get('eventlog', None)
+
             self.log.info('Seller session ready! Starting to publish events ..')
             running = True
             while running:
@@ -160,7 +130,8 @@ class XbrDelegate(ApplicationSession):
                 pub = await self.publish(topic, key_id, enc_ser, ciphertext,
                                          options=PublishOptions(acknowledge=True))
 
-                print('Published event {}: {}'.format(pub.id, payload))
+                if eventlog:
+                    eventlog.event('published', publication=pub.id, topic=topic, payload=payload)
 
                 counter += 1
                 await sleep(1)
@@ -175,6 +146,7 @@ class XbrDelegate(ApplicationSession):
 
         if details.reason == 'wamp.close.normal':
             self.log.info('Shutting down ..')
+            self._stopping = True
             # user initiated leave => end the program
             self.config.runner.stop()
             self.disconnect()
@@ -185,10 +157,12 @@ class XbrDelegate(ApplicationSession):
     def onDisconnect(self):
         self.log.info('{klass}.onDisconnect()', klass=self.__class__.__name__)
 
-        try:
-            reactor.stop()
-        except ReactorNotRunning:
-            pass
+        # only stop when leaving (normally): when the connection was lost, ApplicationRunner reconnects
+        if self._stopping:
+            try:
+                reactor.stop()
+            except ReactorNotRunning:
+                pass
 
 
 if __name__ == '__main__':
@@ -222,6 +196,22 @@ if __name__ == '__main__':
                         type=str,
                         help='Member client private WAMP-cryptosign authentication key (32 bytes as HEX encoded string)')
 
+    parser.add_argument('--probe_rate',
+                        dest='probe_rate',
+                        type=float,
+                        default=100,
+                        help='Maximum number of probe requests per second (default: 100).')
+
+    parser.add_argument('--probe_host_rate',
+                        dest='probe_host_rate',
+                        type=float,
+                        default=5,
+                        help='Maximum number of probe requests per second to any one host (default: 5).')
+
+    add_keyindex_arguments(parser, qrcode=False)
+
+    add_eventlog_arguments(parser)
+
     args = parser.parse_args()
 
     if args.debug:
@@ -232,8 +222,19 @@ if __name__ == '__main__':
     extra = {
         'ethkey': binascii.a2b_hex(args.ethkey),
         'cskey': binascii.a2b_hex(args.cskey),
+        'keyindex': args.keyindex or None,
     }
 
+    # probes are run independent of the session (and continue while the seller reconnects)
+    probes = ProbeScheduler(rate=args.probe_rate, host_rate=args.probe_host_rate)
+    reactor.callWhenRunning(probes.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', probes.stop)
+    extra['probes'] = probes
+
+    eventlog = open_eventlog(args, reactor)
+    if eventlog:
+        extra['eventlog'] = eventlog
+
     runner = ApplicationRunner(url=args.url, realm=args.realm, extra=extra, serializers=[CBORSerializer()])
 
     try:
@@ -0,0 +1,234 @@
+# coding=utf8
+
+# event log of XBR delegates: events (published or received) are sampled on the reactor, and formatted as JSON
+# lines and written in batches from a writer thread, so logging events does not slow down publishing or receiving
+
+import os
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.internet.task import LoopingCall
+
+
+def _default(value):
+    # JSON representation of values not serializable as JSON (e.g. key IDs)
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return repr(value)
+
+
+class EventLog(object):
+    """
+    JSON lines log of events, sampled (every Nth event, and/or up to a rate), and written in batches.
+
+    Logging an event only samples it and appends it to the current batch. Batches are formatted and written
+    from a writer thread, when full or periodically. Event fields are formatted when written, so they must not
+    be changed after being logged. When the writer falls behind, batches are dropped (and counted) rather than
+    queueing up without limit, and so are batches which fail to be written.
+    """
+    log = make_logger()
+
+    def __init__(self, path='-', every=1, rate=None, batch_size=1000, flush_interval=.5, max_pending=16,
+                 reactor=None):
+        """
+
+        :param path: Path of the file to append to, or ``'-'`` for stdout.
+        :param every: Log every Nth event (of each kind).
+        :param rate: optional maximum number of events logged per second (of all kinds).
+        :param batch_size: Number of events written at once.
+        :param flush_interval: Time (in seconds) after which events logged are written (also when the batch is
+            not full).
+        :param max_pending: Maximum number of batches waiting to be written.
+        :param reactor: Twisted reactor to run under.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._path = path
+        self._every = max(1, every)
+        self._rate = rate
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+
+        self._file = None
+        self._writer = None
+        self._flushing = None
+        self._batch = []
+        self._pending = []
+        # events seen per kind (for sampling every Nth)
+        self._seen = {}
+        # token bucket (for sampling up to the rate)
+        self._tokens = rate or 0
+        self._refilled = time.monotonic()
+
+        self.logged = 0
+        self.sampled_out = 0
+        self.dropped = 0
+
+    def stats(self):
+        """
+        :return: Counters of events logged, not logged (sampling), and dropped (the writer fell behind, or
+            failed to write them).
+        """
+        return {
+            'logged': self.logged,
+            'sampled_out': self.sampled_out,
+            'dropped': self.dropped,
+        }
+
+    def start(self):
+        """
+        Open the log, and start writing events periodically.
+        """
+        if self._path == '-':
+            # the original stdout (logging may redirect sys.stdout)
+            self._file = sys.__stdout__
+        else:
+            path = os.path.expanduser(self._path)
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._file = open(path, 'a')
+        self._writer = ThreadPoolExecutor(1)
+        self._flushing = LoopingCall(self.flush)
+        self._flushing.clock = self._reactor
+        self._flushing.start(self._flush_interval, now=False)
+
+    def stop(self):
+        """
+        Write the events logged, and close the log.
+        """
+        if self._writer is None:
+            return
+        if self._flushing.running:
+            self._flushing.stop()
+        self.flush()
+        self._writer.shutdown(wait=True)
+        self._writer = None
+        if self._file is not sys.__stdout__:
+            self._file.close()
+        self._file = None
+
+    def sample(self, kind):
+        """
+        :param kind: The kind of event.
+        :return: Whether an event of the kind is to be logged.
+        """
+        if self._every > 1:
+            seen = self._seen.get(kind, 0)
+            self._seen[kind] = seen + 1
+            if seen % self._every:
+                self.sampled_out += 1
+                return False
+        if self._rate:
+            if self._tokens < 1:
+                now = time.monotonic()
+                self._tokens = min(self._rate, self._tokens + (now - self._refilled) * self._rate)
+                self._refilled = now
+                if self._tokens < 1:
+                    self.sampled_out += 1
+                    return False
+            self._tokens -= 1
+        return True
+
+    def event(self, kind, **fields):
+        """
+        Log an event (if sampled).
+
+        :param kind: The kind of event, e.g. ``'published'``.
+        :param fields: Fields of the event (serializable as JSON, or bytes).
+        """
+        if (self._every > 1 or self._rate) and not self.sample(kind):
+            return
+        self._batch.append((time.time(), kind, fields))
+        self.logged += 1
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the events logged to the writer thread.
+        """
+        if not self._batch or self._writer is None:
+            return
+        batch, self._batch = self._batch, []
+        self._pending = [future for future in self._pending if not future.done()]
+        if len(self._pending) >= self._max_pending:
+            self.dropped += len(batch)
+            return
+        self._pending.append(self._writer.submit(self._write, batch))
+
+    def _write(self, batch):
+        # runs on the writer thread
+        try:
+            self._file.write(''.join(json.dumps(dict(fields, ts=ts, event=kind), default=_default) + '\n'
+                                     for ts, kind, fields in batch))
+            self._file.flush()
+        except Exception as e:
+            self._reactor.callFromThread(self._on_write_failed, len(batch), e)
+
+    def _on_write_failed(self, count, error):
+        # runs on the reactor (counters are only changed there)
+        self.dropped += count
+        self.log.warn('Failed to write event log ({count} events dropped): {error}', count=count, error=error)
+
+
+def add_eventlog_arguments(parser):
+    """
+    Add the command line options for the event log to an argument parser.
+
+    :param parser: The :class:`argparse.ArgumentParser`.
+    """
+    parser.add_argument('--event_log',
+                        dest='event_log',
+                        type=str,
+                        default='-',
+                        help='File to log events to (JSON lines), "-" for stdout, or "" to disable (default: "-").')
+
+    parser.add_argument('--event_log_every',
+                        dest='event_log_every',
+                        type=int,
+                        default=1,
+                        help='Log every Nth event (default: 1, all events).')
+
+    parser.add_argument('--event_log_rate',
+                        dest='event_log_rate',
+                        type=float,
+                        default=None,
+                        help='Maximum number of events logged per second (default: no limit).')
+
+
+def add_eventlog_metrics(registry, eventlog):
+    """
+    Add the counters of an event log to a metrics registry.
+
+    :param registry: The :class:`metrics.MetricsRegistry`.
+    :param eventlog: The :class:`EventLog`.
+    """
+    registry.counter('xbr_eventlog_logged_total', 'Events logged.', lambda: eventlog.logged)
+    registry.counter('xbr_eventlog_sampled_out_total', 'Events not logged (sampling).', lambda: eventlog.sampled_out)
+    registry.counter('xbr_eventlog_dropped_total', 'Events logged, but dropped (the writer fell behind or failed).',
+                     lambda: eventlog.dropped)
+
+
+def open_eventlog(args, reactor):
+    """
+    Create the event log configured on the command line (see :func:`add_eventlog_arguments`), started when the
+    reactor is running, and stopped (writing the events logged) when the reactor shuts down.
+
+    :param args: The parsed command line options.
+    :param reactor: Twisted reactor to run under.
+    :return: The :class:`EventLog`, or ``None`` when disabled.
+    """
+    if not args.event_log:
+        return None
+    eventlog = EventLog(args.event_log, every=args.event_log_every, rate=args.event_log_rate, reactor=reactor)
+    reactor.callWhenRunning(eventlog.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', eventlog.stop)
+    return eventlog
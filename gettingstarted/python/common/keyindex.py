@@ -0,0 +1,157 @@
+# coding=utf8
+
+# cached derivation of delegate key material: the Ethereum address of a delegate key is derived once (which
+# requires the heavy eth_keys and web3 packages) and kept in a small local index, so delegates (and short-lived
+# tools) starting again look up the address instead
+
+import os
+import json
+import hashlib
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+
+class KeyIndex(object):
+    """
+    JSON file mapping fingerprints of delegate (Ethereum) private keys to the address derived from the key.
+
+    Private keys are never stored: entries are looked up by a (keyed) hash of the private key. The index
+    is read once, kept in memory, and written (atomically) when an entry is added.
+    """
+    log = make_logger()
+
+    # default location of the index (the directory of the default XBR profile)
+    DEFAULT_PATH = '~/.xbrnetwork/keyindex.json'
+
+    def __init__(self, path=DEFAULT_PATH):
+        """
+
+        :param path: Path of the index file (created if it does not exist), or ``None`` to keep the
+            index in memory only.
+        """
+        self._path = os.path.expanduser(path) if path else None
+        self._entries = None
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(ethkey):
+        """
+        :param ethkey: Private Ethereum key (raw bytes).
+        :return: The fingerprint (hex) the key is indexed by.
+        """
+        return hashlib.blake2b(ethkey, digest_size=16, person=b'xbr-keyindex').hexdigest()
+
+    def _load(self):
+        self._entries = {}
+        if self._path and os.path.exists(self._path):
+            try:
+                with open(self._path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                self.log.warn('Ignoring unreadable key index {path}: {error}', path=self._path, error=e)
+
+    def _save(self):
+        if self._path:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp = '{}.{}'.format(self._path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self._entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self._path)
+
+    def address(self, ethkey):
+        """
+        Get the address of a delegate key, deriving (and indexing) it when not indexed yet.
+
+        :param ethkey: Private Ethereum key (raw bytes).
+        :return: Tuple ``(adr_raw, eth_adr)`` with the address (raw bytes) and the checksummed address.
+        """
+        if self._entries is None:
+            self._load()
+
+        fingerprint = self.fingerprint(ethkey)
+        eth_adr = self._entries.get(fingerprint, None)
+        if eth_adr is not None:
+            self.hits += 1
+            return bytes.fromhex(eth_adr[2:]), eth_adr
+
+        self.misses += 1
+        adr_raw, eth_adr = derive_address(ethkey)
+        self._entries[fingerprint] = eth_adr
+        try:
+            self._save()
+        except OSError as e:
+            self.log.warn('Failed to write key index {path}: {error}', path=self._path, error=e)
+        return adr_raw, eth_adr
+
+
+def derive_address(ethkey):
+    """
+    Derive the address of a delegate key (importing eth_keys and web3 only when called).
+
+    :param ethkey: Private Ethereum key (raw bytes).
+    :return: Tuple ``(adr_raw, eth_adr)`` with the address (raw bytes) and the checksummed address.
+    """
+    import eth_keys
+    import web3
+
+    adr_raw = eth_keys.keys.PrivateKey(ethkey).public_key.to_canonical_address()
+    return adr_raw, web3.Web3.toChecksumAddress(adr_raw)
+
+
+# index per path, shared by all delegates of the process
+_indexes = {}
+
+
+def get_address(ethkey, path=KeyIndex.DEFAULT_PATH):
+    """
+    Get the address of a delegate key from the (process wide) index at a path.
+
+    :param ethkey: Private Ethereum key (raw bytes).
+    :param path: Path of the index file, or ``None`` to keep the index in memory only.
+    :return: Tuple ``(adr_raw, eth_adr)`` with the address (raw bytes) and the checksummed address.
+    """
+    index = _indexes.get(path, None)
+    if index is None:
+        index = _indexes[path] = KeyIndex(path)
+    return index.address(ethkey)
+
+
+def print_address(eth_adr, qrcode=True):
+    """
+    Print the address of the delegate, optionally with a QR code (importing pyqrcode only when printing one).
+
+    :param eth_adr: The checksummed address.
+    :param qrcode: Whether to print a QR code.
+    """
+    if qrcode:
+        import pyqrcode
+        eth_adr_qr = pyqrcode.create(eth_adr, error='L', mode='binary').terminal()
+        print('Delegate Ethereum address is {}:\n{}'.format(eth_adr, eth_adr_qr))
+    else:
+        print('Delegate Ethereum address is {}'.format(eth_adr))
+
+
+def add_keyindex_arguments(parser, qrcode=True):
+    """
+    Add the command line options for the key index (and printing the delegate address) to an argument parser.
+
+    :param parser: The :class:`argparse.ArgumentParser`.
+    :param qrcode: Whether to add the option for printing the delegate address as QR code.
+    """
+    parser.add_argument('--keyindex',
+                        dest='keyindex',
+                        type=str,
+                        default=KeyIndex.DEFAULT_PATH,
+                        help='Key index file caching the addresses derived from delegate keys, or "" to keep '
+                             'the index in memory only (default: "{}").'.format(KeyIndex.DEFAULT_PATH))
+
+    if qrcode:
+        parser.add_argument('--no_qrcode',
+                            dest='no_qrcode',
+                            action='store_true',
+                            help='Do not print the delegate address as QR code (faster startup).')
@@ -0,0 +1,72 @@
+# coding=utf8
+
+# XBR user profile and market maker values, read without autobahn.xbr: importing autobahn.xbr imports web3
+# and eth_keys, which adds about two seconds to the startup of tools that do not need them otherwise
+
+import os
+import binascii
+import configparser
+
+
+class Profile(object):
+    """
+    XBR user profile, a section of the user configuration (``~/.xbrnetwork/config.ini``), with the
+    attributes of the profiles loaded by ``autobahn.xbr.load_or_create_profile``.
+    """
+
+    def __init__(self, path=None, name=None, ethkey=None, cskey=None, market_url=None, market_realm=None,
+                 infura_url=None, infura_network=None, infura_key=None, infura_secret=None):
+        self.path = path
+        self.name = name
+        self.ethkey = ethkey
+        self.cskey = cskey
+        self.market_url = market_url
+        self.market_realm = market_realm
+        self.infura_url = infura_url
+        self.infura_network = infura_network
+        self.infura_key = infura_key
+        self.infura_secret = infura_secret
+
+    @staticmethod
+    def parse(path, name, items):
+        kwargs = {}
+        for k, v in items:
+            if k in ('ethkey', 'cskey'):
+                kwargs[k] = binascii.a2b_hex(v[2:])
+            elif k in ('market_url', 'market_realm', 'infura_url', 'infura_network', 'infura_key', 'infura_secret'):
+                kwargs[k] = str(v)
+        return Profile(path, name, **kwargs)
+
+
+def load_profile(dotdir=None, profile=None):
+    """
+    Load a XBR user profile. A user configuration or profile which does not exist yet is created
+    (interactively) by ``autobahn.xbr.load_or_create_profile``, which is only imported then.
+
+    :param dotdir: Directory of the user configuration (default: ``~/.xbrnetwork``).
+    :param profile: Name of the profile (default: ``default``).
+    :return: The :class:`Profile`.
+    """
+    dotdir = dotdir or '~/.xbrnetwork'
+    profile = profile or 'default'
+
+    config_path = os.path.join(os.path.expanduser(dotdir), 'config.ini')
+    config = configparser.ConfigParser()
+    if not config.read(config_path) or not config.has_section(profile):
+        from autobahn.xbr import load_or_create_profile
+        return load_or_create_profile(dotdir, profile)
+    return Profile.parse(config_path, profile, config.items(profile))
+
+
+def unpack_uint256(data):
+    """
+    Unpack a uint256 (as returned by the XBR market maker, e.g. channel amounts and balances).
+
+    :param data: The value serialized as 32 bytes (big endian), or ``None``.
+    :return: The value (``0`` for ``None``).
+    """
+    assert data is None or type(data) == bytes, 'data must by bytes, was {}'.format(type(data))
+    if data:
+        assert len(data) == 32, 'data must be bytes[32], but was bytes[{}]'.format(len(data))
+        return int.from_bytes(data, 'big')
+    return 0
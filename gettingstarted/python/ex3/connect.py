@@ -1,30 +1,36 @@
 # coding=utf8
 
 # connect to WAMP router, join a XBR realm (with WAMP-cryptosign authentication), print session details and
-# get (if any) active buyer/seller channels and exit
+# get (if any) active buyer/seller channels and exit. with --delegate/--delegates, query the channels of
+# many delegates concurrently over the one session and write them as a JSON or CSV table
 
+import os
 import sys
-import pyqrcode
+import csv
+import json
+import uuid
 import argparse
 import binascii
 
 from pprint import pformat
 
-import eth_keys
-import web3
-
 import txaio
 
 txaio.use_twisted()
 
 from twisted.internet import reactor
 from twisted.internet.error import ReactorNotRunning
+from twisted.internet.defer import DeferredSemaphore, ensureDeferred, gatherResults
 
 from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
 from autobahn.wamp.serializer import CBORSerializer
 from autobahn.wamp import cryptosign
 
-from autobahn.xbr import unpack_uint256, load_or_create_profile
+# helpers shared by the examples (common/) are imported from the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.keyindex import KeyIndex, add_keyindex_arguments, get_address, print_address
+from common.profile import load_profile, unpack_uint256
 
 
 class XbrDelegate(ApplicationSession):
@@ -32,10 +38,12 @@ class XbrDelegate(ApplicationSession):
     def __init__(self, config=None):
         ApplicationSession.__init__(self, config)
         self._ethkey_raw = config.extra['ethkey']
-        self._ethkey = eth_keys.keys.PrivateKey(self._ethkey_raw)
-        self._ethadr = web3.Web3.toChecksumAddress(self._ethkey.public_key.to_canonical_address())
+        # the address is derived once per key, and then looked up in the key index
+        self._ethadr_raw, self._ethadr = get_address(self._ethkey_raw,
+                                                     config.extra.get('keyindex', KeyIndex.DEFAULT_PATH))
         self._key = cryptosign.SigningKey.from_key_bytes(config.extra['cskey'])
         self._running = True
+        self._stopping = False
 
     def onUserError(self, fail, msg):
         self.leave('wamp.error', msg)
@@ -45,8 +53,14 @@ class XbrDelegate(ApplicationSession):
 
         try:
             delegate_key = self._ethkey_raw
-            delegate_adr = self._ethkey.public_key.to_canonical_address()
-            await self._do_get_channel(delegate_key, delegate_adr)
+            delegate_adr = self._ethadr_raw
+            delegates = self.config.extra.get('delegates', None)
+            if delegates:
+                await self._do_get_channels(delegates, self.config.extra.get('concurrency', 20),
+                                            self.config.extra.get('format', 'json'),
+                                            self.config.extra.get('output', None))
+            else:
+                await self._do_get_channel(delegate_key, delegate_adr)
         except Exception as e:
             self.log.failure()
             self.config.extra['error'] = e
@@ -60,6 +74,7 @@ class XbrDelegate(ApplicationSession):
 
         if details.reason == 'wamp.close.normal':
             self.log.info('Shutting down ..')
+            self._stopping = True
             # user initiated leave => end the program
             self.config.runner.stop()
             self.disconnect()
@@ -70,38 +85,153 @@ class XbrDelegate(ApplicationSession):
     def onDisconnect(self):
         self.log.info('{klass}.onDisconnect()', klass=self.__class__.__name__)
 
-        try:
-            reactor.stop()
-        except ReactorNotRunning:
-            pass
+        # only stop when leaving (normally): when the connection was lost, ApplicationRunner reconnects
+        if self._stopping:
+            try:
+                reactor.stop()
+            except ReactorNotRunning:
+                pass
+
+    # columns of the (machine-readable) channel table, one row per delegate
+    COLUMNS = ['delegate',
+               'payment_channel', 'payment_amount', 'payment_remaining', 'payment_seq',
+               'paying_channel', 'paying_amount', 'paying_remaining', 'paying_seq',
+               'error']
+
+    async def _query_channel(self, get_channel, get_balance, delegate_adr):
+        channel = await self.call(get_channel, delegate_adr)
+        self.log.debug('{channel}', channel=pformat(channel))
+        if not channel:
+            return None, None
+        balance = await self.call(get_balance, channel['channel_oid'])
+        self.log.debug('{balance}', balance=pformat(balance))
+        return channel, balance
+
+    async def _query_channels(self, delegate_adr):
+        """
+        Query the active buyer (payment) and seller (paying) channel, and their off-chain balances,
+        of a delegate. Both channels are queried concurrently.
+
+        :param delegate_adr: Address of the delegate (20 bytes).
+        :return: Row of the channel table (see ``COLUMNS``), amounts in (non-decimal) token units.
+        """
+        row = dict.fromkeys(self.COLUMNS)
+        row['delegate'] = '0x' + binascii.b2a_hex(delegate_adr).decode()
+        results = await gatherResults([
+            ensureDeferred(self._query_channel('xbr.marketmaker.get_active_payment_channel',
+                                               'xbr.marketmaker.get_payment_channel_balance', delegate_adr)),
+            ensureDeferred(self._query_channel('xbr.marketmaker.get_active_paying_channel',
+                                               'xbr.marketmaker.get_paying_channel_balance', delegate_adr)),
+        ])
+        for kind, (channel, balance) in zip(['payment', 'paying'], results):
+            if channel:
+                row[kind + '_channel'] = str(uuid.UUID(bytes=channel['channel_oid']))
+                row[kind + '_amount'] = unpack_uint256(channel['amount'])
+                row[kind + '_remaining'] = unpack_uint256(balance['remaining'])
+                row[kind + '_seq'] = balance['seq']
+        return row
 
     async def _do_get_channel(self, delegate_key, delegate_adr):
+        row = await self._query_channels(delegate_adr)
         print('*' * 100)
-        channel = await self.call('xbr.marketmaker.get_active_payment_channel', delegate_adr)
-        self.log.debug('{channel}', channel=pformat(channel))
-        if channel:
+        if row['payment_channel']:
             self.log.info('Active buyer (payment) channel found: {amount} amount',
-                          amount=int(unpack_uint256(channel['amount']) / 10**18))
-            balance = await self.call('xbr.marketmaker.get_payment_channel_balance', channel['channel_oid'])
-            self.log.debug('{balance}', channel=pformat(balance))
+                          amount=int(row['payment_amount'] / 10**18))
             self.log.info('Current off-chain amount remaining: {remaining} [sequence {sequence}]',
-                          remaining=int(unpack_uint256(balance['remaining']) / 10 ** 18), sequence=balance['seq'])
+                          remaining=int(row['payment_remaining'] / 10 ** 18), sequence=row['payment_seq'])
         else:
             self.log.info('No active buyer (payment) channel found!')
         print('.' * 100)
-        channel = await self.call('xbr.marketmaker.get_active_paying_channel', delegate_adr)
-        self.log.debug('{channel}', channel=pformat(channel))
-        if channel:
+        if row['paying_channel']:
             self.log.info('Active seller (paying) channel found: {amount} amount',
-                          amount=int(unpack_uint256(channel['amount']) / 10**18))
-            balance = await self.call('xbr.marketmaker.get_paying_channel_balance', channel['channel_oid'])
-            self.log.debug('{balance}', channel=pformat(balance))
+                          amount=int(row['paying_amount'] / 10**18))
             self.log.info('Current off-chain amount remaining: {remaining} [sequence {sequence}]',
-                          remaining=int(unpack_uint256(balance['remaining']) / 10 ** 18), sequence=balance['seq'])
+                          remaining=int(row['paying_remaining'] / 10 ** 18), sequence=row['paying_seq'])
         else:
             self.log.info('No active seller (paying) channel found!')
         print('*' * 100)
 
+    async def _do_get_channels(self, delegates, concurrency, fmt, output):
+        """
+        Query the channels of many delegates over this session, with at most ``concurrency`` delegates
+        queried at the same time, and write the channel table as JSON or CSV.
+        """
+        limit = DeferredSemaphore(concurrency)
+
+        async def query(delegate_adr):
+            try:
+                return await self._query_channels(delegate_adr)
+            except Exception as e:
+                row = dict.fromkeys(self.COLUMNS)
+                row['delegate'] = '0x' + binascii.b2a_hex(delegate_adr).decode()
+                row['error'] = str(e)
+                return row
+
+        rows = await gatherResults([limit.run(lambda adr=adr: ensureDeferred(query(adr))) for adr in delegates])
+        self.log.info('Queried channels of {count} delegates', count=len(rows))
+
+        f = open(output, 'w', newline='') if output else sys.stdout
+        try:
+            if fmt == 'csv':
+                writer = csv.DictWriter(f, fieldnames=self.COLUMNS)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump(rows, f, indent=2)
+                f.write('\n')
+        finally:
+            if output:
+                f.close()
+
+
+def _read_lines(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def add_profile_arguments(parser, what):
+    """
+    Add the command line options for delegates given by profile to an argument parser.
+
+    :param parser: The :class:`argparse.ArgumentParser`.
+    :param what: What is done for the delegates, completing the help texts (e.g. ``'to query channels for'``).
+    """
+    parser.add_argument('--profile',
+                        dest='profiles',
+                        type=str,
+                        action='append',
+                        default=[],
+                        help='Profile (in the user configuration) of a delegate {}, for the address of its key '
+                             '(can be given multiple times).'.format(what))
+
+    parser.add_argument('--profiles',
+                        dest='profiles_file',
+                        type=str,
+                        help='File with profiles of delegates {} (one per line).'.format(what))
+
+
+def resolve_delegates(args):
+    """
+    Get the addresses of the delegates given on the command line: the addresses given (``--delegate`` and
+    ``--delegates``), and the addresses of the keys of the profiles given (``--profile`` and ``--profiles``,
+    see :func:`add_profile_arguments`), looked up in the key index.
+
+    :param args: The parsed command line options.
+    :return: List of addresses (raw bytes).
+    """
+    delegates = list(args.delegates)
+    if args.delegates_file:
+        delegates.extend(_read_lines(args.delegates_file))
+    addresses = [binascii.a2b_hex(adr[2:] if adr.startswith('0x') else adr) for adr in delegates]
+
+    profiles = list(args.profiles)
+    if args.profiles_file:
+        profiles.extend(_read_lines(args.profiles_file))
+    for name in profiles:
+        adr_raw, _ = get_address(load_profile(profile=name).ethkey, args.keyindex or None)
+        addresses.append(adr_raw)
+    return addresses
+
 
 if __name__ == '__main__':
 
@@ -112,6 +242,40 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Enable debug output.')
 
+    parser.add_argument('--delegate',
+                        dest='delegates',
+                        type=str,
+                        action='append',
+                        default=[],
+                        help='Address of a delegate to query channels for (can be given multiple times).')
+
+    parser.add_argument('--delegates',
+                        dest='delegates_file',
+                        type=str,
+                        help='File with addresses of delegates to query channels for (one per line).')
+
+    add_profile_arguments(parser, 'to query channels for')
+
+    parser.add_argument('--concurrency',
+                        dest='concurrency',
+                        type=int,
+                        default=20,
+                        help='Number of delegates queried at the same time (default: 20).')
+
+    parser.add_argument('--format',
+                        dest='format',
+                        type=str,
+                        choices=['json', 'csv'],
+                        default='json',
+                        help='Format of the channel table written when querying many delegates (default: json).')
+
+    parser.add_argument('--output',
+                        dest='output',
+                        type=str,
+                        help='File to write the channel table to (default: stdout).')
+
+    add_keyindex_arguments(parser)
+
     args = parser.parse_args()
 
     if args.debug:
@@ -119,17 +283,19 @@ if __name__ == '__main__':
     else:
         txaio.start_logging(level='info')
 
-    profile = load_or_create_profile()
+    profile = load_profile()
 
-    privkey = eth_keys.keys.PrivateKey(profile.ethkey)
-    adr_raw = privkey.public_key.to_canonical_address()
-    eth_adr = web3.Web3.toChecksumAddress(adr_raw)
-    eth_adr_qr = pyqrcode.create(eth_adr, error='L', mode='binary').terminal()
-    print('Delegate Ethereum address is {}:\n{}'.format(eth_adr, eth_adr_qr))
+    _, eth_adr = get_address(profile.ethkey, args.keyindex or None)
+    print_address(eth_adr, qrcode=not args.no_qrcode)
 
     extra = {
         'ethkey': profile.ethkey,
         'cskey': profile.cskey,
+        'keyindex': args.keyindex or None,
+        'delegates': resolve_delegates(args),
+        'concurrency': args.concurrency,
+        'format': args.format,
+        'output': args.output,
     }
 
     runner = ApplicationRunner(url=profile.market_url, realm=profile.market_realm, extra=extra,
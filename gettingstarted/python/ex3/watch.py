@@ -0,0 +1,362 @@
+# coding=utf8
+
+# connect to WAMP router, join a XBR realm (with WAMP-cryptosign authentication), and keep watching the
+# off-chain balances of the active buyer/seller channels of (many) delegates, reporting channels running low
+
+import os
+import sys
+import uuid
+import heapq
+import argparse
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.internet.defer import DeferredSemaphore, ensureDeferred, gatherResults
+
+from autobahn.twisted.wamp import ApplicationRunner
+from autobahn.wamp.serializer import CBORSerializer
+
+# helpers shared by the examples (common/) are imported from the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import connect
+from common.keyindex import add_keyindex_arguments, get_address, print_address
+from common.profile import load_profile, unpack_uint256
+
+
+class BalanceWatcher(object):
+    """
+    Keeps a local view of the off-chain balance (``remaining`` and ``seq``) of many channels.
+
+    Balances are updated from balance events pushed by the market maker (when subscribed to), and by
+    polling, where the polling interval of a channel backs off while its balance does not change (or
+    is pushed), and drops back to the minimum interval when it changes. All channels are polled from
+    one schedule served by a single reactor timer, with a limit on concurrent calls.
+    """
+    log = make_logger()
+
+    def __init__(self, session, reactor=None, min_interval=5, max_interval=300, backoff=2, concurrency=10):
+        """
+
+        :param session: WAMP session to call the market maker on.
+        :param reactor: Twisted reactor to run under.
+        :param min_interval: Polling interval (in seconds) of a channel after its balance changed.
+        :param max_interval: Maximum polling interval (in seconds) of a channel.
+        :param backoff: Factor the polling interval grows by each time the balance was unchanged.
+        :param concurrency: Maximum number of balance calls in flight.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._session = session
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._limit = DeferredSemaphore(concurrency)
+
+        # channel_oid -> channel state
+        self._channels = {}
+        # heap of (due, channel_oid)
+        self._schedule = []
+        self._timer = None
+        self._running = False
+        # list of (fraction, callback, channels below fraction)
+        self._thresholds = []
+
+        self.polls = 0
+        self.pushes = 0
+
+    def on_threshold(self, fraction, callback):
+        """
+        Register a callback fired when the balance of a channel falls below a fraction of the channel
+        amount. The callback fires once when falling below, and again only after having been above.
+
+        :param fraction: Fraction of the channel amount, e.g. ``0.1`` for "under 10% left".
+        :param callback: Callback ``callback(channel_oid, channel)`` with the channel state.
+        """
+        self._thresholds.append((fraction, callback, set()))
+
+    def watch(self, channel_oid, kind, amount, remaining=None, seq=None):
+        """
+        Watch the balance of a channel.
+
+        :param channel_oid: OID of the channel (16 bytes).
+        :param kind: ``'payment'`` (buyer) or ``'paying'`` (seller) channel.
+        :param amount: The channel amount (in token units).
+        :param remaining: Initial (known) remaining off-chain balance.
+        :param seq: Initial (known) off-chain transaction sequence number.
+        """
+        assert kind in ['payment', 'paying']
+        self._channels[channel_oid] = {
+            'kind': kind,
+            'amount': amount,
+            'remaining': None,
+            'seq': None,
+            'interval': self._min_interval,
+            'updated': None,
+        }
+        if remaining is not None:
+            self._update(channel_oid, remaining, seq)
+        self._push(channel_oid, self._reactor.seconds() + (self._min_interval if remaining is not None else 0))
+
+    def channels(self):
+        """
+        :return: Map of channel OID to channel state (kind, amount, remaining, seq, polling interval).
+        """
+        return self._channels
+
+    def on_balance(self, channel_oid, balance):
+        """
+        WAMP event handler for balance updates pushed by the market maker.
+
+        :param channel_oid: OID of the channel.
+        :param balance: The channel balance (as returned by ``xbr.marketmaker.get_*_channel_balance``).
+        """
+        channel = self._channels.get(channel_oid, None)
+        if channel is None:
+            return
+        self.pushes += 1
+        self._update(channel_oid, unpack_uint256(balance['remaining']), balance['seq'])
+        # pushes keep the balance up to date, so polling can back off fully
+        channel['interval'] = self._max_interval
+
+    def start(self):
+        """
+        Start polling channel balances.
+        """
+        assert not self._running
+        self._running = True
+        self._reschedule()
+
+    def stop(self):
+        """
+        Stop polling channel balances.
+        """
+        self._running = False
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def _update(self, channel_oid, remaining, seq):
+        channel = self._channels[channel_oid]
+        changed = seq != channel['seq'] or remaining != channel['remaining']
+        if seq is not None and channel['seq'] is not None and seq < channel['seq']:
+            # stale (e.g. a poll racing a push)
+            return False
+        channel['remaining'] = remaining
+        channel['seq'] = seq
+        channel['updated'] = self._reactor.seconds()
+        if changed:
+            self.log.info('Channel {channel_oid} ({kind}): {remaining} remaining [sequence {seq}]',
+                          channel_oid=uuid.UUID(bytes=channel_oid), kind=channel['kind'],
+                          remaining=int(remaining / 10**18), seq=seq)
+            self._check_thresholds(channel_oid, channel)
+        return changed
+
+    def _check_thresholds(self, channel_oid, channel):
+        if not channel['amount']:
+            return
+        left = channel['remaining'] / channel['amount']
+        for fraction, callback, below in self._thresholds:
+            if left < fraction:
+                if channel_oid not in below:
+                    below.add(channel_oid)
+                    try:
+                        callback(channel_oid, channel)
+                    except Exception:
+                        self.log.failure()
+            else:
+                below.discard(channel_oid)
+
+    def _push(self, channel_oid, due):
+        heapq.heappush(self._schedule, (due, channel_oid))
+        if self._running and self._schedule[0][1] == channel_oid:
+            self._reschedule()
+
+    def _reschedule(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if self._running and self._schedule:
+            delay = max(0, self._schedule[0][0] - self._reactor.seconds())
+            self._timer = self._reactor.callLater(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        now = self._reactor.seconds()
+        while self._schedule and self._schedule[0][0] <= now:
+            _, channel_oid = heapq.heappop(self._schedule)
+            if channel_oid in self._channels:
+                self._limit.run(lambda oid=channel_oid: ensureDeferred(self._poll(oid)))
+        self._reschedule()
+
+    async def _poll(self, channel_oid):
+        # polls still waiting for a slot when stopped are skipped
+        if not self._running:
+            return
+        channel = self._channels[channel_oid]
+        try:
+            balance = await self._session.call('xbr.marketmaker.get_{}_channel_balance'.format(channel['kind']),
+                                               channel_oid)
+        except Exception as e:
+            self.log.warn('Failed to get balance of channel {channel_oid}: {error}',
+                          channel_oid=uuid.UUID(bytes=channel_oid), error=e)
+        else:
+            self.polls += 1
+            if self._update(channel_oid, unpack_uint256(balance['remaining']), balance['seq']):
+                channel['interval'] = self._min_interval
+            else:
+                channel['interval'] = min(channel['interval'] * self._backoff, self._max_interval)
+        self._push(channel_oid, self._reactor.seconds() + channel['interval'])
+
+
+class XbrDelegate(connect.XbrDelegate):
+
+    def __init__(self, config=None):
+        connect.XbrDelegate.__init__(self, config)
+        self._watcher = None
+
+    async def onJoin(self, details):
+        self.log.info('{klass}.onJoin(details={details})', klass=self.__class__.__name__, details=details)
+
+        try:
+            delegate_adr = self._ethadr_raw
+            delegates = self.config.extra.get('delegates', None) or [delegate_adr]
+
+            watcher = BalanceWatcher(self,
+                                     min_interval=self.config.extra.get('min_interval', 5),
+                                     max_interval=self.config.extra.get('max_interval', 300),
+                                     concurrency=self.config.extra.get('concurrency', 10))
+            self._watcher = watcher
+
+            def on_low_balance(channel_oid, channel):
+                self.log.warn('Channel {channel_oid} ({kind}) is running low: {remaining} of {amount} remaining',
+                              channel_oid=uuid.UUID(bytes=channel_oid), kind=channel['kind'],
+                              remaining=int(channel['remaining'] / 10**18), amount=int(channel['amount'] / 10**18))
+
+            watcher.on_threshold(self.config.extra.get('threshold', 0.1), on_low_balance)
+
+            await gatherResults([self.subscribe(watcher.on_balance, topic)
+                                 for topic in self.config.extra.get('push_topics', [])], consumeErrors=True)
+
+            # look up the active channels (and initial balances) of all delegates, concurrently
+            limit = DeferredSemaphore(self.config.extra.get('concurrency', 10))
+            rows = await gatherResults([limit.run(lambda adr=adr: ensureDeferred(self._query_channels(adr)))
+                                        for adr in delegates])
+            for row in rows:
+                for kind in ['payment', 'paying']:
+                    if row[kind + '_channel']:
+                        watcher.watch(uuid.UUID(row[kind + '_channel']).bytes, kind, row[kind + '_amount'],
+                                      row[kind + '_remaining'], row[kind + '_seq'])
+
+            self.log.info('Watching {count} channels of {delegates} delegates', count=len(watcher.channels()),
+                          delegates=len(delegates))
+            watcher.start()
+        except Exception as e:
+            self.log.failure()
+            self.config.extra['error'] = e
+            self.leave()
+
+    def onLeave(self, details):
+        # the watcher polls through this session: a new one is started when (re)joining
+        if self._watcher:
+            self._watcher.stop()
+            self._watcher = None
+        connect.XbrDelegate.onLeave(self, details)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d',
+                        '--debug',
+                        action='store_true',
+                        help='Enable debug output.')
+
+    parser.add_argument('--delegate',
+                        dest='delegates',
+                        type=str,
+                        action='append',
+                        default=[],
+                        help='Address of a delegate to watch channels of (default: this delegate).')
+
+    parser.add_argument('--delegates',
+                        dest='delegates_file',
+                        type=str,
+                        help='File with addresses of delegates to watch channels of (one per line).')
+
+    connect.add_profile_arguments(parser, 'to watch channels of')
+
+    parser.add_argument('--threshold',
+                        dest='threshold',
+                        type=float,
+                        default=0.1,
+                        help='Report channels with less than this fraction of the amount remaining (default: 0.1).')
+
+    parser.add_argument('--min_interval',
+                        dest='min_interval',
+                        type=float,
+                        default=5,
+                        help='Polling interval in seconds after a balance changed (default: 5).')
+
+    parser.add_argument('--max_interval',
+                        dest='max_interval',
+                        type=float,
+                        default=300,
+                        help='Maximum polling interval in seconds for unchanged balances (default: 300).')
+
+    parser.add_argument('--concurrency',
+                        dest='concurrency',
+                        type=int,
+                        default=10,
+                        help='Number of market maker calls in flight (default: 10).')
+
+    parser.add_argument('--push_topic',
+                        dest='push_topics',
+                        type=str,
+                        action='append',
+                        default=[],
+                        help='Market maker topic publishing balance updates (channel_oid, balance) to subscribe to.')
+
+    add_keyindex_arguments(parser, qrcode=False)
+
+    args = parser.parse_args()
+
+    if args.debug:
+        txaio.start_logging(level='debug')
+    else:
+        txaio.start_logging(level='info')
+
+    profile = load_profile()
+
+    _, eth_adr = get_address(profile.ethkey, args.keyindex or None)
+    print_address(eth_adr, qrcode=False)
+
+    extra = {
+        'ethkey': profile.ethkey,
+        'cskey': profile.cskey,
+        'keyindex': args.keyindex or None,
+        'delegates': connect.resolve_delegates(args),
+        'threshold': args.threshold,
+        'min_interval': args.min_interval,
+        'max_interval': args.max_interval,
+        'concurrency': args.concurrency,
+        'push_topics': args.push_topics,
+    }
+
+    # reconnect quickly, with exponential backoff (and jitter) between attempts
+    runner = ApplicationRunner(url=profile.market_url, realm=profile.market_realm, extra=extra,
+                               serializers=[CBORSerializer()], max_retries=-1, initial_retry_delay=0.2,
+                               max_retry_delay=30, retry_delay_growth=1.5, retry_delay_jitter=0.1)
+
+    try:
+        runner.run(XbrDelegate, auto_reconnect=True)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+    else:
+        sys.exit(0)
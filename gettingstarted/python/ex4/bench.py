@@ -0,0 +1,631 @@
+# coding=utf8
+
+# benchmark of the XBR seller/buyer pipelines (see publisher.py and receiver.py): sellers and buyers run in one
+# process against an in-process WAMP router stand-in and a market maker stub, reporting publish rate, end-to-end
+# latency percentiles, CPU time per event and memory, for combinations of payload sizes and key rotation intervals
+
+import os
+import json
+import time
+import uuid
+import inspect
+import argparse
+import resource
+from collections import namedtuple
+
+import cbor2
+import nacl.public
+import nacl.secret
+import nacl.utils
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.internet import task
+from twisted.internet.defer import Deferred, DeferredList, QueueOverflow, ensureDeferred, maybeDeferred
+from twisted.internet.task import LoopingCall
+
+from autobahn.twisted.util import sleep
+from autobahn.wamp.request import Subscription
+from autobahn.wamp.types import EventDetails, SubscribeOptions
+
+from publisher import QueuePublisher
+from receiver import QueueReceiver
+from keycache import KeyCache
+import compressors
+import payloads
+from metrics import MetricsRegistry
+from tracing import EventTracer
+
+
+# publication acknowledged by the router
+Publication = namedtuple('Publication', ['id'])
+
+
+class LoopbackRouter(object):
+    """
+    In-process stand-in for a WAMP router: sessions publish, subscribe, call and register on the router
+    directly, with every message serialized (CBOR) and delivered from the reactor, like over a connection.
+    Only exact and prefix matching subscriptions are supported.
+    """
+
+    def __init__(self, reactor):
+        self._reactor = reactor
+        # topic -> [(subscription, details)]
+        self._exact = {}
+        # [(prefix, subscription, details)]
+        self._prefixes = []
+        # procedure -> endpoint
+        self._procedures = {}
+        self._next_id = 1
+
+        self.published = 0
+        self.delivered = 0
+        self.calls = 0
+
+    def session(self):
+        """
+        :return: A new session on the router.
+        """
+        return LoopbackSession(self)
+
+    def _id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def subscribe(self, session, handler, topic, options=None):
+        subscription = Subscription(self._id(), topic, session, handler)
+        details = bool(options and options.details)
+        if options and options.match == 'prefix':
+            self._prefixes.append((topic, subscription, details))
+        elif options is None or options.match in (None, 'exact'):
+            self._exact.setdefault(topic, []).append((subscription, details))
+        else:
+            raise ValueError('match policy "{}" not supported'.format(options.match))
+        return subscription
+
+    def publish(self, topic, args, kwargs):
+        publication = self._id()
+        self.published += 1
+        msg = cbor2.dumps([args, kwargs])
+        subscribers = [(subscription, details, None) for subscription, details in self._exact.get(topic, [])]
+        subscribers.extend((subscription, details, topic) for prefix, subscription, details in self._prefixes
+                           if topic.startswith(prefix))
+        for subscription, details, event_topic in subscribers:
+            self._reactor.callLater(0, self._deliver, subscription, details, publication, event_topic, msg)
+        return publication
+
+    def _deliver(self, subscription, details, publication, topic, msg):
+        args, kwargs = cbor2.loads(msg)
+        if details:
+            kwargs['details'] = EventDetails(subscription, publication, topic=topic)
+        self.delivered += 1
+        subscription.handler(*args, **kwargs)
+
+    def register(self, endpoint, procedure):
+        if procedure in self._procedures:
+            raise ValueError('procedure "{}" already registered'.format(procedure))
+        self._procedures[procedure] = endpoint
+
+    def call(self, procedure, args, kwargs):
+        self.calls += 1
+        d = Deferred()
+        self._reactor.callLater(0, self._invoke, d, procedure, cbor2.dumps([args, kwargs]))
+        return d
+
+    def _invoke(self, d, procedure, msg):
+        args, kwargs = cbor2.loads(msg)
+        result = maybeDeferred(lambda: self._procedures[procedure](*args, **kwargs))
+        result.addCallback(lambda res: ensureDeferred(res) if inspect.iscoroutine(res) else res)
+        result.addCallback(lambda res: cbor2.loads(cbor2.dumps(res)))
+        result.chainDeferred(d)
+
+
+class LoopbackSession(object):
+    """
+    Session on a :class:`LoopbackRouter`, with the (subset of the) WAMP session API used by the delegates.
+    """
+
+    def __init__(self, router):
+        self._router = router
+
+    def publish(self, topic, *args, options=None, **kwargs):
+        publication = self._router.publish(topic, args, kwargs)
+        if options is not None and options.acknowledge:
+            d = Deferred()
+            self._router._reactor.callLater(0, d.callback, Publication(publication))
+            return d
+
+    def subscribe(self, handler, topic, options=None):
+        d = Deferred()
+        d.callback(self._router.subscribe(self, handler, topic, options))
+        return d
+
+    def register(self, endpoint, procedure, options=None):
+        self._router.register(endpoint, procedure)
+        d = Deferred()
+        d.callback(None)
+        return d
+
+    def call(self, procedure, *args, **kwargs):
+        return self._router.call(procedure, args, kwargs)
+
+
+class MarketMakerStub(object):
+    """
+    Market maker stub: configuration, payment/paying channels with (off-chain) balances, and key offers.
+    Keys are handed out sealed to the buyer (no signatures, and no actual payment).
+    """
+    log = make_logger()
+
+    def __init__(self, session, balance=1000 * 10 ** 18):
+        self._session = session
+        self._adr = os.urandom(20)
+        self._balance = balance
+        # delegate_adr -> channel, channel_oid -> balance
+        self._channels = {}
+        self._balances = {}
+        # key_id -> (key, price)
+        self._offers = {}
+
+        self.offers = 0
+        self.keys_sold = 0
+
+    async def start(self):
+        for procedure, endpoint in [('get_config', self.get_config),
+                                    ('get_active_payment_channel', self.get_active_channel),
+                                    ('get_payment_channel_balance', self.get_channel_balance),
+                                    ('get_active_paying_channel', self.get_active_channel),
+                                    ('get_paying_channel_balance', self.get_channel_balance),
+                                    ('place_offer', self.place_offer),
+                                    ('buy_key', self.buy_key)]:
+            await self._session.register(endpoint, 'xbr.marketmaker.' + procedure)
+
+    def get_config(self):
+        return {'marketmaker': '0x' + self._adr.hex()}
+
+    def get_active_channel(self, delegate_adr):
+        if delegate_adr not in self._channels:
+            channel_oid = uuid.uuid4().bytes
+            self._channels[delegate_adr] = {'channel_oid': channel_oid, 'amount': self._balance}
+            self._balances[channel_oid] = {'remaining': self._balance, 'seq': 0}
+        return self._channels[delegate_adr]
+
+    def get_channel_balance(self, channel_oid):
+        return self._balances[channel_oid]
+
+    def place_offer(self, key_id, api_id, uri, key, price):
+        self._offers[key_id] = (key, price)
+        self.offers += 1
+        self._session.publish('xbr.marketmaker.on_offer_placed', {'key': key_id, 'api': api_id, 'uri': uri})
+
+    def buy_key(self, delegate_adr, buyer_pubkey, key_id):
+        key, price = self._offers[key_id]
+        balance = self._balances[self.get_active_channel(delegate_adr)['channel_oid']]
+        if balance['remaining'] < price:
+            raise Exception('insufficient balance in payment channel')
+        balance['remaining'] -= price
+        balance['seq'] += 1
+        self.keys_sold += 1
+        return nacl.public.SealedBox(nacl.public.PublicKey(buyer_pubkey)).encrypt(key)
+
+
+class StubKeySeries(object):
+    """
+    Data encryption keys of one API, rotated periodically, with the current key (ID and box) in the
+    same attributes as :class:`autobahn.xbr.KeySeries`.
+    """
+
+    def __init__(self, session, api_id, prefix, price, interval, reactor):
+        self._session = session
+        self._api_id = api_id
+        self._prefix = prefix
+        self._price = price
+        self._id = None
+        self._box = None
+        self._loop = LoopingCall(self._rotate)
+        self._loop.clock = reactor
+        self._interval = interval
+
+    async def start(self):
+        await self._rotate()
+        self._loop.start(self._interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def _rotate(self):
+        key = nacl.utils.random(nacl.secret.SecretBox.KEY_SIZE)
+        key_id = os.urandom(16)
+        self._id, self._box = key_id, nacl.secret.SecretBox(key)
+        return self._session.call('xbr.marketmaker.place_offer', key_id, self._api_id, self._prefix, key, self._price)
+
+
+class StubSeller(object):
+    """
+    Seller stub with the (subset of the) :class:`autobahn.twisted.xbr.SimpleSeller` API used by
+    :class:`publisher.QueuePublisher`: payloads are serialized and encrypted exactly like the seller does.
+    """
+
+    def __init__(self, delegate_adr, reactor):
+        self._delegate_adr = delegate_adr
+        self._reactor = reactor
+        self._apis = []
+        self._keys = {}
+
+    def add(self, api_id, prefix, price, interval):
+        self._apis.append((api_id, prefix, price, interval))
+
+    async def start(self, session):
+        channel = await session.call('xbr.marketmaker.get_active_paying_channel', self._delegate_adr)
+        balance = await session.call('xbr.marketmaker.get_paying_channel_balance', channel['channel_oid'])
+        for api_id, prefix, price, interval in self._apis:
+            self._keys[api_id] = StubKeySeries(session, api_id, prefix, price, interval, self._reactor)
+            await self._keys[api_id].start()
+        return balance['remaining']
+
+    def stop(self):
+        for keyseries in self._keys.values():
+            keyseries.stop()
+
+    async def wrap(self, api_id, uri, payload):
+        keyseries = self._keys[api_id]
+        return keyseries._id, 'cbor', keyseries._box.encrypt(cbor2.dumps(payload))
+
+
+class StubBuyer(object):
+    """
+    Buyer stub with the (subset of the) :class:`autobahn.twisted.xbr.SimpleBuyer` API used by
+    :class:`receiver.QueueReceiver`: keys are bought (sealed to the buyer) when first used, and
+    payloads are decrypted and deserialized exactly like the buyer does.
+    """
+
+    def __init__(self, delegate_adr):
+        self._delegate_adr = delegate_adr
+        self._receive_key = nacl.public.PrivateKey.generate()
+        self._keys = {}
+        self._session = None
+        # key_id -> deferreds waiting for the key being bought
+        self._buying = {}
+
+    async def start(self, session, consumer_id):
+        self._session = session
+        channel = await session.call('xbr.marketmaker.get_active_payment_channel', self._delegate_adr)
+        balance = await session.call('xbr.marketmaker.get_payment_channel_balance', channel['channel_oid'])
+        return balance['remaining']
+
+    async def unwrap(self, key_id, enc_ser, ciphertext):
+        if key_id not in self._keys:
+            self._keys[key_id] = False
+            self._buying[key_id] = []
+            try:
+                sealed = await self._session.call('xbr.marketmaker.buy_key', self._delegate_adr,
+                                                  bytes(self._receive_key.public_key), key_id)
+                key = nacl.public.SealedBox(self._receive_key).decrypt(sealed)
+            except Exception:
+                del self._keys[key_id]
+                raise
+            finally:
+                waiting = self._buying.pop(key_id)
+            self._keys[key_id] = nacl.secret.SecretBox(key)
+            for d in waiting:
+                d.callback(None)
+        elif self._keys[key_id] is False:
+            d = Deferred()
+            self._buying[key_id].append(d)
+            await d
+        return cbor2.loads(self._keys[key_id].decrypt(ciphertext))
+
+
+def percentile(values, p):
+    """
+    :param values: Sorted list of values.
+    :param p: Percentile (0-100).
+    :return: The value at the percentile (nearest rank).
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+
+class Benchmark(object):
+    """
+    One benchmark run: sellers publishing (and buyers receiving) events of one payload size, with keys
+    rotated at one interval, for a duration, after a warmup.
+    """
+    log = make_logger()
+
+    # tick (in seconds) at which sellers produce events
+    PRODUCE_TICK = 0.01
+
+    def __init__(self, reactor, sellers=1, buyers=1, topics=1, rate=1000, payload_size=256, interval=10,
+                 duration=10, warmup=2, max_inflight=64, queue_size=1000, workers=4, batch_size=1,
+                 batch_delay=None, codec=None, compression=None, metrics=None, trace=False):
+        self._reactor = reactor
+        self._sellers = sellers
+        self._buyers = buyers
+        self._topics = topics
+        self._rate = rate
+        self._payload_size = payload_size
+        self._interval = interval
+        self._duration = duration
+        self._warmup = warmup
+        self._max_inflight = max_inflight
+        self._queue_size = queue_size
+        self._workers = workers
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._codec = codec
+        self._compression = compression
+        self._metrics = metrics
+        self._trace = trace
+
+        self._measuring = False
+        self._latencies = []
+        self._produced = 0
+        self._overflow = 0
+
+    def _on_payload(self, payload, key_id, details):
+        if self._measuring:
+            self._latencies.append(time.perf_counter() - payload['ts'])
+
+    def _produce(self, publisher, topics, state):
+        # events due since the last tick (rate per seller), with fractions carried over
+        state['due'] += self._rate * self.PRODUCE_TICK
+        count, state['due'] = int(state['due']), state['due'] - int(state['due'])
+        data = os.urandom(self._payload_size)
+        for _ in range(count):
+            api_id, topic = topics[state['next'] % len(topics)]
+            state['next'] += 1
+            try:
+                publisher.put_nowait(api_id, topic, {'ts': time.perf_counter(), 'data': data})
+            except QueueOverflow:
+                self._overflow += 1
+            else:
+                if self._measuring:
+                    self._produced += 1
+
+    async def run(self):
+        """
+        :return: Dict with the results.
+        """
+        router = LoopbackRouter(self._reactor)
+        marketmaker = MarketMakerStub(router.session())
+        await marketmaker.start()
+
+        receivers = []
+        tracers = []
+        for _ in range(self._buyers):
+            session = router.session()
+            buyer = StubBuyer(os.urandom(20))
+            buyer._keys = KeyCache()
+            await buyer.start(session, None)
+            # every buyer receives every event, so sequence numbers are tracked per buyer
+            tracer = EventTracer() if self._trace else None
+            receiver = QueueReceiver(buyer, self._on_payload, reactor=self._reactor, workers=self._workers,
+                                     queue_size=self._queue_size, metrics=self._metrics, tracer=tracer)
+            await session.subscribe(receiver.on_event, 'io.crossbar.example.bench',
+                                    options=SubscribeOptions(match='prefix', details=True))
+            receivers.append((receiver, ensureDeferred(receiver.run())))
+            tracers.append(tracer)
+
+        publishers = []
+        for i in range(self._sellers):
+            session = router.session()
+            seller = StubSeller(os.urandom(20), self._reactor)
+            api_id = uuid.uuid4().bytes
+            prefix = 'io.crossbar.example.bench.{}'.format(i)
+            seller.add(api_id, prefix, 10 ** 15, self._interval)
+            await seller.start(session)
+            publisher = QueuePublisher(session, seller, reactor=self._reactor, max_inflight=self._max_inflight,
+                                       queue_size=self._queue_size, codec=self._codec,
+                                       batch_size=self._batch_size, batch_delay=self._batch_delay,
+                                       compression=self._compression, metrics=self._metrics, trace=self._trace)
+            topics = [(api_id, '{}.{}'.format(prefix, t)) for t in range(self._topics)]
+            producer = LoopingCall(self._produce, publisher, topics, {'due': 0., 'next': 0})
+            producer.clock = self._reactor
+            publishers.append((seller, publisher, ensureDeferred(publisher.run()), producer))
+            producer.start(self.PRODUCE_TICK)
+
+        await sleep(self._warmup)
+
+        self._measuring = True
+        published = sum(publisher.published for _, publisher, _, _ in publishers)
+        delivered = sum(receiver.delivered for receiver, _ in receivers)
+        started, cpu_started = time.perf_counter(), time.process_time()
+
+        await sleep(self._duration)
+
+        self._measuring = False
+        elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+        published = sum(publisher.published for _, publisher, _, _ in publishers) - published
+        delivered = sum(receiver.delivered for receiver, _ in receivers) - delivered
+
+        for seller, publisher, _, producer in publishers:
+            producer.stop()
+            publisher.stop()
+            seller.stop()
+        await DeferredList([publishing for _, _, publishing, _ in publishers])
+        for receiver, _ in receivers:
+            receiver.stop()
+        await DeferredList([receiving for _, receiving in receivers])
+
+        latencies = sorted(self._latencies)
+        return {
+            'sellers': self._sellers,
+            'buyers': self._buyers,
+            'payload_size': self._payload_size,
+            'interval': self._interval,
+            'batch_size': self._batch_size,
+            'produced': self._produced,
+            'overflow': self._overflow,
+            'published': published,
+            'delivered': delivered,
+            'publish_rate': published / elapsed,
+            'deliver_rate': delivered / elapsed,
+            'latency_p50_ms': _ms(percentile(latencies, 50)),
+            'latency_p90_ms': _ms(percentile(latencies, 90)),
+            'latency_p99_ms': _ms(percentile(latencies, 99)),
+            'latency_max_ms': _ms(latencies[-1] if latencies else None),
+            'cpu_us_per_event': cpu / delivered * 10 ** 6 if delivered else None,
+            'keys_sold': marketmaker.keys_sold,
+            'dropped': sum(receiver.dropped for receiver, _ in receivers),
+            'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            'trace': [tracer.stats() for tracer in tracers] if self._trace else None,
+        }
+
+
+def _ms(seconds):
+    return round(seconds * 1000., 3) if seconds is not None else None
+
+
+# columns of the results table printed
+COLUMNS = ['payload_size', 'interval', 'publish_rate', 'deliver_rate', 'latency_p50_ms', 'latency_p90_ms',
+           'latency_p99_ms', 'cpu_us_per_event', 'dropped', 'maxrss_mb']
+
+
+async def main(reactor, args):
+    results = []
+    print(' '.join('{:>16}'.format(column) for column in COLUMNS))
+    for payload_size in args.payload_sizes:
+        for interval in args.intervals:
+            benchmark = Benchmark(reactor, sellers=args.sellers, buyers=args.buyers, topics=args.topics,
+                                  rate=args.rate, payload_size=payload_size, interval=interval,
+                                  duration=args.duration, warmup=args.warmup, max_inflight=args.max_inflight,
+                                  queue_size=args.queue_size, workers=args.workers, batch_size=args.batch_size,
+                                  batch_delay=args.batch_delay / 1000., codec=args.codec,
+                                  compression=compressors.parse_compression(args.compression) if args.compression
+                                  else None,
+                                  metrics=MetricsRegistry() if args.metrics else None, trace=args.trace)
+            result = await benchmark.run()
+            results.append(result)
+            print(' '.join('{:>16}'.format(round(result[column], 1) if isinstance(result[column], float)
+                                           else str(result[column])) for column in COLUMNS))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d',
+                        '--debug',
+                        action='store_true',
+                        help='Enable debug output.')
+
+    parser.add_argument('--sellers',
+                        dest='sellers',
+                        type=int,
+                        default=1,
+                        help='Number of seller delegates (default: 1).')
+
+    parser.add_argument('--buyers',
+                        dest='buyers',
+                        type=int,
+                        default=1,
+                        help='Number of buyer delegates, each receiving the events of all sellers (default: 1).')
+
+    parser.add_argument('--topics',
+                        dest='topics',
+                        type=int,
+                        default=1,
+                        help='Number of topics per seller (default: 1).')
+
+    parser.add_argument('--rate',
+                        dest='rate',
+                        type=float,
+                        default=1000,
+                        help='Rate of events produced per seller per second (default: 1000).')
+
+    parser.add_argument('--payload_sizes',
+                        dest='payload_sizes',
+                        type=lambda value: [int(size) for size in value.split(',')],
+                        default=[64, 1024, 16384],
+                        help='Comma separated payload sizes in bytes to run with (default: 64,1024,16384).')
+
+    parser.add_argument('--intervals',
+                        dest='intervals',
+                        type=lambda value: [float(interval) for interval in value.split(',')],
+                        default=[10],
+                        help='Comma separated key rotation intervals in seconds to run with (default: 10).')
+
+    parser.add_argument('--duration',
+                        dest='duration',
+                        type=float,
+                        default=10,
+                        help='Duration in seconds of each run measured (default: 10).')
+
+    parser.add_argument('--warmup',
+                        dest='warmup',
+                        type=float,
+                        default=2,
+                        help='Duration in seconds of each run before measuring (default: 2).')
+
+    parser.add_argument('--max_inflight',
+                        dest='max_inflight',
+                        type=int,
+                        default=64,
+                        help='Maximum number of publications not yet acknowledged per seller (default: 64).')
+
+    parser.add_argument('--queue_size',
+                        dest='queue_size',
+                        type=int,
+                        default=1000,
+                        help='Size of the publishing and receiving queues (default: 1000).')
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=4,
+                        help='Number of events decrypted concurrently per buyer (default: 4).')
+
+    parser.add_argument('--batch_size',
+                        dest='batch_size',
+                        type=int,
+                        default=1,
+                        help='Maximum number of events per topic published as one batch (default: 1, no batching).')
+
+    parser.add_argument('--batch_delay',
+                        dest='batch_delay',
+                        type=float,
+                        default=10,
+                        help='Maximum time in ms an event waits for its batch to fill up (default: 10).')
+
+    parser.add_argument('--codec',
+                        dest='codec',
+                        type=str,
+                        choices=payloads.plain_codecs(),
+                        help='Codec to encode event payloads with, e.g. "msgpack" (default: none, plain CBOR).')
+
+    parser.add_argument('--compression',
+                        dest='compression',
+                        type=str,
+                        help='Compress event payloads before encryption, "name[:level[:dictionary_file]]" '
+                             '(default: none).')
+
+    parser.add_argument('--metrics',
+                        action='store_true',
+                        help='Instrument the pipelines with metrics (to measure the overhead of metrics).')
+
+    parser.add_argument('--trace',
+                        action='store_true',
+                        help='Trace events end-to-end (latency per stage is written to the results).')
+
+    parser.add_argument('--output',
+                        dest='output',
+                        type=str,
+                        help='File to write the results to (JSON), e.g. to compare runs for regressions.')
+
+    args = parser.parse_args()
+
+    if args.debug:
+        txaio.start_logging(level='debug')
+    else:
+        txaio.start_logging(level='info')
+
+    task.react(lambda reactor: ensureDeferred(main(reactor, args)))
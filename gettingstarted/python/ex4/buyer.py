@@ -3,30 +3,40 @@
 # connect to WAMP router, join a XBR realm (with WAMP-cryptosign authentication), and
 # subscribe to (XBR encrypted) events buying data encryption keys
 
+import os
 import sys
-import pyqrcode
 import argparse
-import binascii
-from uuid import UUID
-from pprint import pformat
-
-import eth_keys
-import web3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import txaio
 txaio.use_twisted()
 
 from twisted.internet import reactor
 from twisted.internet.error import ReactorNotRunning
+from twisted.internet.defer import ensureDeferred, gatherResults
+from twisted.web.server import Site
 
 from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
-from autobahn.twisted.xbr import SimpleBuyer
-
 from autobahn.wamp.types import SubscribeOptions
 from autobahn.wamp.serializer import CBORSerializer
 from autobahn.wamp import cryptosign
 
-from autobahn.xbr import load_or_create_profile
+# helpers shared by the examples (common/) are imported from the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from receiver import QueueReceiver
+from keycache import KeyCache, KeyPrefetcher
+from keystore import KeyStore
+from topics import TopicRouter
+from history import HistoryCatchUp
+from resume import SessionState, add_reconnect_arguments, reconnect_options
+from common.keyindex import KeyIndex, add_keyindex_arguments, get_address, print_address
+from common.profile import load_profile
+from metrics import DelegateMetrics, MetricsRegistry, MetricsResource, add_metrics_arguments
+from tracing import EventTracer
+from common.eventlog import add_eventlog_arguments, add_eventlog_metrics, open_eventlog
+import compressors
 
 
 class XbrDelegate(ApplicationSession):
@@ -34,10 +44,18 @@ class XbrDelegate(ApplicationSession):
     def __init__(self, config=None):
         ApplicationSession.__init__(self, config)
         self._ethkey_raw = config.extra['ethkey']
-        self._ethkey = eth_keys.keys.PrivateKey(self._ethkey_raw)
-        self._ethadr = web3.Web3.toChecksumAddress(self._ethkey.public_key.to_canonical_address())
+        # the address is derived once per key, and then looked up in the key index
+        self._ethadr_raw, self._ethadr = get_address(self._ethkey_raw,
+                                                     config.extra.get('keyindex', KeyIndex.DEFAULT_PATH))
         self._key = cryptosign.SigningKey.from_key_bytes(config.extra['cskey'])
         self._running = True
+        self._stopping = False
+        self._receiver = None
+        self._router = None
+        # state kept across reconnects
+        self._state = SessionState(config.extra.setdefault('state', {}), ttl=config.extra.get('state_ttl', 300))
+        # metrics (kept across reconnects)
+        self._metrics = DelegateMetrics(config.extra['metrics']) if config.extra.get('metrics', None) else None
 
     def onUserError(self, fail, msg):
         self.leave('wamp.error', msg)
@@ -47,43 +65,134 @@ class XbrDelegate(ApplicationSession):
 
         try:
             delegate_key = self._ethkey_raw
-            delegate_adr = self._ethkey.public_key.to_canonical_address()
+            delegate_adr = self._ethadr_raw
             print('Using delegate adr:', delegate_adr)
 
-            config = await self.call('xbr.marketmaker.get_config')
+            # the market maker configuration and the buyer (with its payment channel) are looked up once, and then
+            # kept across reconnects
+            config, market_maker_adr = await self._state.get_config(self)
             print('Using market maker adr:', config['marketmaker'])
 
-            market_maker_adr = binascii.a2b_hex(config['marketmaker'][2:])
-            max_price = 100 * 10 ** 18
-            buyer = SimpleBuyer(market_maker_adr, delegate_key, max_price)
-            balance = await buyer.start(self, details.authid)
-            balance = int(balance / 10 ** 18)
-            print("Remaining balance in active payment channel: {} XBR".format(balance))
-
-            async def on_event(key_id, enc_ser, ciphertext, details=None):
-                print('Received event {}, encrypted with key_id={}'.format(details.publication, UUID(bytes=key_id)))
-                try:
-                    payload = await buyer.unwrap(key_id, enc_ser, ciphertext)
-                except:
-                    self.log.failure()
-                    self.leave()
+            def make_buyer():
+                # imported only now, as autobahn.twisted.xbr imports web3 and eth_keys (which takes seconds)
+                from autobahn.twisted.xbr import SimpleBuyer
+
+                max_price = 100 * 10 ** 18
+                buyer = SimpleBuyer(market_maker_adr, delegate_key, max_price)
+
+                # keep bought keys in a cache bounded in size and key lifetime, backed by the (on-disk) key store
+                # from which keys are looked up (lazily) when not in the cache
+                buyer._keys = KeyCache(max_bytes=self.config.extra.get('key_cache_bytes', 2**20),
+                                       ttl=self.config.extra.get('key_ttl', None),
+                                       store=self.config.extra.get('keystore', None),
+                                       metrics=self._metrics.registry if self._metrics else None)
+                return buyer
+
+            buyer, balance, validated = await self._state.resume_buyer(self, market_maker_adr, details.authid,
+                                                                       make_buyer)
+
+            def print_balance(balance):
+                balance = int(balance / 10 ** 18)
+                print("Remaining balance in active payment channel: {} XBR".format(balance))
+                if self._metrics:
+                    self._metrics.balance(balance)
+
+            if balance is not None:
+                print_balance(balance)
+            if self._metrics:
+                # keys bought and loaded are counted by the key cache (across buyers), keys cached are of this buyer
+                self._metrics.registry.gauge('xbr_buyer_keys_cached', 'Data encryption keys in the key cache.',
+                                             lambda: len(buyer._keys))
+
+            topic = self.config.extra.get('topic', 'io.crossbar.example')
+            match = self.config.extra.get('match', 'exact')
+
+            # events received are logged (sampled) off the reactor, rather than printed one by one
+            eventlog = self.config.extra.get('eventlog', None)
+
+            def on_payload(payload, key_id, details):
+                if eventlog:
+                    eventlog.event('received', publication=details.publication, topic=details.topic or topic,
+                                 key_id=key_id, payload=payload)
+
+            # all events (of all topics matching) are received on one subscription, and dispatched per topic
+            self._router = TopicRouter()
+            self._router.add(topic, on_payload, match=match)
+
+            def on_decrypted(payload, key_id, details):
+                self._router.dispatch(details.topic or topic, payload, key_id, details)
+
+            # events are queued, decrypted by a pool of workers and delivered in order to the router
+            self._receiver = QueueReceiver(buyer, on_decrypted,
+                                           workers=self.config.extra.get('workers', 4),
+                                           queue_size=self.config.extra.get('queue_size', 1000),
+                                           executor=self.config.extra.get('executor', None),
+                                           metrics=self._metrics.registry if self._metrics else None,
+                                           tracer=self.config.extra.get('tracer', None), topic=topic)
+            ensureDeferred(self._receiver.run())
+
+            on_event = self._receiver.on_event
+            catch_up = None
+            procedure = self.config.extra.get('history_procedure', None)
+            if procedure:
+                # the publication received last per topic outlives the session, so after reconnecting, the events
+                # published meanwhile are fetched from the seller's history
+                last_received = self.config.extra.setdefault('last_received', {})
+                catch_up = HistoryCatchUp(self, procedure, self._receiver.on_event, last_received, topic=topic)
+                catch_up.hold()
+                on_event = catch_up.on_event
+
+            # subscriptions are made concurrently, rather than one round trip after the other
+            subscribing = [self.subscribe(on_event, topic, options=SubscribeOptions(match=match, details=True))]
+            if self.config.extra.get('prefetch', False):
+                # keys are prefetched for the topic, or for all topics under the (literal) prefix of the pattern
+                if match == 'exact':
+                    prefetcher = KeyPrefetcher(self, buyer, topics=[topic])
                 else:
-                    print('Unencrypted event payload: {}'.format(pformat(payload)))
-
-            await self.subscribe(on_event, "io.crossbar.example", options=SubscribeOptions(details=True))
+                    prefetcher = KeyPrefetcher(self, buyer, prefixes=[topic.split('..')[0].rstrip('.')])
+                subscribing.append(ensureDeferred(prefetcher.start()))
+            if self._metrics and self.config.extra.get('metrics_procedure', None):
+                subscribing.append(self.register(self._metrics.registry.snapshot,
+                                                 self.config.extra['metrics_procedure']))
+            if validated:
+                # the payment channel of a buyer resumed is validated concurrently with subscribing
+                validated.addCallback(print_balance)
+                subscribing.append(validated)
+            subscription, *_ = await gatherResults(subscribing, consumeErrors=True)
+
+            if catch_up:
+                try:
+                    await catch_up.catch_up(subscription)
+                except Exception as e:
+                    self.log.warn('Failed to catch up on events missed: {error}', error=e)
         except Exception as e:
             self.log.failure()
             self.config.extra['error'] = e
-        finally:
+            # look up all state again on the next join
+            self._state.invalidate()
             self.leave()
+        else:
+            if self._metrics:
+                self._metrics.joined()
+            self.log.info('Buyer session ready! Waiting to receive events ..')
 
     def onLeave(self, details):
         self.log.info('{klass}.onLeave(details={details})', klass=self.__class__.__name__, details=details)
 
         self._running = False
+        if self._receiver:
+            self.log.info('Event receiver stopped: {stats}', stats=self._receiver.stats())
+            self._receiver.stop()
+        if self._router:
+            self.log.info('Events received per topic: {stats}', stats=self._router.stats())
+        if self.config.extra.get('tracer', None):
+            self.log.info('Event latency per topic and stage: {stats}', stats=self.config.extra['tracer'].stats())
+        if self._metrics:
+            self._metrics.left()
 
         if details.reason == 'wamp.close.normal':
             self.log.info('Shutting down ..')
+            self._stopping = True
             # user initiated leave => end the program
             self.config.runner.stop()
             self.disconnect()
@@ -94,10 +203,12 @@ class XbrDelegate(ApplicationSession):
     def onDisconnect(self):
         self.log.info('{klass}.onDisconnect()', klass=self.__class__.__name__)
 
-        try:
-            reactor.stop()
-        except ReactorNotRunning:
-            pass
+        # only stop when leaving (normally): when the connection was lost, ApplicationRunner reconnects
+        if self._stopping:
+            try:
+                reactor.stop()
+            except ReactorNotRunning:
+                pass
 
 
 if __name__ == '__main__':
@@ -109,6 +220,93 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Enable debug output.')
 
+    parser.add_argument('--topic',
+                        dest='topic',
+                        type=str,
+                        default='io.crossbar.example',
+                        help='Topic, topic prefix or wildcard pattern to subscribe to (default: io.crossbar.example).')
+
+    parser.add_argument('--match',
+                        dest='match',
+                        type=str,
+                        choices=['exact', 'prefix', 'wildcard'],
+                        default='exact',
+                        help='Topic matching policy of the subscription (default: exact).')
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=4,
+                        help='Number of events decrypted concurrently (default: 4).')
+
+    parser.add_argument('--queue_size',
+                        dest='queue_size',
+                        type=int,
+                        default=1000,
+                        help='Maximum number of events queued for decryption, dropping events beyond (default: 1000).')
+
+    parser.add_argument('--unwrap_workers',
+                        dest='unwrap_workers',
+                        type=int,
+                        default=0,
+                        help='Number of workers to decrypt and deserialize events in (default: 0, on the reactor).')
+
+    parser.add_argument('--unwrap_processes',
+                        action='store_true',
+                        help='Use worker processes (rather than threads) to decrypt and deserialize events.')
+
+    parser.add_argument('--prefetch',
+                        action='store_true',
+                        help='Buy data encryption keys when offered, rather than on the first event using the key.')
+
+    parser.add_argument('--key_cache_bytes',
+                        dest='key_cache_bytes',
+                        type=int,
+                        default=2**20,
+                        help='Memory budget in bytes for data encryption keys kept (default: 1MB).')
+
+    parser.add_argument('--key_ttl',
+                        dest='key_ttl',
+                        type=float,
+                        default=None,
+                        help='Time in seconds after which data encryption keys are dropped (default: never).')
+
+    parser.add_argument('--keystore',
+                        dest='keystore',
+                        type=str,
+                        default=KeyStore.DEFAULT_PATH,
+                        help='Path of the (on-disk) store for keys bought, or "" to disable (default: "{}").'.format(
+                            KeyStore.DEFAULT_PATH))
+
+    parser.add_argument('--keystore_ttl',
+                        dest='keystore_ttl',
+                        type=float,
+                        default=86400,
+                        help='Time in seconds keys are kept in the key store (default: 86400).')
+
+    parser.add_argument('--history_procedure',
+                        dest='history_procedure',
+                        type=str,
+                        default='io.crossbar.example.history',
+                        help='Procedure of the seller to catch up on events missed when reconnecting, or "" to '
+                             'disable (default: io.crossbar.example.history).')
+
+    parser.add_argument('--trace',
+                        action='store_true',
+                        help='Measure the latency per stage (and detect lost or reordered events) of events '
+                             'published with trace metadata (seller option --trace).')
+
+    parser.add_argument('--compression_dict',
+                        dest='compression_dict',
+                        action='append',
+                        default=[],
+                        help='Dictionary file event payloads are compressed with by the seller (can be repeated).')
+
+    add_reconnect_arguments(parser)
+    add_keyindex_arguments(parser)
+    add_metrics_arguments(parser)
+    add_eventlog_arguments(parser)
+
     args = parser.parse_args()
 
     if args.debug:
@@ -116,21 +314,69 @@ if __name__ == '__main__':
     else:
         txaio.start_logging(level='info')
 
-    profile = load_or_create_profile()
+    profile = load_profile()
 
-    privkey = eth_keys.keys.PrivateKey(profile.ethkey)
-    adr_raw = privkey.public_key.to_canonical_address()
-    eth_adr = web3.Web3.toChecksumAddress(adr_raw)
-    eth_adr_qr = pyqrcode.create(eth_adr, error='L', mode='binary').terminal()
-    print('Delegate Ethereum address is {}:\n{}'.format(eth_adr, eth_adr_qr))
+    _, eth_adr = get_address(profile.ethkey, args.keyindex or None)
+    print_address(eth_adr, qrcode=not args.no_qrcode)
 
     extra = {
         'ethkey': profile.ethkey,
         'cskey': profile.cskey,
+        'keyindex': args.keyindex or None,
+        'topic': args.topic,
+        'match': args.match,
+        'workers': args.workers,
+        'queue_size': args.queue_size,
+        'prefetch': args.prefetch,
+        'key_cache_bytes': args.key_cache_bytes,
+        'key_ttl': args.key_ttl,
+        'history_procedure': args.history_procedure,
+        'state_ttl': args.state_ttl,
     }
 
+    # the key store outlives sessions, like the buyer (and its key cache backed by the store)
+    keystore = None
+    if args.keystore:
+        keystore = KeyStore(args.keystore, profile.ethkey, ttl=args.keystore_ttl)
+        keystore.open()
+        extra['keystore'] = keystore
+
+    # payloads compressed with a dictionary are decompressed with the same dictionary (looked up by its ID)
+    for path in args.compression_dict:
+        compressors.load_dictionary(path)
+
+    executor = None
+    if args.unwrap_workers:
+        if args.unwrap_processes:
+            # worker processes need the compression dictionaries loaded
+            executor = ProcessPoolExecutor(args.unwrap_workers, mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=compressors.register_dictionaries,
+                                           initargs=(compressors.get_dictionaries(),))
+        else:
+            executor = ThreadPoolExecutor(args.unwrap_workers)
+        extra['executor'] = executor
+
+    # metrics outlive sessions, like the buyer
+    if args.metrics_port or args.metrics_procedure:
+        metrics = MetricsRegistry()
+        extra['metrics'] = metrics
+        extra['metrics_procedure'] = args.metrics_procedure
+        if args.metrics_port:
+            reactor.listenTCP(args.metrics_port, Site(MetricsResource(metrics)), interface=args.metrics_interface)
+
+    # the tracer outlives sessions, so events lost while reconnecting are detected
+    if args.trace:
+        extra['tracer'] = EventTracer(extra.get('metrics', None))
+
+    # the event log outlives sessions, and writes the events logged when the reactor shuts down
+    eventlog = open_eventlog(args, reactor)
+    if eventlog:
+        extra['eventlog'] = eventlog
+        if 'metrics' in extra:
+            add_eventlog_metrics(extra['metrics'], eventlog)
+
     runner = ApplicationRunner(url=profile.market_url, realm=profile.market_realm, extra=extra,
-                               serializers=[CBORSerializer()])
+                               serializers=[CBORSerializer()], **reconnect_options(args))
 
     try:
         runner.run(XbrDelegate, auto_reconnect=True)
@@ -139,3 +385,8 @@ if __name__ == '__main__':
         sys.exit(1)
     else:
         sys.exit(0)
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
+        if keystore:
+            keystore.close()
@@ -0,0 +1,159 @@
+# coding=utf8
+
+# catalogue of APIs (and topics) sold by one XBR seller delegate, and the timer wheel rotating the data
+# encryption keys of all APIs (rather than one timer per API, see catalogueseller.py)
+
+import json
+import uuid
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.internet.task import LoopingCall
+
+
+def load_catalogue(path):
+    """
+    Load a catalogue of APIs from a JSON file with a list of APIs like::
+
+        [
+            {
+                "api_id": "627f1b5c-58c2-43b1-8422-a34f7d3f5a04",
+                "prefix": "io.crossbar.example",
+                "price": 5,
+                "interval": 10,
+                "topics": ["io.crossbar.example.a", "io.crossbar.example.b"]
+            }
+        ]
+
+    where ``price`` is in XBR per key, ``interval`` is the key rotation interval in seconds, and ``topics``
+    (optional, defaults to the prefix) are the topics published under the API prefix.
+
+    :param path: Path of the catalogue file.
+    :return: List of APIs ``(api_id, prefix, price, interval, topics)``, with the price in token units.
+    """
+    with open(path) as f:
+        catalogue = json.load(f)
+    apis = []
+    for api in catalogue:
+        apis.append((uuid.UUID(api['api_id']).bytes,
+                     api['prefix'],
+                     int(api['price'] * 10 ** 18),
+                     api['interval'],
+                     api.get('topics', [api['prefix']])))
+    return apis
+
+
+def load_compression(path):
+    """
+    Load the payload compression settings of the topics in a catalogue of APIs (see :func:`load_catalogue`).
+    The payloads of all topics of an API are compressed when the API has compression settings like::
+
+        "compression": "zstd:9:mobility.dict"
+
+    (see :func:`compressors.parse_compression`).
+
+    :param path: Path of the catalogue file.
+    :return: Compression settings strings by topic.
+    """
+    with open(path) as f:
+        catalogue = json.load(f)
+    compression = {}
+    for api in catalogue:
+        if api.get('compression', None):
+            for topic in api.get('topics', [api['prefix']]):
+                compression[topic] = api['compression']
+    return compression
+
+
+class _WheelTimer(object):
+    __slots__ = ('ticks', 'callback', 'rounds', 'active')
+
+    def __init__(self, ticks, callback):
+        self.ticks = ticks
+        self.callback = callback
+        self.rounds = 0
+        self.active = True
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel for (many) periodic timers, driven by a single reactor timer ticking at the
+    wheel resolution. Adding, firing and cancelling a timer is O(1), independent of the number of timers.
+    """
+    log = make_logger()
+
+    def __init__(self, reactor=None, resolution=1., slots=512):
+        """
+
+        :param reactor: Twisted reactor to run under.
+        :param resolution: Wheel tick (in seconds). Timer intervals are rounded to whole ticks.
+        :param slots: Number of wheel slots (intervals longer than ``slots`` ticks take multiple rounds).
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._resolution = resolution
+        self._slots = [[] for _ in range(slots)]
+        self._tick = 0
+        self._loop = LoopingCall(self._advance)
+        self._loop.clock = reactor
+
+    def schedule(self, interval, callback):
+        """
+        Add a periodic timer.
+
+        :param interval: Timer interval in seconds.
+        :param callback: Function called (without arguments) every interval.
+        :return: Handle of the timer (for :meth:`cancel`).
+        """
+        timer = _WheelTimer(max(1, int(round(interval / self._resolution))), callback)
+        self._insert(timer)
+        if not self._loop.running:
+            self._loop.start(self._resolution, now=False)
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancel a periodic timer.
+
+        :param timer: Handle of the timer (as returned from :meth:`schedule`).
+        """
+        # removed from its slot when next visited
+        timer.active = False
+
+    def stop(self):
+        """
+        Stop the wheel (no timer fires anymore).
+        """
+        if self._loop.running:
+            self._loop.stop()
+
+    def _insert(self, timer):
+        slots = len(self._slots)
+        timer.rounds = (timer.ticks - 1) // slots
+        self._slots[(self._tick + timer.ticks) % slots].append(timer)
+
+    def _advance(self):
+        self._tick += 1
+        slot = self._slots[self._tick % len(self._slots)]
+        if not slot:
+            return
+        due = []
+        keep = []
+        for timer in slot:
+            if not timer.active:
+                continue
+            if timer.rounds:
+                timer.rounds -= 1
+                keep.append(timer)
+            else:
+                due.append(timer)
+        slot[:] = keep
+        for timer in due:
+            self._insert(timer)
+            try:
+                timer.callback()
+            except Exception:
+                self.log.failure()
@@ -0,0 +1,109 @@
+# coding=utf8
+
+# XBR seller delegate selling a catalogue of APIs (and topics), with data encryption keys of all APIs rotated
+# from a single timer wheel (rather than one timer per API). Kept apart from catalogue.py, as importing
+# autobahn.twisted.xbr imports web3 and eth_keys (which takes seconds): this module is imported when joining
+
+import uuid
+import inspect
+from functools import partial
+
+import txaio
+txaio.use_twisted()
+
+from twisted.internet.defer import Deferred, ensureDeferred
+
+from autobahn.twisted.xbr import KeySeries, SimpleSeller
+
+from catalogue import TimerWheel
+
+
+class WheelKeySeries(KeySeries):
+    """
+    Key series rotating keys from a (shared) timer wheel, rather than from its own looping call.
+    """
+
+    def __init__(self, api_id, price, interval=None, count=None, on_rotate=None, wheel=None):
+        KeySeries.__init__(self, api_id, price, interval=interval, count=count, on_rotate=on_rotate)
+        self._wheel = wheel
+        self._timer = None
+        self._rotating = False
+        self._stopped = None
+
+    def start(self):
+        assert not self.running
+        self.log.info('Starting key rotation every {interval} seconds for api_id="{api_id}" ..',
+                      interval=self._interval, api_id=uuid.UUID(bytes=self._api_id))
+        self.running = True
+        # like a looping call, rotate right away, and return a deferred fired when stopped
+        self._stopped = Deferred()
+        self._rotate_now()
+        self._timer = self._wheel.schedule(self._interval, self._rotate_now)
+        return self._stopped
+
+    def stop(self):
+        if not self.running:
+            raise RuntimeError('cannot stop {} - not currently running'.format(self.__class__.__name__))
+        self.running = False
+        self._wheel.cancel(self._timer)
+        self._timer = None
+        stopped, self._stopped = self._stopped, None
+        stopped.callback(self)
+        return stopped
+
+    def _rotate_now(self):
+        # skip a rotation when the previous one is still in progress
+        if self._rotating:
+            return
+        self._rotating = True
+        try:
+            result = self._rotate()
+        except Exception:
+            self._rotating = False
+            self.log.failure()
+            return
+        if inspect.isawaitable(result):
+            d = ensureDeferred(result)
+        else:
+            d = Deferred()
+            d.callback(result)
+
+        def done(result):
+            self._rotating = False
+            return result
+
+        d.addBoth(done)
+        d.addErrback(lambda fail: self.log.failure('Key rotation failed', failure=fail))
+
+
+class CatalogueSeller(SimpleSeller):
+    """
+    Seller for many APIs in one session, with key rotation of all APIs driven by one timer wheel.
+    """
+
+    def __init__(self, market_maker_adr, seller_key, provider_id=None, wheel=None):
+        SimpleSeller.__init__(self, market_maker_adr, seller_key, provider_id)
+        # a wheel created by the seller is stopped with the seller
+        self._own_wheel = wheel is None
+        self._wheel = wheel or TimerWheel()
+        # key series created by add() are bound to the wheel
+        self.KeySeries = partial(WheelKeySeries, wheel=self._wheel)
+
+    def add_catalogue(self, apis):
+        """
+        Add all APIs of a catalogue (see :func:`load_catalogue`).
+
+        :param apis: List of APIs ``(api_id, prefix, price, interval, topics)``.
+        """
+        for api_id, prefix, price, interval, _ in apis:
+            self.add(api_id, prefix, price, interval, None)
+
+    async def stop(self):
+        """
+        Stop the seller (the key series of all APIs), and the timer wheel (when created by the seller).
+        """
+        try:
+            await SimpleSeller.stop(self)
+        finally:
+            if self._own_wheel:
+                self._wheel.stop()
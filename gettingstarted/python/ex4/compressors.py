@@ -0,0 +1,226 @@
+# coding=utf8
+
+# compression of XBR event payloads: encrypted data does not compress, so payloads are serialized and
+# compressed before they are encrypted, optionally with a pre-trained dictionary (shared by sellers and
+# buyers) for small and repetitive payloads
+
+import hashlib
+import zlib
+from collections import namedtuple
+
+import cbor2
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+
+# first element of a compressed payload: ``[COMPRESSED, compressor_name, dictionary_id, data]``
+COMPRESSED = 'xbr.compressed'
+
+
+# compression settings (e.g. for a topic): compressor name, compression level (or ``None`` for the
+# compressor's default) and ID of the dictionary to compress with (or ``None``)
+Compression = namedtuple('Compression', ['name', 'level', 'dictionary'])
+
+
+class Compressor(object):
+    """
+    Payload compressor (base class), compressing bytes with an optional dictionary.
+    """
+    name = None
+
+    def compress(self, data, level=None, dictionary=None):
+        raise NotImplementedError()
+
+    def decompress(self, data, dictionary=None):
+        raise NotImplementedError()
+
+
+class ZlibCompressor(Compressor):
+    """
+    zlib (deflate) compression, with preset dictionaries.
+    """
+    name = 'zlib'
+
+    def compress(self, data, level=None, dictionary=None):
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        if dictionary is None:
+            return zlib.compress(data, level)
+        c = zlib.compressobj(level, zdict=dictionary)
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data, dictionary=None):
+        if dictionary is None:
+            return zlib.decompress(data)
+        d = zlib.decompressobj(zdict=dictionary)
+        return d.decompress(data) + d.flush()
+
+
+class ZstdCompressor(Compressor):
+    """
+    Zstandard compression (requires ``zstandard``), with dictionaries as trained by ``zstd --train``.
+    """
+    name = 'zstd'
+
+    def __init__(self):
+        # dictionary data -> (digested) zstd dictionary
+        self._dictionaries = {}
+
+    def _dictionary(self, dictionary):
+        if dictionary is None:
+            return None
+        if dictionary not in self._dictionaries:
+            self._dictionaries[dictionary] = zstandard.ZstdCompressionDict(dictionary)
+        return self._dictionaries[dictionary]
+
+    def compress(self, data, level=None, dictionary=None):
+        c = zstandard.ZstdCompressor(level=3 if level is None else level, dict_data=self._dictionary(dictionary))
+        return c.compress(data)
+
+    def decompress(self, data, dictionary=None):
+        return zstandard.ZstdDecompressor(dict_data=self._dictionary(dictionary)).decompress(data)
+
+
+class Lz4Compressor(Compressor):
+    """
+    LZ4 block compression (requires ``lz4``): fastest, at a lower compression ratio. A level (1-16)
+    selects high compression mode.
+    """
+    name = 'lz4'
+
+    def compress(self, data, level=None, dictionary=None):
+        if level is None:
+            return lz4.block.compress(data, dict=dictionary)
+        return lz4.block.compress(data, mode='high_compression', compression=level, dict=dictionary)
+
+    def decompress(self, data, dictionary=None):
+        return lz4.block.decompress(data, dict=dictionary)
+
+
+_COMPRESSORS = {}
+
+
+def register_compressor(compressor):
+    """
+    Register a payload compressor.
+
+    :param compressor: The compressor (a :class:`Compressor`) to register under its name.
+    """
+    _COMPRESSORS[compressor.name] = compressor
+
+
+def get_compressor(name):
+    """
+    Get a registered payload compressor.
+
+    :param name: Name of the compressor.
+    :return: The compressor.
+    :raises KeyError: No compressor of this name is registered (e.g. the compressor's library is not installed).
+    """
+    return _COMPRESSORS[name]
+
+
+register_compressor(ZlibCompressor())
+if zstandard:
+    register_compressor(ZstdCompressor())
+if lz4:
+    register_compressor(Lz4Compressor())
+
+
+# dictionary ID -> dictionary data
+_DICTIONARIES = {}
+
+
+def register_dictionary(data):
+    """
+    Register a compression dictionary.
+
+    :param data: The dictionary data.
+    :return: The dictionary ID (derived from the dictionary data, so sellers and buyers agree on it).
+    """
+    dictionary_id = hashlib.blake2b(data, digest_size=8).hexdigest()
+    _DICTIONARIES[dictionary_id] = data
+    return dictionary_id
+
+
+def register_dictionaries(dictionaries):
+    """
+    Register compression dictionaries, e.g. as initializer of worker processes.
+
+    :param dictionaries: Dictionary data by dictionary ID, as returned from :func:`get_dictionaries`.
+    """
+    _DICTIONARIES.update(dictionaries)
+
+
+def get_dictionaries():
+    """
+    :return: All compression dictionaries registered (data by dictionary ID).
+    """
+    return dict(_DICTIONARIES)
+
+
+def load_dictionary(path):
+    """
+    Load and register a compression dictionary from a file.
+
+    :param path: Path of the dictionary file.
+    :return: The dictionary ID.
+    """
+    with open(path, 'rb') as f:
+        return register_dictionary(f.read())
+
+
+def parse_compression(spec):
+    """
+    Parse compression settings from a string ``name[:level[:dictionary_path]]``, e.g. ``zstd:9:mobility.dict``,
+    loading the dictionary (when given).
+
+    :param spec: The compression settings string.
+    :return: The compression settings.
+    :raises KeyError: The compressor is not available.
+    """
+    parts = spec.split(':', 2)
+    name = parts[0]
+    get_compressor(name)
+    level = int(parts[1]) if len(parts) > 1 and parts[1] else None
+    dictionary = load_dictionary(parts[2]) if len(parts) > 2 and parts[2] else None
+    return Compression(name, level, dictionary)
+
+
+def compress(compression, payload):
+    """
+    Serialize and compress a payload.
+
+    :param compression: The compression settings.
+    :param payload: The payload.
+    :return: The compressed payload (to encrypt and publish), or the payload as is when it does not compress.
+    """
+    data = cbor2.dumps(payload)
+    dictionary = _DICTIONARIES[compression.dictionary] if compression.dictionary else None
+    compressed = get_compressor(compression.name).compress(data, compression.level, dictionary)
+    if len(compressed) >= len(data):
+        return payload
+    return [COMPRESSED, compression.name, compression.dictionary, compressed]
+
+
+def decompress(payload):
+    """
+    Decompress and deserialize a (decrypted) payload. Payloads not compressed are returned as is.
+
+    :param payload: The payload.
+    :return: The decompressed payload.
+    :raises KeyError: The compressor or the dictionary the payload was compressed with is not available.
+    """
+    if type(payload) == list and len(payload) == 4 and payload[0] == COMPRESSED:
+        _, name, dictionary_id, data = payload
+        dictionary = _DICTIONARIES[dictionary_id] if dictionary_id else None
+        return cbor2.loads(get_compressor(name).decompress(data, dictionary))
+    return payload
@@ -0,0 +1,464 @@
+# coding=utf8
+
+# run a fleet of XBR seller and buyer delegates from a manifest: delegates are spread over worker processes
+# (one reactor per core), each hosting many delegate sessions, supervised (delegates and workers are restarted
+# when they stop or crash), with the health of the whole fleet served over HTTP
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import binascii
+import multiprocessing
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from autobahn.twisted.wamp import ApplicationRunner
+from autobahn.wamp.serializer import CBORSerializer
+
+
+class FleetMember(object):
+    """
+    Mixin for delegates run in a fleet: tracks the health of the delegate in its config extra, and rather
+    than stopping the reactor (shared with the other delegates of the worker) when the delegate stops,
+    reports the delegate stopped to the worker, which restarts it.
+    """
+
+    async def onJoin(self, details):
+        health = self.config.extra['health']
+        health['state'] = 'joined'
+        health['joins'] += 1
+        health['joined'] = time.time()
+        await super(FleetMember, self).onJoin(details)
+
+    def onLeave(self, details):
+        health = self.config.extra['health']
+        health['state'] = 'left'
+        error = self.config.extra.pop('error', None)
+        if error is not None:
+            health['errors'] += 1
+            health['last_error'] = str(error)
+        super(FleetMember, self).onLeave(details)
+
+    def onDisconnect(self):
+        self.log.info('{klass}.onDisconnect()', klass=self.__class__.__name__)
+        self.config.extra['health']['state'] = 'disconnected'
+        if self._stopping:
+            # the delegate left (normally, or after failing to join): the runner does not reconnect
+            self.config.extra['on_stopped']()
+
+
+def make_delegate(role):
+    """
+    :param role: ``'seller'`` or ``'buyer'``.
+    :return: The delegate (session) class to run delegates of the role in a fleet.
+    """
+    if role == 'seller':
+        import seller
+        return type('FleetSeller', (FleetMember, seller.XbrDelegate), {})
+    elif role == 'buyer':
+        import buyer
+        return type('FleetBuyer', (FleetMember, buyer.XbrDelegate), {})
+    raise ValueError('invalid delegate role "{}"'.format(role))
+
+
+def make_extra(role, ethkey, cskey, options):
+    """
+    Make the config extra of a delegate, like the delegate's command line does.
+
+    :param role: ``'seller'`` or ``'buyer'``.
+    :param ethkey: Private Ethereum key (raw bytes) of the delegate.
+    :param cskey: Private WAMP-cryptosign key (raw bytes) of the delegate.
+    :param options: Delegate options (plain values, named like the delegate's config extra).
+    :return: The config extra.
+    """
+    import compressors
+
+    extra = dict(options)
+    extra['ethkey'] = ethkey
+    extra['cskey'] = cskey
+
+    for path in options.get('compression_dict', []):
+        compressors.load_dictionary(path)
+
+    # metrics are served per delegate, from a procedure of its own
+    if options.get('metrics_procedure', None):
+        from metrics import MetricsRegistry
+        extra['metrics'] = MetricsRegistry()
+
+    if role == 'seller':
+        from catalogue import load_compression
+        from history import EventHistory
+        if options.get('compression', None):
+            extra['compression'] = compressors.parse_compression(options['compression'])
+        # compression settings for the topics of catalogue APIs, and for single topics
+        topic_compression = load_compression(options['catalogue']) if options.get('catalogue', None) else {}
+        topic_compression.update(options.get('topic_compression', {}))
+        extra['topic_compression'] = {topic: compressors.parse_compression(spec) if spec else None
+                                      for topic, spec in topic_compression.items()}
+        # the history procedure is registered per delegate, so it is only enabled with a procedure of its own
+        if options.get('history_procedure', None):
+            extra['history'] = EventHistory(max_events=options.get('history_events', 1000),
+                                            max_bytes=options.get('history_bytes', 2**20))
+    else:
+        from keystore import KeyStore
+        from tracing import EventTracer
+        if options.get('trace', False):
+            extra['tracer'] = EventTracer(extra.get('metrics', None))
+        # the key store is per delegate (keys are sealed with a secret of the delegate), so it is only enabled
+        # with a path of its own
+        if options.get('keystore', None):
+            keystore = KeyStore(options['keystore'], ethkey, ttl=options.get('keystore_ttl', 86400))
+            keystore.open()
+            extra['keystore'] = keystore
+    return extra
+
+
+def load_manifest(path):
+    """
+    Load a fleet manifest from a JSON file like::
+
+        {
+            "url": "ws://localhost:8070/ws",
+            "realm": "idma",
+            "delegates": [
+                {
+                    "name": "seller1",
+                    "role": "seller",
+                    "ethkey": "0xd99b5b29e6da2528bf458b26237a6cf8655a3e3276c1cdc0de1f98cefee81c01",
+                    "cskey": "0x2c7031758603fb7fefba12df274d7c0c3d180b40c5aa1e95b859a3f2d2458cab",
+                    "options": {"rate": 10}
+                }
+            ]
+        }
+
+    where ``options`` (optional) are the delegate options, named like the delegate's config extra.
+
+    :param path: Path of the manifest file.
+    :return: Tuple ``(url, realm, delegates)`` with the list of delegates ``(name, role, ethkey, cskey, options)``.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    delegates = []
+    for i, delegate in enumerate(manifest['delegates']):
+        if delegate['role'] not in ('seller', 'buyer'):
+            raise ValueError('invalid role "{}" of delegate {}'.format(delegate['role'], i))
+        delegates.append((delegate.get('name', '{}{}'.format(delegate['role'], i)),
+                          delegate['role'],
+                          binascii.a2b_hex(delegate['ethkey'][2:] if delegate['ethkey'].startswith('0x')
+                                           else delegate['ethkey']),
+                          binascii.a2b_hex(delegate['cskey'][2:] if delegate['cskey'].startswith('0x')
+                                           else delegate['cskey']),
+                          delegate.get('options', {})))
+    return manifest['url'], manifest['realm'], delegates
+
+
+class FleetWorker(object):
+    """
+    Runs (many) delegates in one worker process, on one reactor, restarting delegates that stop, and
+    reporting the health of its delegates to the supervisor.
+    """
+    log = make_logger()
+
+    def __init__(self, reactor, index, url, realm, delegates, reports, report_interval=2., restart_delay=1.,
+                 max_restart_delay=60., retry=None):
+        """
+
+        :param reactor: Twisted reactor to run under.
+        :param index: Index of the worker.
+        :param url: WAMP router URL.
+        :param realm: Realm to join.
+        :param delegates: List of delegates ``(name, role, ethkey, cskey, options)`` to run.
+        :param reports: Queue to put health reports on.
+        :param report_interval: Time (in seconds) between health reports.
+        :param restart_delay: Initial delay (in seconds) before restarting a delegate that stopped.
+        :param max_restart_delay: Maximum delay (in seconds) before restarting a delegate that stopped repeatedly.
+        :param retry: Keyword arguments for ``ApplicationRunner`` (reconnecting).
+        """
+        self._reactor = reactor
+        self._index = index
+        self._url = url
+        self._realm = realm
+        self._reports = reports
+        self._report_interval = report_interval
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._retry = retry or {}
+        # name -> (delegate class, extra)
+        self._delegates = {}
+        for name, role, ethkey, cskey, options in delegates:
+            extra = make_extra(role, ethkey, cskey, options)
+            extra['health'] = {'role': role, 'state': 'starting', 'joins': 0, 'joined': None, 'restarts': 0,
+                               'errors': 0, 'last_error': None}
+            extra['on_stopped'] = lambda name=name: self._on_stopped(name)
+            self._delegates[name] = (make_delegate(role), extra)
+        self._reporting = LoopingCall(self._report)
+        self._reporting.clock = reactor
+
+    def start(self):
+        """
+        Start all delegates, and reporting health.
+        """
+        for name in self._delegates:
+            self._start(name)
+        self._reporting.start(self._report_interval)
+
+    def _start(self, name):
+        klass, extra = self._delegates[name]
+        extra['health']['state'] = 'connecting'
+        runner = ApplicationRunner(url=self._url, realm=self._realm, extra=extra, serializers=[CBORSerializer()],
+                                   **self._retry)
+        runner.run(klass, start_reactor=False, auto_reconnect=True)
+
+    def _on_stopped(self, name):
+        health = self._delegates[name][1]['health']
+        health['state'] = 'restarting'
+        health['restarts'] += 1
+        delay = min(self._restart_delay * 2 ** min(health['restarts'] - 1, 16), self._max_restart_delay)
+        # delegates that ran for a while are restarted right away (and back off only when failing repeatedly)
+        if health['joined'] and time.time() - health['joined'] > self._max_restart_delay:
+            delay = self._restart_delay
+        self.log.warn('Delegate {name} stopped: restarting in {delay:.1f}s', name=name, delay=delay)
+        self._reactor.callLater(delay, self._start, name)
+
+    def _report(self):
+        report = {
+            'worker': self._index,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'delegates': {name: dict(extra['health']) for name, (_, extra) in self._delegates.items()},
+        }
+        try:
+            self._reports.put_nowait(report)
+        except queue.Full:
+            pass
+
+
+def run_worker(index, url, realm, delegates, reports, report_interval, retry, debug):
+    """
+    Entry point of worker processes.
+    """
+    # the delegates modules are imported (by module name) from this directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    txaio.start_logging(level='debug' if debug else 'info')
+
+    from twisted.internet import reactor
+
+    worker = FleetWorker(reactor, index, url, realm, delegates, reports, report_interval=report_interval,
+                         retry=retry)
+    reactor.callWhenRunning(worker.start)
+    reactor.run()
+
+
+class FleetSupervisor(object):
+    """
+    Runs worker processes (hosting the delegates), restarting workers that exit, and aggregates the
+    health reports of all workers.
+    """
+    log = make_logger()
+
+    def __init__(self, reactor, url, realm, delegates, workers=None, report_interval=2., restart_delay=1.,
+                 max_restart_delay=60., retry=None, debug=False):
+        """
+
+        :param reactor: Twisted reactor to run under.
+        :param url: WAMP router URL.
+        :param realm: Realm to join.
+        :param delegates: List of delegates ``(name, role, ethkey, cskey, options)`` to run.
+        :param workers: Number of worker processes (default: number of cores), delegates are spread over.
+        :param report_interval: Time (in seconds) between health reports of workers.
+        :param restart_delay: Initial delay (in seconds) before restarting a worker that exited.
+        :param max_restart_delay: Maximum delay (in seconds) before restarting a worker that exited repeatedly.
+        :param retry: Keyword arguments for ``ApplicationRunner`` (reconnecting).
+        :param debug: Enable debug output in workers.
+        """
+        self._reactor = reactor
+        self._url = url
+        self._realm = realm
+        self._report_interval = report_interval
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._retry = retry or {}
+        self._debug = debug
+        self._context = multiprocessing.get_context('spawn')
+        self._reports = self._context.Queue()
+
+        workers = min(workers or os.cpu_count() or 1, len(delegates)) or 1
+        # delegates spread round-robin over the workers
+        self._assigned = [delegates[i::workers] for i in range(workers)]
+        # index -> process, restarts, last report
+        self._workers = {}
+        self._running = False
+        self._polling = LoopingCall(self._poll)
+        self._polling.clock = reactor
+
+    def start(self):
+        """
+        Start all worker processes.
+        """
+        self._running = True
+        for index in range(len(self._assigned)):
+            self._workers[index] = [None, 0, None]
+            self._spawn(index)
+        self._polling.start(.5)
+
+    def stop(self):
+        """
+        Stop all worker processes.
+        """
+        self._running = False
+        if self._polling.running:
+            self._polling.stop()
+        for process, _, _ in self._workers.values():
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process, _, _ in self._workers.values():
+            if process is not None:
+                process.join(5)
+
+    def _spawn(self, index):
+        if not self._running:
+            return
+        process = self._context.Process(target=run_worker, name='xbr-fleet-{}'.format(index),
+                                        args=(index, self._url, self._realm, self._assigned[index], self._reports,
+                                              self._report_interval, self._retry, self._debug))
+        process.start()
+        self._workers[index][0] = process
+        self.log.info('Started worker {index} (pid {pid}) with {count} delegates', index=index, pid=process.pid,
+                      count=len(self._assigned[index]))
+
+    def _poll(self):
+        while True:
+            try:
+                report = self._reports.get_nowait()
+            except queue.Empty:
+                break
+            self._workers[report['worker']][2] = report
+
+        for index, worker in self._workers.items():
+            process = worker[0]
+            if process is not None and not process.is_alive():
+                worker[0] = None
+                worker[1] += 1
+                delay = min(self._restart_delay * 2 ** min(worker[1] - 1, 16), self._max_restart_delay)
+                self.log.warn('Worker {index} (pid {pid}) exited with {code}: restarting in {delay:.1f}s', index=index,
+                              pid=process.pid, code=process.exitcode, delay=delay)
+                self._reactor.callLater(delay, self._spawn, index)
+
+    def health(self):
+        """
+        :return: Tuple ``(healthy, health)``: whether all workers are running and reporting, and all delegates
+            are joined, and the aggregated health of all workers and delegates.
+        """
+        now = time.time()
+        workers = {}
+        delegates = {}
+        healthy = True
+        for index, (process, restarts, report) in self._workers.items():
+            alive = process is not None and process.is_alive()
+            age = now - report['time'] if report else None
+            reporting = age is not None and age < 3 * self._report_interval
+            healthy = healthy and alive and reporting
+            workers[index] = {'pid': process.pid if process else None, 'alive': alive, 'restarts': restarts,
+                              'report_age': age}
+            if report:
+                delegates.update(report['delegates'])
+        states = [delegate['state'] for delegate in delegates.values()]
+        joined = states.count('joined')
+        delegate_count = sum(len(assigned) for assigned in self._assigned)
+        healthy = healthy and joined == delegate_count
+        return healthy, {
+            'healthy': healthy,
+            'delegates': delegate_count,
+            'joined': joined,
+            'restarts': sum(delegate['restarts'] for delegate in delegates.values()),
+            'worker_restarts': sum(worker['restarts'] for worker in workers.values()),
+            'workers': workers,
+            'members': delegates,
+        }
+
+
+class HealthResource(Resource):
+    """
+    HTTP resource serving the (aggregated) fleet health as JSON, with status 503 when not healthy.
+    """
+    isLeaf = True
+
+    def __init__(self, supervisor):
+        Resource.__init__(self)
+        self._supervisor = supervisor
+
+    def render_GET(self, request):
+        healthy, health = self._supervisor.health()
+        request.setResponseCode(200 if healthy else 503)
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(health).encode('utf8')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d',
+                        '--debug',
+                        action='store_true',
+                        help='Enable debug output.')
+
+    parser.add_argument('--manifest',
+                        dest='manifest',
+                        type=str,
+                        required=True,
+                        help='JSON file with the router and the delegates (keys, roles and options) to run.')
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=None,
+                        help='Number of worker processes (default: number of cores).')
+
+    parser.add_argument('--health_port',
+                        dest='health_port',
+                        type=int,
+                        default=8090,
+                        help='Port to serve the fleet health on (HTTP, at any path), or 0 to disable (default: 8090).')
+
+    parser.add_argument('--report_interval',
+                        dest='report_interval',
+                        type=float,
+                        default=2,
+                        help='Time in seconds between health reports of workers (default: 2).')
+
+    from resume import add_reconnect_arguments, reconnect_options
+    add_reconnect_arguments(parser)
+
+    args = parser.parse_args()
+
+    from twisted.internet import reactor
+
+    # created before logging is started, which replaces stderr (passed on to the multiprocessing helper process)
+    url, realm, delegates = load_manifest(args.manifest)
+    supervisor = FleetSupervisor(reactor, url, realm, delegates, workers=args.workers,
+                                 report_interval=args.report_interval, retry=reconnect_options(args),
+                                 debug=args.debug)
+
+    if args.debug:
+        txaio.start_logging(level='debug')
+    else:
+        txaio.start_logging(level='info')
+
+    if args.health_port:
+        reactor.listenTCP(args.health_port, Site(HealthResource(supervisor)))
+
+    reactor.callWhenRunning(supervisor.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+    reactor.run()
@@ -0,0 +1,202 @@
+# coding=utf8
+
+# replay of recent XBR encrypted events: sellers keep the events published last per topic (bounded in
+# count and bytes), and buyers reconnecting fetch all events published since the last event they received
+# in one call
+
+from collections import deque
+from itertools import islice
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from autobahn.wamp.types import EventDetails
+
+
+class _TopicHistory(object):
+    __slots__ = ('events', 'index', 'bytes', 'next_seq')
+
+    def __init__(self):
+        # (seq, publication, key_id, enc_ser, ciphertext), oldest first
+        self.events = deque()
+        # publication -> seq
+        self.index = {}
+        self.bytes = 0
+        self.next_seq = 0
+
+
+class EventHistory(object):
+    """
+    Ring buffer per topic of the (encrypted) events published last, bounded by the number of events and
+    the bytes of ciphertext per topic. Events are kept encrypted, so fetching them still requires buying
+    the data encryption keys.
+
+    Publication IDs are not ordered, so events are fetched since a publication ID by looking up its
+    position in the buffer.
+    """
+
+    # approximate memory used per event in addition to the ciphertext (tuple, index and IDs)
+    EVENT_OVERHEAD = 200
+
+    def __init__(self, max_events=1000, max_bytes=2**20):
+        """
+
+        :param max_events: Maximum number of events kept per topic.
+        :param max_bytes: Budget (in bytes) for the memory used by the events kept per topic.
+        """
+        self._max_events = max_events
+        self._max_bytes = max_bytes
+        # topic -> _TopicHistory
+        self._topics = {}
+
+        self.evicted = 0
+
+    def stats(self):
+        """
+        :return: Number of events and bytes kept per topic, and the number of events evicted.
+        """
+        return {
+            'topics': {topic: {'events': len(history.events), 'bytes': history.bytes}
+                       for topic, history in self._topics.items()},
+            'evicted': self.evicted,
+        }
+
+    def append(self, topic, publication, key_id, enc_ser, ciphertext):
+        """
+        Keep an event published, evicting the oldest events of the topic when over budget.
+
+        :param topic: The topic the event was published to.
+        :param publication: The publication ID.
+        :param key_id: ID of the data encryption key the event is encrypted with.
+        :param enc_ser: Serializer of the encrypted payload.
+        :param ciphertext: The encrypted payload.
+        """
+        history = self._topics.get(topic, None)
+        if history is None:
+            history = self._topics[topic] = _TopicHistory()
+        history.events.append((history.next_seq, publication, key_id, enc_ser, ciphertext))
+        history.index[publication] = history.next_seq
+        history.next_seq += 1
+        history.bytes += len(ciphertext) + self.EVENT_OVERHEAD
+
+        while len(history.events) > self._max_events or (history.bytes > self._max_bytes and
+                                                         len(history.events) > 1):
+            _, publication, _, _, ciphertext = history.events.popleft()
+            del history.index[publication]
+            history.bytes -= len(ciphertext) + self.EVENT_OVERHEAD
+            self.evicted += 1
+
+    def since(self, topic, publication=None, limit=None):
+        """
+        Get the events of a topic published after an event. This is the WAMP procedure buyers call to catch up.
+
+        :param topic: The topic.
+        :param publication: ID of the last publication received, or ``None`` for all events kept.
+        :param limit: optional maximum number of (the oldest) events to return.
+        :return: Dict with the list of ``events`` (``[publication, key_id, enc_ser, ciphertext]``), and
+            ``complete``, which is false if events since the publication may have been evicted already
+            (the publication is not kept anymore) or not all events were returned due to the limit.
+        """
+        history = self._topics.get(topic, None)
+        if history is None:
+            return {'events': [], 'complete': publication is None}
+
+        complete = True
+        first = 0
+        if publication is not None:
+            seq = history.index.get(publication, None)
+            if seq is None:
+                complete = False
+            else:
+                # sequence numbers are consecutive, so the position in the buffer follows from the first event
+                first = seq - history.events[0][0] + 1
+
+        events = [[pub, key_id, enc_ser, ciphertext]
+                  for _, pub, key_id, enc_ser, ciphertext in islice(history.events, first, None)]
+        if limit is not None and len(events) > limit:
+            events = events[:limit]
+            complete = False
+        return {'events': events, 'complete': complete}
+
+
+class HistoryCatchUp(object):
+    """
+    Catches up on the events missed while a buyer was disconnected, from the history of the seller.
+
+    The publication received last per topic is tracked in a (plain) dict, which outlives the session
+    when kept in the session config extra. After (re-)subscribing, the events published since are fetched
+    and fed to the event handler, followed by the events received live meanwhile (which were held back,
+    to keep the order of events), without duplicates.
+    """
+    log = make_logger()
+
+    def __init__(self, session, procedure, on_event, last_received, topic=None):
+        """
+
+        :param session: WAMP session to call the history procedure on.
+        :param procedure: The history procedure of the seller (see :meth:`EventHistory.since`).
+        :param on_event: Event handler ``on_event(key_id, enc_ser, ciphertext, details, trace=None)`` to feed
+            events to (events replayed from the history have no trace).
+        :param last_received: Dict of the publication received last per topic (updated as events are received).
+        :param topic: Topic of events received without topic in the event details (exact subscriptions).
+        """
+        self._session = session
+        self._procedure = procedure
+        self._on_event = on_event
+        self._last_received = last_received
+        self._topic = topic
+        # live events held back while catching up, or None
+        self._held = None
+
+        self.replayed = 0
+
+    def on_event(self, key_id, enc_ser, ciphertext, details=None, trace=None):
+        """
+        WAMP event handler to subscribe with.
+        """
+        if self._held is not None:
+            self._held.append((key_id, enc_ser, ciphertext, details, trace))
+            return
+        self._received(key_id, enc_ser, ciphertext, details, trace)
+
+    def _received(self, key_id, enc_ser, ciphertext, details, trace=None):
+        topic = (details.topic if details else None) or self._topic
+        if details:
+            self._last_received[topic] = details.publication
+        self._on_event(key_id, enc_ser, ciphertext, details, trace=trace)
+
+    def hold(self):
+        """
+        Start holding back live events. Call before subscribing.
+        """
+        if self._held is None:
+            self._held = []
+
+    async def catch_up(self, subscription):
+        """
+        Fetch and feed the events published since the publication received last, for all topics events were
+        received on, and then the live events held back.
+
+        :param subscription: The subscription (events are replayed as received on).
+        """
+        self.hold()
+        replayed = set()
+        try:
+            for topic, publication in list(self._last_received.items()):
+                result = await self._session.call(self._procedure, topic, publication)
+                if not result['complete']:
+                    self.log.warn('History of topic {topic} is incomplete: events were lost', topic=topic)
+                for publication, key_id, enc_ser, ciphertext in result['events']:
+                    replayed.add(publication)
+                    self._received(key_id, enc_ser, ciphertext,
+                                   EventDetails(subscription, publication, topic=topic))
+                self.replayed += len(result['events'])
+                self.log.info('Caught up on {count} events of topic {topic}', count=len(result['events']),
+                              topic=topic)
+        finally:
+            held, self._held = self._held, None
+            for key_id, enc_ser, ciphertext, details, trace in held:
+                if details is None or details.publication not in replayed:
+                    self._received(key_id, enc_ser, ciphertext, details, trace)
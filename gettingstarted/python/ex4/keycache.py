@@ -0,0 +1,245 @@
+# coding=utf8
+
+# data encryption key cache for XBR buyer delegates (bounded in size and key lifetime), and prefetching
+# of keys offered for subscribed topics, so keys are bought before the first event encrypted with them arrives
+
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import nacl.secret
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.internet.defer import ensureDeferred
+
+from autobahn.wamp.exception import ApplicationError
+
+
+class KeyCache(MutableMapping):
+    """
+    Least-recently-used cache of XBR data encryption keys, with a byte budget and a time-to-live.
+
+    The cache is used as the key map of a buyer (key ID -> key, or ``False`` for a key currently being
+    bought). Keys currently being bought are never evicted or expired.
+
+    With a (persistent) key store, keys bought are also written to the store, and keys not in the cache
+    are looked up in the store before being bought (again).
+    """
+
+    # approximate memory used per entry in addition to key ID and key (dict and object overhead)
+    ENTRY_OVERHEAD = 160
+
+    # size of XBR data encryption keys
+    KEY_SIZE = 32
+
+    def __init__(self, max_bytes=2**20, ttl=None, clock=time.monotonic, store=None, metrics=None):
+        """
+
+        :param max_bytes: Budget (in bytes) for the memory used by keys in the cache.
+        :param ttl: Time (in seconds) after which keys are expired, or ``None`` to keep keys until evicted.
+        :param clock: Function returning the current time in seconds.
+        :param store: optional :class:`keystore.KeyStore` backing the cache.
+        :param metrics: optional :class:`metrics.MetricsRegistry` to count keys bought (cache misses) and loaded
+            from the key store in. The counts accumulate across the caches of all buyers of the registry.
+        """
+        self._max_bytes = max_bytes
+        self._store = store
+        self._ttl = ttl
+        self._clock = clock
+        # key_id -> (key, added)
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+        self.loaded = 0
+
+        self._metrics = metrics is not None
+        if self._metrics:
+            self._bought_total = metrics.counter('xbr_buyer_keys_bought_total',
+                                                 'Data encryption keys bought (key cache misses).')
+            self._loaded_total = metrics.counter('xbr_buyer_keys_loaded_total',
+                                                 'Data encryption keys loaded from the key store.')
+
+    @property
+    def bytes(self):
+        """
+        Approximate memory (in bytes) used by keys in the cache.
+        """
+        return self._bytes
+
+    def stats(self):
+        """
+        :return: Cache size and hit/miss/eviction counters.
+        """
+        return {
+            'keys': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evicted': self.evicted,
+            'expired': self.expired,
+            'loaded': self.loaded,
+        }
+
+    def _entry_size(self, key_id):
+        return len(key_id) + self.KEY_SIZE + self.ENTRY_OVERHEAD
+
+    def _is_expired(self, key, added):
+        return self._ttl is not None and key is not False and self._clock() - added > self._ttl
+
+    def __contains__(self, key_id):
+        entry = self._entries.get(key_id, None)
+        if entry is not None and self._is_expired(*entry):
+            self.expired += 1
+            del self[key_id]
+            entry = None
+        if entry is None and not self._load(key_id):
+            self.misses += 1
+            if self._metrics:
+                self._bought_total.inc()
+            return False
+        self.hits += 1
+        return True
+
+    def _load(self, key_id):
+        if self._store is None:
+            return False
+        key = self._store.get(key_id)
+        if key is None:
+            return False
+        self.loaded += 1
+        if self._metrics:
+            self._loaded_total.inc()
+        self._entries[key_id] = (nacl.secret.SecretBox(key), self._clock())
+        self._bytes += self._entry_size(key_id)
+        self._evict()
+        return True
+
+    def __getitem__(self, key_id):
+        key, added = self._entries[key_id]
+        if self._is_expired(key, added):
+            self.expired += 1
+            del self[key_id]
+            raise KeyError(key_id)
+        self._entries.move_to_end(key_id)
+        return key
+
+    def get(self, key_id, default=None):
+        # does not count as hit or miss, nor look up the store (used for peeking at keys)
+        try:
+            return self[key_id]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key_id, key):
+        # only keys are persisted (not the False marker of keys being bought, nor the error of a failed purchase)
+        if self._store is not None and isinstance(key, nacl.secret.SecretBox):
+            self._store.put(key_id, bytes(key))
+        if key_id in self._entries:
+            del self[key_id]
+        self._entries[key_id] = (key, self._clock())
+        self._bytes += self._entry_size(key_id)
+        self._evict()
+
+    def __delitem__(self, key_id):
+        del self._entries[key_id]
+        self._bytes -= self._entry_size(key_id)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        # evict least recently used keys (skipping keys being bought) until within budget
+        if self._bytes <= self._max_bytes:
+            return
+        for key_id, (key, _) in list(self._entries.items()):
+            if key is False:
+                continue
+            del self[key_id]
+            self.evicted += 1
+            if self._bytes <= self._max_bytes:
+                break
+
+
+class KeyPrefetcher(object):
+    """
+    Buys data encryption keys when offered by sellers for topics of interest, rather than when the
+    first event encrypted with a (new) key arrives.
+
+    Keys are offered for the (URI) prefix of an API, and bought when a topic is the API prefix or below it,
+    or when the API prefix is a topic prefix or below it. URI components match whole, so the prefix
+    ``io.crossbar.example`` does not match ``io.crossbar.example2``.
+    """
+    log = make_logger()
+
+    # market maker topic on which key offers are announced
+    OFFER_TOPIC = 'xbr.marketmaker.on_offer_placed'
+
+    # the buyer only buys keys as part of unwrapping an event, so a key is prefetched by unwrapping
+    # this (undecryptable) dummy ciphertext (a nonce and MAC of zeros)
+    DUMMY_CIPHERTEXT = b'\x00' * 40
+
+    def __init__(self, session, buyer, topics=(), prefixes=()):
+        """
+
+        :param session: WAMP session to watch key offers on.
+        :param buyer: XBR buyer (:class:`autobahn.twisted.xbr.SimpleBuyer`) to buy keys with.
+        :param topics: Topics keys are bought for.
+        :param prefixes: Topic prefixes keys are bought for.
+        """
+        self._session = session
+        self._buyer = buyer
+        self._topics = tuple(topics)
+        self._prefixes = tuple(prefixes)
+
+        self.prefetched = 0
+        self.failed = 0
+
+    async def start(self):
+        """
+        Start watching key offers.
+        """
+        await self._session.subscribe(self._on_offer, self.OFFER_TOPIC)
+
+    def _on_offer(self, offer):
+        key_id = offer.get('key', None)
+        uri = offer.get('uri', None)
+        if not key_id or not uri or not self._wanted(uri):
+            return
+        # peek (a membership test would count as a cache miss, and look up the key store)
+        if self._buyer._keys.get(key_id, None) is not None:
+            return
+        ensureDeferred(self._prefetch(key_id, uri))
+
+    def _wanted(self, uri):
+        below = uri + '.'
+        for topic in self._topics:
+            if topic == uri or topic.startswith(below):
+                return True
+        for prefix in self._prefixes:
+            if prefix == uri or prefix.startswith(below) or uri.startswith(prefix + '.'):
+                return True
+        return False
+
+    async def _prefetch(self, key_id, uri):
+        try:
+            await self._buyer.unwrap(key_id, 'cbor', self.DUMMY_CIPHERTEXT)
+        except Exception as e:
+            if isinstance(e, ApplicationError) and e.error == 'xbr.error.decryption_failed':
+                # expected: the key was bought, and then failed to decrypt the dummy
+                self.prefetched += 1
+                self.log.debug('Prefetched key {key_id} for {uri}', key_id=key_id, uri=uri)
+            else:
+                self.failed += 1
+                self.log.warn('Failed to prefetch key {key_id} for {uri}: {error}', key_id=key_id, uri=uri,
+                              error=e)
@@ -0,0 +1,83 @@
+# coding=utf8
+
+# persistent (on-disk) store for data encryption keys bought by XBR buyer delegates, so that keys
+# survive restarts and need not be bought again
+
+import os
+import time
+import sqlite3
+
+import nacl.hash
+import nacl.secret
+import nacl.encoding
+
+
+class KeyStore(object):
+    """
+    SQLite database of data encryption keys, indexed by key ID.
+
+    Keys are stored encrypted with a secret derived from the delegate (Ethereum) private key, and
+    expire after a configurable time. Keys are only read from the database when looked up.
+    """
+
+    # default location of the key store (the directory of the default XBR profile)
+    DEFAULT_PATH = '~/.xbrnetwork/keys.db'
+
+    def __init__(self, path, delegate_key, ttl=86400, clock=time.time):
+        """
+
+        :param path: Path of the database file (created if it does not exist).
+        :param delegate_key: Private key (raw bytes) of the delegate, the key store secret is derived from.
+        :param ttl: Time (in seconds) keys are kept in the store after being stored.
+        :param clock: Function returning the current (wall clock) time in seconds.
+        """
+        self._path = os.path.expanduser(path)
+        self._ttl = ttl
+        self._clock = clock
+        secret = nacl.hash.blake2b(delegate_key, digest_size=nacl.secret.SecretBox.KEY_SIZE,
+                                   person=b'xbr-keystore', encoder=nacl.encoding.RawEncoder)
+        self._box = nacl.secret.SecretBox(secret)
+        self._db = None
+
+    def open(self):
+        """
+        Open (or create) the database, and remove expired keys.
+        """
+        assert self._db is None
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        self._db = sqlite3.connect(self._path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS keys (key_id BLOB PRIMARY KEY, key BLOB NOT NULL, '
+                         'expires REAL NOT NULL)')
+        self._db.execute('DELETE FROM keys WHERE expires < ?', (self._clock(),))
+        self._db.commit()
+
+    def close(self):
+        """
+        Close the database.
+        """
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def get(self, key_id):
+        """
+        Look up a key.
+
+        :param key_id: ID of the key.
+        :return: The (raw) key, or ``None`` if not stored (or expired).
+        """
+        row = self._db.execute('SELECT key, expires FROM keys WHERE key_id = ?', (key_id,)).fetchone()
+        if row is None or row[1] < self._clock():
+            return None
+        return self._box.decrypt(row[0])
+
+    def put(self, key_id, key):
+        """
+        Store a key.
+
+        :param key_id: ID of the key.
+        :param key: The (raw) key.
+        """
+        self._db.execute('INSERT OR REPLACE INTO keys (key_id, key, expires) VALUES (?, ?, ?)',
+                         (key_id, self._box.encrypt(key), self._clock() + self._ttl))
+        self._db.commit()
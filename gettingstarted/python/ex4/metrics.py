@@ -0,0 +1,296 @@
+# coding=utf8
+
+# metrics of XBR delegates: counters, gauges and histograms cheap enough to update on the hot paths (for every
+# event published or received), exposed in the Prometheus text format over HTTP, and as a WAMP procedure
+
+import math
+import time
+from bisect import bisect_left
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.web.resource import Resource
+
+# latency buckets (in seconds), from 100us to 10s
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+# size buckets (in bytes), from 64B to 1MB
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Counter(object):
+    """
+    Monotonically increasing count, or the value of a function returning a count (read when collected).
+    """
+    __slots__ = ('name', 'help', 'value', 'fn')
+
+    TYPE = 'counter'
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = fn
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.fn() if self.fn else self.value
+
+
+class Gauge(Counter):
+    """
+    Value going up and down, or the value of a function (read when collected).
+    """
+    __slots__ = ()
+
+    TYPE = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """
+    Distribution of observed values in fixed buckets (by upper bound), with the count and sum of all values.
+    """
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        # one count per bucket, and one for values above the largest bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def buckets(self):
+        """
+        :return: List of the cumulative counts per bucket ``(upper_bound, count)``, ending with ``+Inf``.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """
+        :param q: The quantile (0 to 1).
+        :return: Upper bound of the bucket the quantile falls in (an estimate), or ``None`` without values.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.buckets():
+            if total >= rank:
+                return bound
+        return math.inf
+
+
+def _format_labels(labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                     .replace('\n', '\\n'))
+                    for name, value in sorted(labels.items()))
+
+
+class MetricsRegistry(object):
+    """
+    Metrics of a delegate, by name (and labels). Metrics are created once and then returned again when asked
+    for by name, so a registry kept in the session config extra accumulates counts across reconnects.
+    """
+    log = make_logger()
+
+    def __init__(self, labels=None):
+        """
+
+        :param labels: optional labels added to all metrics (e.g. the delegate name in a fleet).
+        """
+        self._labels = _format_labels(labels or {})
+        # name -> (type, help, labels -> metric), in order of creation
+        self._metrics = {}
+        self._started = time.time()
+
+    def _get(self, klass, name, help, labels, *args):
+        family = self._metrics.get(name, None)
+        if family is None:
+            family = self._metrics[name] = (klass.TYPE, help, {})
+        key = _format_labels(labels) if labels else ''
+        metric = family[2].get(key, None)
+        if metric is None:
+            metric = family[2][key] = klass(name, help, *args)
+        return metric
+
+    def counter(self, name, help, fn=None, labels=None):
+        """
+        Get (or create) a counter.
+
+        :param name: Name of the counter (by convention ending in ``_total``).
+        :param help: Description of the counter.
+        :param fn: optional function returning the count, replacing the function of an existing counter.
+        :param labels: optional labels (dict) of the counter.
+        :return: The :class:`Counter`.
+        """
+        counter = self._get(Counter, name, help, labels)
+        if fn is not None:
+            counter.fn = fn
+        return counter
+
+    def gauge(self, name, help, fn=None, labels=None):
+        """
+        Get (or create) a gauge.
+
+        :param name: Name of the gauge.
+        :param help: Description of the gauge.
+        :param fn: optional function returning the value, replacing the function of an existing gauge.
+        :param labels: optional labels (dict) of the gauge.
+        :return: The :class:`Gauge`.
+        """
+        gauge = self._get(Gauge, name, help, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=None):
+        """
+        Get (or create) a histogram.
+
+        :param name: Name of the histogram.
+        :param help: Description of the histogram.
+        :param buckets: Upper bounds of the buckets (sorted).
+        :param labels: optional labels (dict) of the histogram.
+        :return: The :class:`Histogram`.
+        """
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def _value(self, metric):
+        try:
+            return metric.get()
+        except Exception as e:
+            self.log.debug('Failed to collect {name}: {error}', name=metric.name, error=e)
+            return None
+
+    def render(self):
+        """
+        :return: All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, (kind, help, series) in self._metrics.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for key, metric in series.items():
+                labels = ','.join(filter(None, [self._labels, key]))
+                if kind == 'histogram':
+                    for bound, count in metric.buckets():
+                        le = 'le="{}"'.format('+Inf' if bound == math.inf else repr(bound))
+                        lines.append('{}_bucket{{{}}} {}'.format(name, labels + ',' + le if labels else le, count))
+                    labels = '{' + labels + '}' if labels else ''
+                    lines.append('{}_sum{} {!r}'.format(name, labels, metric.sum))
+                    lines.append('{}_count{} {}'.format(name, labels, metric.count))
+                else:
+                    value = self._value(metric)
+                    labels = '{' + labels + '}' if labels else ''
+                    lines.append('{}{} {}'.format(name, labels, 'NaN' if value is None else repr(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Get the current values of all metrics. This is the WAMP procedure the metrics are served with.
+
+        :return: Dict of the values of counters and gauges, and of the count, sum and (estimated) median and
+            99th percentile of histograms (``None`` above the largest bucket), by name (with labels).
+        """
+        result = {'uptime': time.time() - self._started}
+        for name, (kind, _, series) in self._metrics.items():
+            for key, metric in series.items():
+                if kind == 'histogram':
+                    p50, p99 = metric.quantile(.5), metric.quantile(.99)
+                    value = {'count': metric.count, 'sum': metric.sum,
+                             'p50': None if p50 == math.inf else p50,
+                             'p99': None if p99 == math.inf else p99}
+                else:
+                    value = self._value(metric)
+                result['{}{{{}}}'.format(name, key) if key else name] = value
+        return result
+
+
+class DelegateMetrics(object):
+    """
+    Metrics common to seller and buyer delegates: sessions joined, whether joined, and the channel balance.
+    """
+
+    def __init__(self, registry):
+        """
+
+        :param registry: The :class:`MetricsRegistry` of the delegate.
+        """
+        self.registry = registry
+        self._sessions = registry.counter('xbr_delegate_sessions_total',
+                                          'Sessions joined (the first session, and after every reconnect).')
+        self._joined = registry.gauge('xbr_delegate_joined', 'Whether the delegate is joined (1) or not (0).')
+        self._balance = registry.gauge('xbr_delegate_channel_balance',
+                                       'Remaining balance (in XBR) of the channel of the delegate, when last '
+                                       'looked up.')
+
+    def joined(self):
+        self._sessions.inc()
+        self._joined.set(1)
+
+    def left(self):
+        self._joined.set(0)
+
+    def balance(self, balance):
+        self._balance.set(balance)
+
+
+class MetricsResource(Resource):
+    """
+    HTTP resource serving the metrics of a registry in the Prometheus text format.
+    """
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self._registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self._registry.render().encode('utf8')
+
+
+def add_metrics_arguments(parser):
+    """
+    Add the command line options for serving metrics to an argument parser.
+
+    :param parser: The :class:`argparse.ArgumentParser`.
+    """
+    parser.add_argument('--metrics_port',
+                        dest='metrics_port',
+                        type=int,
+                        default=0,
+                        help='Port to serve metrics on (HTTP, Prometheus text format), or 0 to disable (default: 0).')
+
+    parser.add_argument('--metrics_interface',
+                        dest='metrics_interface',
+                        type=str,
+                        default='127.0.0.1',
+                        help='Interface to serve metrics on (default: "127.0.0.1").')
+
+    parser.add_argument('--metrics_procedure',
+                        dest='metrics_procedure',
+                        type=str,
+                        default=None,
+                        help='WAMP procedure to register, returning the current metrics (default: none).')
@@ -0,0 +1,347 @@
+# coding=utf8
+
+# durable outbox for XBR seller delegates: producers append payloads to a memory-mapped, append-only file
+# at memory speed (whether or not the seller is connected), and a drainer publishes from it when connected
+
+import os
+import mmap
+import struct
+from collections import deque
+from functools import partial
+
+import cbor2
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.internet.defer import Deferred, ensureDeferred
+
+from autobahn.twisted.util import sleep
+
+
+class OutboxFull(Exception):
+    """
+    The outbox has no space left for a payload.
+    """
+
+
+class Outbox(object):
+    """
+    Append-only log of payloads (to encrypt and publish) in a memory-mapped file.
+
+    The file starts with a header holding the offsets of the next record not yet committed and of the end of
+    the records written, followed by the records (length prefixed, CBOR serialized ``[api_id, topic,
+    payload]``). Records taken from the outbox are committed once published (acknowledged), and records
+    taken but not committed are taken again after rewinding (e.g. when the seller reconnects) or restarting,
+    so each record is published at least once. Space of records committed is reclaimed when the outbox runs
+    out of space, by moving the records not yet committed to the front.
+
+    The memory-mapped file is written to the OS page cache, so records survive the process crashing, and
+    are written to disk when flushed (or by the OS).
+    """
+    log = make_logger()
+
+    MAGIC = b'XBROBX01'
+
+    # magic, commit offset, write offset
+    HEADER = struct.Struct('<8sQQ')
+
+    RECORD = struct.Struct('<I')
+
+    def __init__(self, path, size=64 * 2**20):
+        """
+
+        :param path: Path of the outbox file (created if it does not exist).
+        :param size: Size (in bytes) of the outbox file, bounding the records not yet published.
+        """
+        self._path = os.path.expanduser(path)
+        self._size = size
+        self._file = None
+        self._mm = None
+        # offset of the oldest record not committed (persisted), of the next record to take, and of the end
+        # of the records written (persisted)
+        self._read = self.HEADER.size
+        self._taken = self.HEADER.size
+        self._write = self.HEADER.size
+        # end offsets of the records taken and not yet committed, in order
+        self._taken_ends = deque()
+        # deferreds fired on the next record appended
+        self._waiting = []
+
+        self.appended = 0
+        self.taken = 0
+        self.committed = 0
+        self.dropped = 0
+
+    def open(self):
+        """
+        Open (or create) the outbox file. Records not yet taken from a previous run are kept.
+        """
+        assert self._mm is None
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        self._file = open(self._path, 'a+b')
+        self._size = max(self._size, os.fstat(self._file.fileno()).st_size)
+        self._file.truncate(self._size)
+        self._mm = mmap.mmap(self._file.fileno(), self._size)
+
+        magic, read, write = self.HEADER.unpack_from(self._mm, 0)
+        if magic == self.MAGIC and self.HEADER.size <= read <= write <= self._size:
+            self._read, self._write = read, write
+            if self._write > self._read:
+                self.log.info('Outbox has {bytes} bytes of records not yet published', bytes=self._write - self._read)
+        else:
+            self._read = self._write = self.HEADER.size
+            self._sync_header()
+        self._taken = self._read
+        self._taken_ends.clear()
+
+    def close(self):
+        """
+        Flush and close the outbox file.
+        """
+        if self._mm:
+            self._mm.flush()
+            self._mm.close()
+            self._mm = None
+            self._file.close()
+            self._file = None
+
+    def flush(self):
+        """
+        Write the records appended to disk.
+        """
+        if self._mm:
+            self._mm.flush()
+
+    @property
+    def empty(self):
+        """
+        Whether there are no records to take.
+        """
+        return self._taken == self._write
+
+    @property
+    def bytes(self):
+        """
+        Bytes used by records not yet committed.
+        """
+        return self._write - self._read
+
+    @property
+    def uncommitted(self):
+        """
+        Number of records taken and not yet committed.
+        """
+        return len(self._taken_ends)
+
+    def stats(self):
+        """
+        :return: Outbox usage and record counters.
+        """
+        return {
+            'bytes': self.bytes,
+            'size': self._size,
+            'appended': self.appended,
+            'taken': self.taken,
+            'committed': self.committed,
+            'uncommitted': self.uncommitted,
+            'dropped': self.dropped,
+        }
+
+    def append(self, api_id, topic, payload):
+        """
+        Append a payload. This never blocks on (or waits for) the seller.
+
+        :param api_id: The API the topic belongs to.
+        :param topic: The topic to publish to.
+        :param payload: The (unencrypted) application payload, which must be serializable with CBOR.
+        :raises OutboxFull: The outbox has no space left (the payload is dropped).
+        """
+        data = cbor2.dumps([api_id, topic, payload])
+        length = self.RECORD.size + len(data)
+        if self._write + length > self._size:
+            self._compact()
+            if self._write + length > self._size:
+                self.dropped += 1
+                raise OutboxFull()
+
+        self.RECORD.pack_into(self._mm, self._write, len(data))
+        self._mm[self._write + self.RECORD.size:self._write + length] = data
+        # the record is complete before the write offset includes it
+        self._write += length
+        self._sync_header()
+        self.appended += 1
+
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            if not d.called:
+                d.callback(None)
+
+    def take(self, max_records=100):
+        """
+        Take the oldest records not yet taken. The records are taken again after rewinding, until committed.
+
+        :param max_records: Maximum number of records to take.
+        :return: List of records ``(api_id, topic, payload)``.
+        """
+        records = []
+        offset = self._taken
+        while offset < self._write and len(records) < max_records:
+            length, = self.RECORD.unpack_from(self._mm, offset)
+            offset += self.RECORD.size
+            records.append(cbor2.loads(self._mm[offset:offset + length]))
+            offset += length
+            self._taken_ends.append(offset)
+        self._taken = offset
+        self.taken += len(records)
+        return records
+
+    def commit(self, count):
+        """
+        Commit the oldest records taken (published), so they are not taken again.
+
+        :param count: Number of records to commit (at most the number of records taken and not committed).
+        """
+        for _ in range(count):
+            self._read = self._taken_ends.popleft()
+        if self._read == self._write:
+            # all records committed: start over at the front
+            self._read = self._taken = self._write = self.HEADER.size
+        self._sync_header()
+        self.committed += count
+
+    def rewind(self):
+        """
+        Take the records taken but not yet committed again.
+        """
+        self._taken = self._read
+        self._taken_ends.clear()
+
+    def wait(self):
+        """
+        Wait for records to take.
+
+        :return: Deferred fired when there are records to take.
+        """
+        d = Deferred()
+        if self.empty:
+            self._waiting.append(d)
+        else:
+            d.callback(None)
+        return d
+
+    def _compact(self):
+        if self._read > self.HEADER.size:
+            shift = self._read - self.HEADER.size
+            self._mm.move(self.HEADER.size, self._read, self._write - self._read)
+            self._read -= shift
+            self._taken -= shift
+            self._write -= shift
+            self._taken_ends = deque(end - shift for end in self._taken_ends)
+            self._sync_header()
+
+    def _sync_header(self):
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, self._read, self._write)
+
+
+class OutboxDrainer(object):
+    """
+    Publishes the payloads appended to an outbox, in batches, using a :class:`publisher.QueuePublisher`.
+
+    Records are committed in order, once their publication is acknowledged. A record failed to publish is
+    queued again after a (growing) delay, and given up (committed without being published, and counted) after
+    ``max_retries``, so it holds back the commit of the records after it only for a bounded time. Records not
+    committed when the drainer stops (still queued or in flight, or waiting to be retried) are taken again by
+    the next drainer, so records published but not yet acknowledged may be published twice.
+    """
+    log = make_logger()
+
+    # delay (in seconds) before publishing a record again, doubled on every further failure (up to the maximum)
+    RETRY_DELAY = .1
+    MAX_RETRY_DELAY = 5.
+
+    def __init__(self, outbox, publisher, batch_size=100, max_retries=10):
+        """
+
+        :param outbox: The outbox to drain.
+        :param publisher: The publisher to queue payloads for publishing with.
+        :param batch_size: Maximum number of records taken from the outbox at once.
+        :param max_retries: Maximum number of times a record failed to publish is published again.
+        """
+        self._outbox = outbox
+        self._publisher = publisher
+        self._batch_size = batch_size
+        self._max_retries = max_retries
+        self._running = False
+        self._waiting = None
+        # records taken, in order: [acknowledged, retries, api_id, topic, payload]
+        self._unacked = None
+
+        self.retried = 0
+        self.given_up = 0
+
+    async def run(self):
+        """
+        Drain the outbox until stopped.
+        """
+        assert not self._running
+        self._running = True
+        # records taken before (and not committed) are published again
+        self._outbox.rewind()
+        unacked = self._unacked = deque()
+        try:
+            while self._running:
+                if self._outbox.empty:
+                    self._waiting = self._outbox.wait()
+                    await self._waiting
+                    self._waiting = None
+                    continue
+                for api_id, topic, payload in self._outbox.take(self._batch_size):
+                    record = [False, 0, api_id, topic, payload]
+                    unacked.append(record)
+                    await self._publisher.put(api_id, topic, payload, partial(self._on_done, unacked, record))
+        finally:
+            self._running = False
+
+    def _on_done(self, unacked, record, published):
+        # records are committed in order: a record failed to publish holds back the records after it, until
+        # published when retried (or given up)
+        if unacked is not self._unacked:
+            return
+        if not published:
+            if record[1] < self._max_retries:
+                record[1] += 1
+                self.retried += 1
+                d = ensureDeferred(self._retry(unacked, record))
+                d.addErrback(lambda fail: self.log.failure('Retrying outbox record failed', failure=fail))
+                return
+            self.given_up += 1
+            self.log.error('Publishing outbox record to {topic} failed {retries} times: giving up (dropped)',
+                           topic=record[3], retries=record[1] + 1)
+        record[0] = True
+        count = 0
+        while unacked and unacked[0][0]:
+            unacked.popleft()
+            count += 1
+        if count:
+            self._outbox.commit(count)
+
+    async def _retry(self, unacked, record):
+        _, retries, api_id, topic, payload = record
+        await sleep(min(self.RETRY_DELAY * 2 ** (retries - 1), self.MAX_RETRY_DELAY))
+        # not when stopped meanwhile (the record is taken again by the next drainer)
+        if unacked is self._unacked:
+            await self._publisher.put(api_id, topic, payload, partial(self._on_done, unacked, record))
+
+    def stop(self):
+        """
+        Stop draining the outbox. Payloads taken from the outbox already are still queued for publishing, but
+        not committed anymore (they are taken again by the next drainer).
+        """
+        if self._running:
+            self._running = False
+            self._unacked = None
+            if self._waiting and not self._waiting.called:
+                self._waiting.callback(None)
@@ -0,0 +1,224 @@
+# coding=utf8
+
+# payload codecs for XBR events: sellers can publish payloads encoded (or pre-serialized) with a codec
+# other than the default CBOR of plain values, e.g. MessagePack, FlatBuffers or raw NumPy array buffers,
+# which buyers decode into memoryviews or NumPy arrays over the encoded data (as deserialized from the event,
+# without copying it once more). several payloads can be packed into (the encrypted payload of) one event as
+# a batch, and compressed (see :mod:`compressors`)
+
+import json
+
+import cbor2
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import compressors
+
+
+# first element of an encoded payload: ``[ENVELOPE, codec_name, data]``
+ENVELOPE = 'xbr.codec'
+
+# first element of a batch of payloads published as one event: ``[BATCH, [payload, ..]]``
+BATCH = 'xbr.batch'
+
+
+class Codec(object):
+    """
+    Payload codec (base class). Encoding returns bytes; decoding takes bytes and may return views into them.
+    """
+    name = None
+
+    # whether the codec encodes plain values (dicts, lists, strings, numbers, ..), rather than only objects of
+    # one type (e.g. bytes, or arrays)
+    plain = True
+
+    def encode(self, obj):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+
+class RawCodec(Codec):
+    """
+    Opaque binary payloads (passed through), decoded as a :class:`memoryview` of the payload.
+    """
+    name = 'raw'
+    plain = False
+
+    def encode(self, obj):
+        return bytes(obj)
+
+    def decode(self, data):
+        return memoryview(data)
+
+
+class FlatBuffersCodec(RawCodec):
+    """
+    FlatBuffers payloads (as built by a ``flatbuffers.Builder``), decoded as a :class:`memoryview` to read
+    the payload in place with the generated ``GetRootAs`` accessors.
+    """
+    name = 'flatbuffers'
+
+
+class CborCodec(Codec):
+    name = 'cbor'
+
+    def encode(self, obj):
+        return cbor2.dumps(obj)
+
+    def decode(self, data):
+        return cbor2.loads(data)
+
+
+class JsonCodec(Codec):
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf8')
+
+    def decode(self, data):
+        return json.loads(bytes(data))
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class NumpyCodec(Codec):
+    """
+    NumPy arrays, encoded as a (short) header with dtype and shape followed by the raw array buffer, and
+    decoded as a read-only array over the encoded data. The encoded data is copied once, when the decrypted
+    event is deserialized (by CBOR), but not again when decoding the array.
+    """
+    name = 'numpy'
+    plain = False
+
+    def encode(self, obj):
+        arr = numpy.ascontiguousarray(obj)
+        header = '{}|{}\n'.format(arr.dtype.str, ','.join(str(n) for n in arr.shape)).encode('ascii')
+        return header + arr.tobytes()
+
+    def decode(self, data):
+        view = memoryview(data)
+        end = bytes(view[:256]).index(b'\n')
+        dtype, shape = bytes(view[:end]).decode('ascii').split('|')
+        shape = tuple(int(n) for n in shape.split(',')) if shape else ()
+        return numpy.frombuffer(view[end + 1:], dtype=dtype).reshape(shape)
+
+
+_CODECS = {}
+
+
+def register_codec(codec):
+    """
+    Register a payload codec.
+
+    :param codec: The codec (a :class:`Codec`) to register under its name.
+    """
+    _CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    """
+    Get a registered payload codec.
+
+    :param name: Name of the codec.
+    :return: The codec.
+    :raises KeyError: No codec of this name is registered (e.g. the codec's library is not installed).
+    """
+    return _CODECS[name]
+
+
+def plain_codecs():
+    """
+    :return: Names of the registered codecs encoding plain values (dicts, lists, ..), e.g. the payloads
+        published by the example sellers.
+    """
+    return sorted(name for name, codec in _CODECS.items() if codec.plain)
+
+
+for _codec in [RawCodec(), FlatBuffersCodec(), CborCodec(), JsonCodec()]:
+    register_codec(_codec)
+if msgpack:
+    register_codec(MsgpackCodec())
+if numpy:
+    register_codec(NumpyCodec())
+
+
+def envelope(name, data):
+    """
+    Wrap data already encoded (pre-serialized) with a codec as payload.
+
+    :param name: Name of the codec the data is encoded with.
+    :param data: The encoded data (bytes).
+    :return: The payload (to encrypt and publish).
+    """
+    return [ENVELOPE, name, data]
+
+
+def encode(name, obj):
+    """
+    Encode an object with a codec as payload.
+
+    :param name: Name of the codec.
+    :param obj: The object to encode.
+    :return: The payload (to encrypt and publish).
+    """
+    return envelope(name, get_codec(name).encode(obj))
+
+
+def decode(payload):
+    """
+    Decode a (decrypted) payload. Payloads not encoded with a codec are returned as is.
+
+    :param payload: The payload.
+    :return: The decoded object.
+    """
+    if type(payload) == list and len(payload) >= 3 and payload[0] == ENVELOPE:
+        return get_codec(payload[1]).decode(payload[2])
+    return payload
+
+
+def pack(items, codec=None, compression=None):
+    """
+    Pack one or more application payloads into the payload of one event.
+
+    :param items: List of application payloads.
+    :param codec: optional name of the codec to encode each payload with.
+    :param compression: optional compression settings (:class:`compressors.Compression`) to compress with.
+    :return: The payload (to encrypt and publish): the only payload, or a batch of all payloads.
+    """
+    if codec:
+        items = [encode(codec, item) for item in items]
+    payload = items[0] if len(items) == 1 else [BATCH, items]
+    if compression:
+        payload = compressors.compress(compression, payload)
+    return payload
+
+
+def unpack(payload):
+    """
+    Unpack (decompress) and decode the (decrypted) payload of one event into the application payloads it carries.
+
+    :param payload: The payload.
+    :return: List of decoded payloads (more than one for a batch).
+    """
+    payload = compressors.decompress(payload)
+    if type(payload) == list and len(payload) == 2 and payload[0] == BATCH:
+        return [decode(item) for item in payload[1]]
+    return [decode(payload)]
@@ -0,0 +1,378 @@
+# coding=utf8
+
+# publishing pipeline for XBR seller delegates: payloads are taken from a queue, encrypted and
+# published with a bounded number of (unacknowledged) publications in flight and at a target rate
+
+import time
+from collections import deque
+
+import cbor2
+import nacl.secret
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.internet.defer import Deferred, DeferredList, DeferredQueue, DeferredSemaphore, QueueOverflow, \
+    ensureDeferred
+from twisted.python.failure import Failure
+
+from autobahn.twisted.util import sleep
+from autobahn.wamp.types import PublishOptions
+
+import payloads
+from metrics import SIZE_BUCKETS
+from tracing import new_stream
+
+
+def encrypt_payload(key_id, key, items, codec=None, compression=None):
+    """
+    Serialize and encrypt payloads with a XBR data encryption key, exactly like the seller does
+    in ``wrap()``. This is a plain function, so it can run in a thread or process pool.
+
+    :param key_id: ID of the data encryption key.
+    :param key: The (raw) data encryption key.
+    :param items: List of application payloads to encrypt (into one event, as a batch for more than one).
+    :param codec: optional name of the codec to encode the payloads with first (see :mod:`payloads`).
+    :param compression: optional compression settings to compress the payloads with before encrypting them
+        (see :mod:`compressors`).
+    :return: Tuple ``(key_id, enc_ser, ciphertext)``.
+    """
+    payload = payloads.pack(items, codec, compression)
+    box = nacl.secret.SecretBox(key)
+    return key_id, 'cbor', box.encrypt(cbor2.dumps(payload))
+
+
+class QueuePublisher(object):
+    """
+    Publishes XBR encrypted events from a queue of payloads.
+
+    Payloads are encrypted (using the seller) and published acknowledged, but without waiting for the
+    acknowledgement of one publication before starting the next one, up to ``max_inflight`` publications.
+
+    Optionally, payloads for the same topic are batched: up to ``batch_size`` payloads, or the payloads
+    queued within ``batch_delay``, are encrypted and published together as one event.
+    """
+    log = make_logger()
+
+    # minimum time (in seconds) to be ahead of the target rate before pausing
+    PACING_GRANULARITY = 0.005
+
+    def __init__(self, session, seller, reactor=None, max_inflight=64, rate=None, queue_size=1000,
+                 on_published=None, executor=None, codec=None, batch_size=1, batch_delay=None,
+                 compression=None, topic_compression=None, history=None, metrics=None, trace=False):
+        """
+
+        :param session: WAMP session to publish on.
+        :param seller: XBR seller (:class:`autobahn.twisted.xbr.SimpleSeller`) to encrypt payloads with.
+        :param reactor: Twisted reactor to run under.
+        :param max_inflight: Maximum number of publications not yet acknowledged.
+        :param rate: Target rate in events per second, or ``None`` to publish as fast as possible.
+        :param queue_size: Maximum number of payloads queued (not yet encrypted and published).
+        :param on_published: optional callback ``on_published(pub, topic, payload)`` fired for every
+            publication acknowledged.
+        :param executor: optional :class:`concurrent.futures.Executor` (thread or process pool) to serialize
+            and encrypt payloads in, keeping the reactor free. Events are still published in the order queued.
+        :param codec: optional name of the codec (see :mod:`payloads`) to encode payloads with.
+        :param batch_size: Maximum number of payloads published (to the same topic) as one event.
+        :param batch_delay: Maximum time (in seconds) a payload waits for a batch to fill up before the batch
+            is published, or ``None`` to only publish full batches (and partial batches when stopped).
+        :param compression: optional compression settings (:class:`compressors.Compression`) to compress
+            payloads with before encrypting them.
+        :param topic_compression: optional compression settings per topic (overriding ``compression``,
+            with ``None`` to not compress payloads of a topic).
+        :param history: optional :class:`history.EventHistory` to keep the (encrypted) events published in.
+        :param metrics: optional :class:`metrics.MetricsRegistry` to count payloads and events published,
+            bytes published, and the latency of encrypting and publishing events in.
+        :param trace: Publish trace metadata with every event (keyword argument ``trace``, see
+            :class:`tracing.EventTracer`), which buyers must accept.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._session = session
+        self._seller = seller
+        self._interval = 1. / rate if rate else 0
+        self._on_published = on_published
+        self._executor = executor
+        self._codec = codec
+        self._compression = compression
+        self._topic_compression = topic_compression or {}
+        self._history = history
+        self._batch_size = max(1, batch_size)
+        self._batch_delay = batch_delay
+
+        self._queue = DeferredQueue()
+        self._slots = DeferredSemaphore(queue_size)
+        self._inflight = DeferredSemaphore(max_inflight)
+        self._pending = set()
+        # publications in queue order: [topic, payloads, wrapped result (or failure), done, time started,
+        # wall clock time started (traced)]
+        self._ordered = deque()
+        # batches being filled: (api_id, topic) -> (payloads, callbacks), and timers publishing them after the
+        # batch delay
+        self._batches = {}
+        self._batch_timers = {}
+        # batches published from timers, waiting for a publication slot
+        self._batching = set()
+        self._running = False
+
+        self.published = 0
+        self.failed = 0
+
+        # traced events are numbered per topic, in a stream of this publisher
+        self._trace = trace
+        self._trace_stream = new_stream() if trace else None
+        self._trace_seq = {}
+
+        self._metrics = metrics is not None
+        if self._metrics:
+            self._published_total = metrics.counter('xbr_seller_payloads_published_total',
+                                                    'Payloads published (and acknowledged).')
+            self._failed_total = metrics.counter('xbr_seller_payloads_failed_total',
+                                                 'Payloads that failed to encrypt or publish.')
+            self._bytes_total = metrics.counter('xbr_seller_bytes_published_total',
+                                                'Bytes of encrypted event payloads published.')
+            self._event_bytes = metrics.histogram('xbr_seller_event_bytes',
+                                                  'Size of encrypted event payloads published.', SIZE_BUCKETS)
+            self._wrap_seconds = metrics.histogram('xbr_seller_wrap_seconds',
+                                                   'Time to serialize and encrypt events (including waiting for '
+                                                   'earlier events, to keep their order).')
+            self._publish_seconds = metrics.histogram('xbr_seller_publish_seconds',
+                                                      'Time to encrypt and publish events, until publications '
+                                                      'are acknowledged.')
+            metrics.gauge('xbr_seller_queued', 'Payloads queued for publishing.', lambda: self.queued)
+            metrics.gauge('xbr_seller_inflight', 'Publications not yet acknowledged.', lambda: self.inflight)
+
+    @property
+    def queued(self):
+        """
+        Number of payloads queued.
+        """
+        return self._slots.limit - self._slots.tokens
+
+    @property
+    def inflight(self):
+        """
+        Number of publications not yet acknowledged.
+        """
+        return len(self._pending)
+
+    async def put(self, api_id, topic, payload, on_done=None):
+        """
+        Queue a payload for publishing, waiting for the queue to have space.
+
+        :param api_id: The API the topic belongs to (and the payload is encrypted for).
+        :param topic: The topic to publish to.
+        :param payload: The (unencrypted) application payload.
+        :param on_done: optional callback ``on_done(published)`` fired when the publication of the payload is
+            acknowledged (``True``) or failed (``False``). Not fired for payloads still queued when stopped.
+        """
+        await self._slots.acquire()
+        self._queue.put((api_id, topic, payload, on_done))
+
+    def put_nowait(self, api_id, topic, payload, on_done=None):
+        """
+        Queue a payload for publishing.
+
+        :raises twisted.internet.defer.QueueOverflow: The queue is full.
+        """
+        if not self._slots.tokens:
+            raise QueueOverflow()
+        # a token is available, so this acquires synchronously
+        self._slots.acquire()
+        self._queue.put((api_id, topic, payload, on_done))
+
+    async def run(self):
+        """
+        Run the publishing pipeline until stopped. Pending publications are waited for before returning.
+        """
+        assert not self._running
+        self._running = True
+        next_slot = self._reactor.seconds()
+        try:
+            while self._running:
+                item = await self._queue.get()
+                if item is None:
+                    break
+                self._slots.release()
+
+                if self._interval:
+                    now = self._reactor.seconds()
+                    ahead = next_slot - now
+                    if ahead > self.PACING_GRANULARITY:
+                        await sleep(ahead)
+                    next_slot = max(now - self.PACING_GRANULARITY, next_slot) + self._interval
+
+                api_id, topic, payload, on_done = item
+                batch = self._add_to_batch(api_id, topic, payload, on_done)
+                if batch:
+                    await self._publish_batch(api_id, topic, batch)
+        finally:
+            self._running = False
+            # payloads taken from the queue already are published in partial batches
+            batches = [(api_id, topic, self._take_batch(api_id, topic)) for api_id, topic in list(self._batches)]
+            for api_id, topic, batch in batches:
+                await self._publish_batch(api_id, topic, batch)
+            await self.flush()
+
+    def stop(self):
+        """
+        Stop the publishing pipeline (payloads still queued are not published).
+        """
+        if self._running:
+            self._running = False
+            self._queue.put(None)
+
+    async def flush(self):
+        """
+        Wait for all publications in flight to be acknowledged (or fail).
+        """
+        if self._batching:
+            await DeferredList(list(self._batching))
+        if self._pending:
+            await DeferredList(list(self._pending))
+
+    def _add_to_batch(self, api_id, topic, payload, on_done):
+        # returns the batch (payloads, and callbacks fired when published) when it is full and to be published
+        if self._batch_size == 1:
+            return [payload], [on_done] if on_done else []
+        key = (api_id, topic)
+        batch = self._batches.get(key, None)
+        if batch is None:
+            batch = self._batches[key] = ([], [])
+            if self._batch_delay is not None:
+                self._batch_timers[key] = self._reactor.callLater(self._batch_delay, self._on_batch_delay,
+                                                                  api_id, topic)
+        batch[0].append(payload)
+        if on_done:
+            batch[1].append(on_done)
+        if len(batch[0]) >= self._batch_size:
+            return self._take_batch(api_id, topic)
+        return None
+
+    def _take_batch(self, api_id, topic):
+        timer = self._batch_timers.pop((api_id, topic), None)
+        if timer and timer.active():
+            timer.cancel()
+        return self._batches.pop((api_id, topic))
+
+    def _on_batch_delay(self, api_id, topic):
+        del self._batch_timers[(api_id, topic)]
+        d = ensureDeferred(self._publish_batch(api_id, topic, self._batches.pop((api_id, topic))))
+        self._batching.add(d)
+
+        def done(result):
+            self._batching.discard(d)
+            return result
+
+        d.addBoth(done)
+        d.addErrback(lambda fail: self.log.failure('Publishing batch to {topic} failed', failure=fail, topic=topic))
+
+    async def _publish_batch(self, api_id, topic, batch):
+        await self._inflight.acquire()
+        try:
+            self._publish(api_id, topic, batch)
+        except Exception:
+            self._inflight.release()
+            raise
+
+    def _publish(self, api_id, topic, batch):
+        batch, callbacks = batch
+        done = Deferred()
+        started = time.perf_counter() if self._metrics else None
+
+        def published(pub):
+            self.published += len(batch)
+            if self._metrics:
+                self._published_total.inc(len(batch))
+                self._publish_seconds.observe(time.perf_counter() - started)
+            if self._on_published:
+                for payload in batch:
+                    self._on_published(pub, topic, payload)
+            for on_done in callbacks:
+                on_done(True)
+
+        def failed(fail):
+            self.failed += len(batch)
+            if self._metrics:
+                self._failed_total.inc(len(batch))
+            self.log.warn('Publishing to {topic} failed: {error}', topic=topic, error=fail.getErrorMessage())
+            for on_done in callbacks:
+                on_done(False)
+
+        def finished(_):
+            self._pending.discard(done)
+            self._inflight.release()
+
+        done.addCallbacks(published, failed)
+        done.addBoth(finished)
+        self._pending.add(done)
+
+        entry = [topic, batch, None, done, started, time.time_ns() if self._trace else None]
+        self._ordered.append(entry)
+
+        compression = self._topic_compression.get(topic, self._compression)
+        key = self._current_key(api_id) if self._executor else None
+        if key:
+            future = self._executor.submit(encrypt_payload, key[0], key[1], batch, self._codec, compression)
+            future.add_done_callback(lambda f: self._reactor.callFromThread(self._on_encrypted, entry, f))
+        else:
+            d = ensureDeferred(self._seller.wrap(api_id, topic, payloads.pack(batch, self._codec, compression)))
+            d.addBoth(self._on_wrapped, entry)
+
+    def _current_key(self, api_id):
+        # this reads the seller's current key for the API on the reactor thread, which is where keys are rotated,
+        # so a payload encrypted off-thread always has the key ID of the key it was encrypted with. when the key
+        # is not accessible, payloads are wrapped by the seller on the reactor thread.
+        try:
+            keyseries = self._seller._keys[api_id]
+            key_id, box = keyseries._id, keyseries._box
+        except (AttributeError, KeyError):
+            return None
+        if key_id is None or box is None:
+            return None
+        return key_id, bytes(box)
+
+    def _on_encrypted(self, entry, future):
+        try:
+            result = future.result()
+        except Exception:
+            result = Failure()
+        self._on_wrapped(result, entry)
+
+    def _on_wrapped(self, result, entry):
+        entry[2] = result
+
+        # publish everything wrapped at the head of the queue order
+        while self._ordered and self._ordered[0][2] is not None:
+            topic, _, wrapped, done, started, started_ns = self._ordered.popleft()
+            if isinstance(wrapped, Failure):
+                done.errback(wrapped)
+                continue
+            key_id, enc_ser, ciphertext = wrapped
+            if self._metrics:
+                self._wrap_seconds.observe(time.perf_counter() - started)
+                self._bytes_total.inc(len(ciphertext))
+                self._event_bytes.observe(len(ciphertext))
+            try:
+                if self._trace:
+                    seq = self._trace_seq.get(topic, 0)
+                    self._trace_seq[topic] = seq + 1
+                    d = self._session.publish(topic, key_id, enc_ser, ciphertext,
+                                              trace=[self._trace_stream, seq, started_ns, time.time_ns()],
+                                              options=PublishOptions(acknowledge=True))
+                else:
+                    d = self._session.publish(topic, key_id, enc_ser, ciphertext,
+                                              options=PublishOptions(acknowledge=True))
+            except Exception:
+                done.errback(Failure())
+            else:
+                if self._history is not None:
+                    d.addCallback(self._remember, topic, wrapped)
+                d.chainDeferred(done)
+
+    def _remember(self, pub, topic, wrapped):
+        self._history.append(topic, pub.id, *wrapped)
+        return pub
@@ -0,0 +1,248 @@
+# coding=utf8
+
+# receiving pipeline for XBR buyer delegates: events are queued (bounded), decrypted (and decoded) by a
+# pool of workers, and delivered to the application in the order received
+
+import time
+
+import cbor2
+import nacl.secret
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.internet.defer import Deferred, DeferredList, DeferredQueue, QueueOverflow, ensureDeferred
+
+import payloads
+from metrics import SIZE_BUCKETS
+
+
+def decrypt_payload(key, ciphertext):
+    """
+    Decrypt and deserialize an event payload with a XBR data encryption key, exactly like the buyer
+    does in ``unwrap()``, and unpack and decode it (see :mod:`payloads`). This is a plain function,
+    so it can run in a thread or process pool.
+
+    :param key: The (raw) data encryption key.
+    :param ciphertext: The encrypted event payload.
+    :return: List of the application payloads (more than one for a batch of payloads).
+    """
+    box = nacl.secret.SecretBox(key)
+    return payloads.unpack(cbor2.loads(box.decrypt(ciphertext)))
+
+
+class QueueReceiver(object):
+    """
+    Receives XBR encrypted events into a bounded queue, from where a pool of workers decrypts them.
+
+    Decrypted payloads are delivered to the application in the order events were received, with the
+    payloads of a batch delivered one by one. When the queue is full, newly received events are dropped
+    (and counted), so a burst of events cannot grow the backlog (and event latency) without limit.
+
+    This is a drop policy rather than backpressure on purpose: pausing the transport (or unsubscribing) while
+    the queue is full would also hold back the results of the calls buying keys, which go over the same
+    session and which queued events may be waiting for, so the receiver could not drain the queue anymore.
+    """
+    log = make_logger()
+
+    def __init__(self, buyer, on_payload, reactor=None, workers=4, queue_size=1000, executor=None, metrics=None,
+                 tracer=None, topic=None):
+        """
+
+        :param buyer: XBR buyer (:class:`autobahn.twisted.xbr.SimpleBuyer`) to decrypt events with.
+        :param on_payload: Callback ``on_payload(payload, key_id, details)`` fired for every payload decrypted.
+        :param reactor: Twisted reactor to run under.
+        :param workers: Number of events decrypted concurrently.
+        :param queue_size: Maximum number of events queued (not yet decrypted).
+        :param executor: optional :class:`concurrent.futures.Executor` (thread or process pool) to decrypt and
+            deserialize events in, keeping the reactor free. Events for keys not bought yet are always unwrapped
+            (buying the key) on the reactor.
+        :param metrics: optional :class:`metrics.MetricsRegistry` to count events received, dropped and
+            delivered, bytes received, and the latency of decrypting events (including buying keys) in.
+        :param tracer: optional :class:`tracing.EventTracer` to trace events received with trace metadata with.
+        :param topic: Topic of events received without topic in the event details (exact subscriptions).
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._buyer = buyer
+        self._on_payload = on_payload
+        self._workers = workers
+        self._executor = executor
+        self._tracer = tracer
+        self._topic = topic
+
+        self._queue = DeferredQueue(size=queue_size)
+        self._running = False
+
+        # events are numbered when received, and delivered strictly in that order
+        self._next_received = 0
+        self._next_delivered = 0
+        # seq -> (payloads, key_id, details) or None for an event that failed to decrypt
+        self._decrypted = {}
+
+        self.received = 0
+        self.dropped = 0
+        self.delivered = 0
+        self.failed = 0
+
+        self._metrics = metrics is not None
+        if self._metrics:
+            self._received_total = metrics.counter('xbr_buyer_events_received_total', 'Events received.')
+            self._dropped_total = metrics.counter('xbr_buyer_events_dropped_total',
+                                                  'Events dropped (the receive queue was full).')
+            self._failed_total = metrics.counter('xbr_buyer_events_failed_total', 'Events that failed to decrypt.')
+            self._delivered_total = metrics.counter('xbr_buyer_payloads_delivered_total',
+                                                    'Payloads decrypted and delivered.')
+            self._bytes_total = metrics.counter('xbr_buyer_bytes_received_total',
+                                                'Bytes of encrypted event payloads received.')
+            self._event_bytes = metrics.histogram('xbr_buyer_event_bytes',
+                                                  'Size of encrypted event payloads received.', SIZE_BUCKETS)
+            self._unwrap_seconds = metrics.histogram('xbr_buyer_unwrap_seconds',
+                                                     'Time to decrypt and deserialize events (including buying '
+                                                     'keys not bought yet).')
+            metrics.gauge('xbr_buyer_queued', 'Events queued for decrypting.', lambda: self.queued)
+            metrics.gauge('xbr_buyer_reordering', 'Events decrypted, waiting for earlier events to be delivered.',
+                          lambda: self.reordering)
+
+    @property
+    def queued(self):
+        """
+        Number of events queued (not yet being decrypted).
+        """
+        return len(self._queue.pending)
+
+    @property
+    def reordering(self):
+        """
+        Number of events decrypted, but waiting for earlier events to be delivered first.
+        """
+        return len(self._decrypted)
+
+    def stats(self):
+        """
+        :return: Event counters and current queue depth.
+        """
+        return {
+            'received': self.received,
+            'dropped': self.dropped,
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'queued': self.queued,
+            'reordering': self.reordering,
+        }
+
+    def on_event(self, key_id, enc_ser, ciphertext, details=None, trace=None):
+        """
+        WAMP event handler to subscribe with. Queues the event, or drops (and counts) it if the queue is full:
+        delivery is never paused (see :class:`QueueReceiver`).
+        """
+        self.received += 1
+        received_ns = None
+        if trace is not None and self._tracer is not None:
+            received_ns = time.time_ns()
+            self._tracer.received((details.topic if details else None) or self._topic, trace)
+        if self._metrics:
+            self._received_total.inc()
+            self._bytes_total.inc(len(ciphertext))
+            self._event_bytes.observe(len(ciphertext))
+        try:
+            self._queue.put((self._next_received, key_id, enc_ser, ciphertext, details, trace, received_ns))
+        except QueueOverflow:
+            self.dropped += 1
+            if self._metrics:
+                self._dropped_total.inc()
+        else:
+            self._next_received += 1
+
+    async def run(self):
+        """
+        Run the decrypting workers until stopped.
+        """
+        assert not self._running
+        self._running = True
+        try:
+            await DeferredList([ensureDeferred(self._worker()) for _ in range(self._workers)])
+        finally:
+            self._running = False
+
+    def stop(self):
+        """
+        Stop the decrypting workers (events still queued are not delivered).
+        """
+        if self._running:
+            self._running = False
+            # drop queued events and wake up all idle workers
+            del self._queue.pending[:]
+            for _ in range(self._workers):
+                try:
+                    self._queue.put(None)
+                except QueueOverflow:
+                    break
+
+    async def _worker(self):
+        while self._running:
+            item = await self._queue.get()
+            if item is None:
+                break
+            seq, key_id, enc_ser, ciphertext, details, trace, received_ns = item
+            started = time.perf_counter() if self._metrics else None
+            if received_ns is not None:
+                dequeued_ns = time.time_ns()
+                # keys not bought yet (or being bought) are fetched first
+                key_fetched = not isinstance(getattr(self._buyer, '_keys', {}).get(key_id, None),
+                                             nacl.secret.SecretBox)
+            try:
+                items = await self._decrypt(key_id, enc_ser, ciphertext)
+            except Exception as e:
+                self.failed += 1
+                if self._metrics:
+                    self._failed_total.inc()
+                self.log.warn('Failed to decrypt event (key_id={key_id}): {error}', key_id=key_id, error=e)
+                self._decrypted[seq] = None
+            else:
+                if self._metrics:
+                    self._unwrap_seconds.observe(time.perf_counter() - started)
+                if received_ns is not None:
+                    self._tracer.decrypted((details.topic if details else None) or self._topic, trace, received_ns,
+                                           dequeued_ns, time.time_ns(), key_fetched)
+                self._decrypted[seq] = (items, key_id, details)
+            self._deliver()
+
+    async def _decrypt(self, key_id, enc_ser, ciphertext):
+        if self._executor and enc_ser == 'cbor':
+            # the buyer's keys are only accessed on the reactor thread: when the key was bought already,
+            # decrypt off the reactor (not while the key is being bought, or after buying it failed)
+            box = getattr(self._buyer, '_keys', {}).get(key_id, None)
+            if isinstance(box, nacl.secret.SecretBox):
+                d = Deferred()
+                future = self._executor.submit(decrypt_payload, bytes(box), ciphertext)
+                future.add_done_callback(lambda f: self._reactor.callFromThread(self._on_decrypted, d, f))
+                return await d
+        return payloads.unpack(await self._buyer.unwrap(key_id, enc_ser, ciphertext))
+
+    def _on_decrypted(self, d, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            d.errback(e)
+        else:
+            d.callback(result)
+
+    def _deliver(self):
+        while self._next_delivered in self._decrypted:
+            decrypted = self._decrypted.pop(self._next_delivered)
+            self._next_delivered += 1
+            if decrypted is None:
+                continue
+            items, key_id, details = decrypted
+            if self._metrics:
+                self._delivered_total.inc(len(items))
+            for payload in items:
+                self.delivered += 1
+                try:
+                    self._on_payload(payload, key_id, details)
+                except Exception:
+                    self.log.failure()
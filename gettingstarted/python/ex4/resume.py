@@ -0,0 +1,206 @@
+# coding=utf8
+
+# fast reconnect for XBR delegates: state looked up when joining (the market maker configuration, and the
+# buyer with its payment channel state) is kept across reconnects, and sessions rejoin with exponential
+# backoff (and jitter) rather than repeating the full startup after every reconnect
+
+import time
+import uuid
+import binascii
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from twisted.internet.defer import DeferredList, ensureDeferred
+
+
+class SessionState(object):
+    """
+    State of a delegate kept across reconnects in a plain dict, e.g. the session config extra (which
+    outlives the session instances ``ApplicationRunner`` creates for every reconnect).
+
+    Entries expire after a time-to-live, so state is validated (looked up again) periodically, and
+    are dropped when the delegate fails to join, so state is looked up again on the next join.
+    """
+    log = make_logger()
+
+    def __init__(self, store, ttl=300., clock=time.monotonic):
+        """
+
+        :param store: The dict to keep state in.
+        :param ttl: Time (in seconds) after which state is looked up again.
+        :param clock: Function returning the current time in seconds.
+        """
+        self._store = store
+        self._ttl = ttl
+        self._clock = clock
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        """
+        Get a state entry.
+
+        :param name: Name of the entry.
+        :return: The value, or ``None`` if not kept (or expired).
+        """
+        entry = self._store.get(name, None)
+        if entry is None or self._clock() - entry[1] > self._ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def put(self, name, value):
+        """
+        Keep a state entry.
+
+        :param name: Name of the entry.
+        :param value: The value.
+        """
+        self._store[name] = (value, self._clock())
+
+    def invalidate(self, name=None):
+        """
+        Drop a state entry, or all state entries.
+
+        :param name: Name of the entry to drop, or ``None`` for all.
+        """
+        if name is None:
+            self._store.clear()
+        else:
+            self._store.pop(name, None)
+
+    async def get_config(self, session):
+        """
+        Get the market maker configuration (kept across reconnects).
+
+        :param session: WAMP session to call the market maker on.
+        :return: Tuple ``(config, market_maker_adr)``.
+        """
+        config = self.get('marketmaker_config')
+        if config is None:
+            config = await session.call('xbr.marketmaker.get_config')
+            self.put('marketmaker_config', config)
+        return config, binascii.a2b_hex(config['marketmaker'][2:])
+
+    async def resume_buyer(self, session, market_maker_adr, authid, make_buyer):
+        """
+        Resume the buyer of a previous session (with its payment channel, balance and keys), or create
+        and start a new buyer when none is kept, or the buyer kept is for another market maker or delegate.
+
+        The payment channel of a buyer resumed is validated with the market maker while the session continues
+        joining: the balance and sequence number are updated, and when the active payment channel changed, the
+        buyer continues on the new channel (and is not resumed anymore).
+
+        :param session: WAMP session the buyer calls the market maker on.
+        :param market_maker_adr: Address of the market maker.
+        :param authid: WAMP authid of the session (the consumer ID).
+        :param make_buyer: Function returning a new (not started) buyer.
+        :return: Tuple ``(buyer, balance, validated)``, with the remaining balance of the payment channel (or
+            ``None`` when the buyer was resumed), and a Deferred fired with the remaining balance when the buyer
+            resumed was validated (or ``None`` for a new buyer).
+        """
+        kept = self.get('buyer')
+        if kept is not None:
+            buyer, kept_adr, kept_authid = kept
+            if kept_adr == market_maker_adr and kept_authid == authid:
+                # the buyer only keeps the session to call the market maker (e.g. to buy keys)
+                buyer._session = session
+                self.log.info('Resumed buyer (payment channel and keys of the previous session)')
+                return buyer, None, ensureDeferred(self._validate_buyer(session, buyer))
+
+        buyer = make_buyer()
+        balance = await buyer.start(session, authid)
+        self.put('buyer', (buyer, market_maker_adr, authid))
+        return buyer, balance, None
+
+    async def _validate_buyer(self, session, buyer):
+        # the active payment channel and the balance of the channel kept are looked up concurrently (the
+        # balance of the channel kept fails to look up when the channel was closed meanwhile)
+        channel_oid = buyer._channel['channel_oid']
+        (channel_ok, channel), (balance_ok, balance) = await DeferredList([
+            session.call('xbr.marketmaker.get_active_payment_channel', buyer._addr),
+            session.call('xbr.marketmaker.get_payment_channel_balance', channel_oid),
+        ], consumeErrors=True)
+        if not channel_ok:
+            channel.raiseException()
+
+        if not channel or channel['channel_oid'] != channel_oid:
+            # look up the buyer again on the next join, and continue on the new channel (like a new buyer)
+            self.invalidate('buyer')
+            if not channel:
+                raise Exception('no active payment channel found')
+            self.log.warn('Active payment channel changed from {old} to {new}: buyer not resumed anymore',
+                          old=uuid.UUID(bytes=channel_oid), new=uuid.UUID(bytes=channel['channel_oid']))
+            balance = await session.call('xbr.marketmaker.get_payment_channel_balance', channel['channel_oid'])
+            buyer._channel = channel
+            buyer._channel_oid = uuid.UUID(bytes=channel['channel_oid'])
+        elif not balance_ok:
+            balance.raiseException()
+
+        remaining = balance['remaining']
+        if type(remaining) == bytes:
+            remaining = int.from_bytes(remaining, 'big')
+        if not remaining > 0:
+            self.invalidate('buyer')
+            raise Exception('no off-chain balance remaining on payment channel')
+        buyer._balance = remaining
+        buyer._seq = balance['seq']
+        return remaining
+
+
+def add_reconnect_arguments(parser):
+    """
+    Add the command line options for reconnecting to an argument parser.
+
+    :param parser: The :class:`argparse.ArgumentParser`.
+    """
+    parser.add_argument('--retry_delay',
+                        dest='retry_delay',
+                        type=float,
+                        default=0.2,
+                        help='Delay in seconds before the first attempt to reconnect (default: 0.2).')
+
+    parser.add_argument('--retry_max_delay',
+                        dest='retry_max_delay',
+                        type=float,
+                        default=30,
+                        help='Maximum delay in seconds between attempts to reconnect (default: 30).')
+
+    parser.add_argument('--retry_growth',
+                        dest='retry_growth',
+                        type=float,
+                        default=1.5,
+                        help='Growth factor of the delay between attempts to reconnect (default: 1.5).')
+
+    parser.add_argument('--retry_jitter',
+                        dest='retry_jitter',
+                        type=float,
+                        default=0.1,
+                        help='Maximum random jitter in seconds added to the delay between attempts to reconnect '
+                             '(default: 0.1).')
+
+    parser.add_argument('--state_ttl',
+                        dest='state_ttl',
+                        type=float,
+                        default=300,
+                        help='Time in seconds state looked up when joining is kept across reconnects (default: 300).')
+
+
+def reconnect_options(args):
+    """
+    :param args: The parsed command line options (see :func:`add_reconnect_arguments`).
+    :return: Keyword arguments for ``ApplicationRunner``: exponential backoff (with jitter) between attempts
+        to reconnect, retrying forever.
+    """
+    return {
+        'max_retries': -1,
+        'initial_retry_delay': args.retry_delay,
+        'max_retry_delay': args.retry_max_delay,
+        'retry_delay_growth': args.retry_growth,
+        'retry_delay_jitter': args.retry_jitter,
+    }
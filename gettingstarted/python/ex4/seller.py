@@ -3,14 +3,13 @@
 # connect to WAMP router, join a XBR realm (with WAMP-cryptosign authentication), and publish (XBR encrypted) events
 # to a topic selling data encryption keys
 
+import os
 import sys
-import pyqrcode
 import argparse
-import binascii
 import uuid
-
-import eth_keys
-import web3
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import txaio
 txaio.use_twisted()
@@ -18,14 +17,48 @@ txaio.use_twisted()
 from twisted.internet import reactor
 from twisted.internet.error import ReactorNotRunning
 
-from autobahn.twisted.util import sleep
-from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
-from autobahn.twisted.xbr import SimpleSeller
+from twisted.internet.defer import ensureDeferred, gatherResults
+from twisted.internet.task import LoopingCall
+from twisted.web.server import Site
 
+from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
 from autobahn.wamp.serializer import CBORSerializer
-from autobahn.wamp.types import PublishOptions
 from autobahn.wamp import cryptosign
-from autobahn.xbr import unpack_uint256, load_or_create_profile
+
+# helpers shared by the examples (common/) are imported from the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from publisher import QueuePublisher
+from catalogue import load_catalogue, load_compression
+import compressors
+import payloads
+from history import EventHistory
+from outbox import Outbox, OutboxDrainer, OutboxFull
+from resume import SessionState, add_reconnect_arguments, reconnect_options
+from common.keyindex import KeyIndex, add_keyindex_arguments, get_address, print_address
+from common.profile import load_profile, unpack_uint256
+from metrics import DelegateMetrics, MetricsRegistry, MetricsResource, add_metrics_arguments
+from common.eventlog import add_eventlog_arguments, add_eventlog_metrics, open_eventlog
+
+
+def load_apis(catalogue=None):
+    """
+    Load the APIs to sell from a catalogue file, or the example API (when no catalogue is given).
+
+    :param catalogue: optional path of the catalogue file.
+    :return: List of APIs ``(api_id, prefix, price, interval, topics)``.
+    """
+    if catalogue:
+        return load_catalogue(catalogue)
+
+    api_id = uuid.UUID('627f1b5c-58c2-43b1-8422-a34f7d3f5a04').bytes
+    topic = 'io.crossbar.example'
+
+    # 5 XBR / 10s
+    price = 5 * 10 ** 18
+    interval = 10
+
+    return [(api_id, topic, price, interval, [topic])]
 
 
 class XbrDelegate(ApplicationSession):
@@ -33,10 +66,18 @@ class XbrDelegate(ApplicationSession):
     def __init__(self, config=None):
         ApplicationSession.__init__(self, config)
         self._ethkey_raw = config.extra['ethkey']
-        self._ethkey = eth_keys.keys.PrivateKey(self._ethkey_raw)
-        self._ethadr = web3.Web3.toChecksumAddress(self._ethkey.public_key.to_canonical_address())
+        # the address is derived once per key, and then looked up in the key index
+        self._ethadr_raw, self._ethadr = get_address(self._ethkey_raw,
+                                                     config.extra.get('keyindex', KeyIndex.DEFAULT_PATH))
         self._key = cryptosign.SigningKey.from_key_bytes(config.extra['cskey'])
         self._running = True
+        self._stopping = False
+        self._drainer = None
+        self._seller = None
+        # state kept across reconnects
+        self._state = SessionState(config.extra.setdefault('state', {}), ttl=config.extra.get('state_ttl', 300))
+        # metrics (kept across reconnects)
+        self._metrics = DelegateMetrics(config.extra['metrics']) if config.extra.get('metrics', None) else None
 
     def onUserError(self, fail, msg):
         self.log.error(msg)
@@ -47,57 +88,111 @@ class XbrDelegate(ApplicationSession):
 
         try:
             delegate_key = self._ethkey_raw
-            delegate_adr = self._ethkey.public_key.to_canonical_address()
+            delegate_adr = self._ethadr_raw
             print('Using delegate adr:', delegate_adr)
 
-            config = await self.call('xbr.marketmaker.get_config')
+            # the market maker configuration is looked up once, and then kept across reconnects
+            config, market_maker_adr = await self._state.get_config(self)
             print('Using market maker adr:', config['marketmaker'])
 
-            market_maker_adr = binascii.a2b_hex(config['marketmaker'][2:])
-
-            api_id = uuid.UUID('627f1b5c-58c2-43b1-8422-a34f7d3f5a04').bytes
-            topic = 'io.crossbar.example'
+            # imported only now, as autobahn.twisted.xbr imports web3 and eth_keys (which takes seconds)
+            from autobahn.twisted.xbr import SimpleSeller
+            from catalogueseller import CatalogueSeller
+
+            catalogue = self.config.extra.get('catalogue', None)
+            apis = load_apis(catalogue)
+            if catalogue:
+                # many APIs (and topics), with keys of all APIs rotated from one timer wheel
+                seller = CatalogueSeller(market_maker_adr, delegate_key)
+                seller.add_catalogue(apis)
+            else:
+                seller = SimpleSeller(market_maker_adr, delegate_key)
+                for api_id, prefix, price, interval, _ in apis:
+                    seller.add(api_id, prefix, price, interval, None)
+
+            topics = [(api_id, topic) for api_id, _, _, _, api_topics in apis for topic in api_topics]
             counter = 1
 
-            # 5 XBR / 10s
-            price = 5 * 10 ** 18
-            interval = 10
-
-            seller = SimpleSeller(market_maker_adr, delegate_key)
-            seller.add(api_id, topic, price, interval, None)
-
-            balance = await seller.start(self)
+            # the seller is started, and the history procedure registered, concurrently
+            self._seller = seller
+            starting = [ensureDeferred(seller.start(self))]
+            history = self.config.extra.get('history', None)
+            if history is not None:
+                # buyers (re-)connecting catch up on the events published recently from the history
+                starting.append(self.register(history.since, self.config.extra['history_procedure']))
+            if self._metrics and self.config.extra.get('metrics_procedure', None):
+                starting.append(self.register(self._metrics.registry.snapshot,
+                                              self.config.extra['metrics_procedure']))
+            balance, *_ = await gatherResults(starting, consumeErrors=True)
             balance = int(balance / 10 ** 18)
             print("Remaining balance: {} XBR".format(balance))
-
-            self.log.info('Seller session ready! Starting to publish events ..')
-            running = True
-            while running:
-                payload = {'data': 'py-seller', 'counter': counter}
-                key_id, enc_ser, ciphertext = await seller.wrap(api_id,
-                                                                topic,
-                                                                payload)
-
-                pub = await self.publish(topic, key_id, enc_ser, ciphertext,
-                                         options=PublishOptions(acknowledge=True))
-
-                print('Published event {}: {}'.format(pub.id, payload))
-
-                counter += 1
-                await sleep(1)
+            if self._metrics:
+                self._metrics.joined()
+                self._metrics.balance(balance)
+
+            # events published are logged (sampled) off the reactor, rather than printed one by one
+            eventlog = self.config.extra.get('eventlog', None)
+
+            def on_published(pub, topic, payload):
+                eventlog.event('published', publication=pub.id, topic=topic, payload=payload)
+
+            # payloads are queued, and then encrypted and published at the target rate
+            publisher = QueuePublisher(self, seller,
+                                       max_inflight=self.config.extra.get('max_inflight', 64),
+                                       rate=self.config.extra.get('rate', 1),
+                                       on_published=on_published if eventlog else None,
+                                       executor=self.config.extra.get('executor', None),
+                                       codec=self.config.extra.get('codec', None),
+                                       batch_size=self.config.extra.get('batch_size', 1),
+                                       batch_delay=self.config.extra.get('batch_delay', None),
+                                       compression=self.config.extra.get('compression', None),
+                                       topic_compression=self.config.extra.get('topic_compression', None),
+                                       history=self.config.extra.get('history', None),
+                                       metrics=self._metrics.registry if self._metrics else None,
+                                       trace=self.config.extra.get('trace', False))
+            publishing = ensureDeferred(publisher.run())
+
+            outbox = self.config.extra.get('outbox', None)
+            if outbox is not None:
+                # events are produced into the outbox (also while disconnected), and published from there
+                self.log.info('Seller session ready! Starting to publish events from the outbox ..')
+                self._drainer = OutboxDrainer(outbox, publisher)
+                await self._drainer.run()
+            else:
+                self.log.info('Seller session ready! Starting to publish events to {count} topics ..',
+                              count=len(topics))
+                while self._running:
+                    for api_id, topic in topics:
+                        payload = {'data': 'py-seller', 'counter': counter}
+                        await publisher.put(api_id, topic, payload)
+                    counter += 1
+
+            publisher.stop()
+            await publishing
         except Exception as e:
             self.log.failure()
             self.config.extra['error'] = e
-        finally:
+            # look up all state again on the next join
+            self._state.invalidate()
             self.leave()
 
     def onLeave(self, details):
         self.log.info('{klass}.onLeave(details={details})', klass=self.__class__.__name__, details=details)
 
         self._running = False
+        if self._drainer:
+            self._drainer.stop()
+        # the seller rotates keys and places offers through this session: a new one is started when rejoining
+        if self._seller:
+            seller, self._seller = self._seller, None
+            d = ensureDeferred(seller.stop())
+            d.addErrback(lambda fail: self.log.warn('Failed to stop seller: {error}', error=fail.getErrorMessage()))
+        if self._metrics:
+            self._metrics.left()
 
         if details.reason == 'wamp.close.normal':
             self.log.info('Shutting down ..')
+            self._stopping = True
             # user initiated leave => end the program
             self.config.runner.stop()
             self.disconnect()
@@ -108,10 +203,12 @@ class XbrDelegate(ApplicationSession):
     def onDisconnect(self):
         self.log.info('{klass}.onDisconnect()', klass=self.__class__.__name__)
 
-        try:
-            reactor.stop()
-        except ReactorNotRunning:
-            pass
+        # only stop when leaving (normally): when the connection was lost, ApplicationRunner reconnects
+        if self._stopping:
+            try:
+                reactor.stop()
+            except ReactorNotRunning:
+                pass
 
 
 if __name__ == '__main__':
@@ -123,6 +220,104 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Enable debug output.')
 
+    parser.add_argument('--rate',
+                        dest='rate',
+                        type=float,
+                        default=1,
+                        help='Target rate of events published per second (default: 1).')
+
+    parser.add_argument('--max_inflight',
+                        dest='max_inflight',
+                        type=int,
+                        default=64,
+                        help='Maximum number of publications not yet acknowledged (default: 64).')
+
+    parser.add_argument('--catalogue',
+                        dest='catalogue',
+                        type=str,
+                        help='JSON file with the catalogue of APIs and topics to sell (default: one example API).')
+
+    parser.add_argument('--codec',
+                        dest='codec',
+                        type=str,
+                        choices=payloads.plain_codecs(),
+                        help='Codec to encode event payloads with, e.g. "msgpack" (default: none, plain CBOR).')
+
+    parser.add_argument('--batch_size',
+                        dest='batch_size',
+                        type=int,
+                        default=1,
+                        help='Maximum number of events per topic published as one batch (default: 1, no batching).')
+
+    parser.add_argument('--batch_delay',
+                        dest='batch_delay',
+                        type=float,
+                        default=10,
+                        help='Maximum time in ms an event waits for its batch to fill up (default: 10).')
+
+    parser.add_argument('--compression',
+                        dest='compression',
+                        type=str,
+                        help='Compress event payloads before encryption, "name[:level[:dictionary_file]]" with '
+                             'name one of zlib, zstd or lz4, e.g. "zstd:9:mobility.dict" (default: none).')
+
+    parser.add_argument('--topic_compression',
+                        dest='topic_compression',
+                        action='append',
+                        default=[],
+                        help='Compression of event payloads for one topic, "topic=name[:level[:dictionary_file]]" '
+                             'or "topic=" for none (can be repeated, overrides --compression and the catalogue).')
+
+    parser.add_argument('--history_events',
+                        dest='history_events',
+                        type=int,
+                        default=1000,
+                        help='Number of events per topic kept for buyers to catch up on (default: 1000, 0 to disable).')
+
+    parser.add_argument('--history_bytes',
+                        dest='history_bytes',
+                        type=int,
+                        default=2**20,
+                        help='Memory budget in bytes for the events kept per topic (default: 1MB).')
+
+    parser.add_argument('--history_procedure',
+                        dest='history_procedure',
+                        type=str,
+                        default='io.crossbar.example.history',
+                        help='Procedure to fetch the events kept (default: io.crossbar.example.history).')
+
+    parser.add_argument('--trace',
+                        action='store_true',
+                        help='Publish trace metadata with every event, for buyers to measure latency end-to-end '
+                             '(buyers must accept it).')
+
+    parser.add_argument('--outbox',
+                        dest='outbox',
+                        type=str,
+                        help='Path of a (memory-mapped) outbox file to produce events into, so events produced while '
+                             'disconnected are published after reconnecting (default: none).')
+
+    parser.add_argument('--outbox_size',
+                        dest='outbox_size',
+                        type=int,
+                        default=64 * 2**20,
+                        help='Size in bytes of the outbox file, bounding the events not yet published (default: 64MB).')
+
+    parser.add_argument('--wrap_workers',
+                        dest='wrap_workers',
+                        type=int,
+                        default=0,
+                        help='Number of workers to serialize and encrypt events in (default: 0, on the reactor).')
+
+    parser.add_argument('--wrap_processes',
+                        action='store_true',
+                        help='Use worker processes (rather than threads) to serialize and encrypt events.')
+
+    add_reconnect_arguments(parser)
+    add_keyindex_arguments(parser)
+    add_metrics_arguments(parser)
+    add_eventlog_arguments(parser)
+
     args = parser.parse_args()
 
     if args.debug:
@@ -130,21 +325,98 @@ if __name__ == '__main__':
     else:
         txaio.start_logging(level='info')
 
-    profile = load_or_create_profile()
+    profile = load_profile()
 
-    privkey = eth_keys.keys.PrivateKey(profile.ethkey)
-    adr_raw = privkey.public_key.to_canonical_address()
-    eth_adr = web3.Web3.toChecksumAddress(adr_raw)
-    eth_adr_qr = pyqrcode.create(eth_adr, error='L', mode='binary').terminal()
-    print('Delegate Ethereum address is {}:\n{}'.format(eth_adr, eth_adr_qr))
+    _, eth_adr = get_address(profile.ethkey, args.keyindex or None)
+    print_address(eth_adr, qrcode=not args.no_qrcode)
 
     extra = {
         'ethkey': profile.ethkey,
         'cskey': profile.cskey,
+        'keyindex': args.keyindex or None,
+        'rate': args.rate,
+        'max_inflight': args.max_inflight,
+        'catalogue': args.catalogue,
+        'codec': args.codec,
+        'batch_size': args.batch_size,
+        'batch_delay': args.batch_delay / 1000.,
+        'state_ttl': args.state_ttl,
+        'trace': args.trace,
     }
 
+    # the history outlives sessions, so buyers can catch up on events published before the seller reconnected
+    if args.history_events:
+        extra['history'] = EventHistory(max_events=args.history_events, max_bytes=args.history_bytes)
+        extra['history_procedure'] = args.history_procedure
+
+    # compression settings for all topics, for the topics of catalogue APIs, and for single topics
+    if args.compression:
+        extra['compression'] = compressors.parse_compression(args.compression)
+    topic_compression = load_compression(args.catalogue) if args.catalogue else {}
+    for setting in args.topic_compression:
+        topic, spec = setting.split('=', 1)
+        topic_compression[topic] = spec
+    extra['topic_compression'] = {topic: compressors.parse_compression(spec) if spec else None
+                                  for topic, spec in topic_compression.items()}
+
+    executor = None
+    if args.wrap_workers:
+        if args.wrap_processes:
+            # worker processes need the compression dictionaries loaded
+            executor = ProcessPoolExecutor(args.wrap_workers, mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=compressors.register_dictionaries,
+                                           initargs=(compressors.get_dictionaries(),))
+        else:
+            executor = ThreadPoolExecutor(args.wrap_workers)
+        extra['executor'] = executor
+
+    outbox = None
+    if args.outbox:
+        outbox = Outbox(args.outbox, size=args.outbox_size)
+        outbox.open()
+        extra['outbox'] = outbox
+
+        topics = [(api_id, topic) for api_id, _, _, _, api_topics in load_apis(args.catalogue)
+                  for topic in api_topics]
+        counter = itertools.count(1)
+
+        # events are produced at the target rate, independent of the seller being connected
+        def produce():
+            n = next(counter)
+            for api_id, topic in topics:
+                try:
+                    outbox.append(api_id, topic, {'data': 'py-seller', 'counter': n})
+                except OutboxFull:
+                    pass
+
+        reactor.callWhenRunning(LoopingCall(produce).start, len(topics) / args.rate if args.rate else 0)
+        reactor.callWhenRunning(LoopingCall(outbox.flush).start, 1., now=False)
+
+    # metrics outlive sessions, like the outbox
+    if args.metrics_port or args.metrics_procedure:
+        metrics = MetricsRegistry()
+        if outbox:
+            metrics.gauge('xbr_seller_outbox_bytes', 'Bytes of records in the outbox not yet published.',
+                          lambda: outbox.bytes)
+            metrics.counter('xbr_seller_outbox_dropped_total', 'Payloads dropped (the outbox was full).',
+                            lambda: outbox.dropped)
+        if 'history' in extra:
+            metrics.counter('xbr_seller_history_evicted_total', 'Events evicted from the history.',
+                            lambda: extra['history'].evicted)
+        extra['metrics'] = metrics
+        extra['metrics_procedure'] = args.metrics_procedure
+        if args.metrics_port:
+            reactor.listenTCP(args.metrics_port, Site(MetricsResource(metrics)), interface=args.metrics_interface)
+
+    # the event log outlives sessions, and writes the events logged when the reactor shuts down
+    eventlog = open_eventlog(args, reactor)
+    if eventlog:
+        extra['eventlog'] = eventlog
+        if 'metrics' in extra:
+            add_eventlog_metrics(extra['metrics'], eventlog)
+
     runner = ApplicationRunner(url=profile.market_url, realm=profile.market_realm, extra=extra,
-                               serializers=[CBORSerializer()])
+                               serializers=[CBORSerializer()], **reconnect_options(args))
 
     try:
         runner.run(XbrDelegate, auto_reconnect=True)
@@ -153,3 +425,8 @@ if __name__ == '__main__':
         sys.exit(1)
     else:
         sys.exit(0)
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
+        if outbox:
+            outbox.close()
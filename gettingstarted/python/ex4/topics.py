@@ -0,0 +1,117 @@
+# coding=utf8
+
+# dispatching of events received on (prefix or wildcard) pattern-based subscriptions to handlers per topic,
+# with per-topic event statistics
+
+from uuid import UUID
+
+
+class TopicRouter(object):
+    """
+    Routes events to handlers by topic, for events received on one (or few) pattern-based subscriptions,
+    rather than on one subscription per topic.
+
+    Handlers are registered for exact topics, topic prefixes or WAMP wildcard patterns (empty URI
+    components match any component). The handler for a topic is resolved once, and then cached, so
+    dispatching an event is a single dictionary lookup.
+    """
+
+    def __init__(self, default=None):
+        """
+
+        :param default: optional handler for events on topics with no handler registered.
+        """
+        self._default = default
+        self._exact = {}
+        # (prefix, handler), longest prefix first
+        self._prefixes = []
+        # (components, handler), in registration order
+        self._wildcards = []
+        # topic -> handler, resolved on first event
+        self._resolved = {}
+        # topic -> stats
+        self._stats = {}
+
+    def add(self, pattern, handler, match='exact'):
+        """
+        Register a handler.
+
+        :param pattern: Topic, topic prefix or wildcard pattern.
+        :param handler: Handler ``handler(payload, key_id, details)``.
+        :param match: ``'exact'``, ``'prefix'`` or ``'wildcard'``.
+        """
+        if match == 'exact':
+            self._exact[pattern] = handler
+        elif match == 'prefix':
+            self._prefixes.append((pattern, handler))
+            self._prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+        elif match == 'wildcard':
+            self._wildcards.append((tuple(pattern.split('.')), handler))
+        else:
+            raise ValueError('invalid match policy "{}"'.format(match))
+        self._resolved.clear()
+
+    def resolve(self, topic):
+        """
+        Get the handler for a topic: an exact match, else the longest prefix match, else the first wildcard
+        match (else the default handler).
+
+        :param topic: The topic.
+        :return: The handler (or ``None``).
+        """
+        try:
+            return self._resolved[topic]
+        except KeyError:
+            handler = self._resolved[topic] = self._resolve(topic)
+            return handler
+
+    def _resolve(self, topic):
+        handler = self._exact.get(topic, None)
+        if handler:
+            return handler
+        for prefix, handler in self._prefixes:
+            if topic.startswith(prefix):
+                return handler
+        components = topic.split('.')
+        for pattern, handler in self._wildcards:
+            if len(pattern) == len(components) and all(not p or p == c for p, c in zip(pattern, components)):
+                return handler
+        return self._default
+
+    def dispatch(self, topic, payload, key_id, details):
+        """
+        Dispatch a (decrypted) event to the handler for its topic, and update the topic statistics.
+
+        :param topic: The topic the event was published to.
+        :param payload: The application payload.
+        :param key_id: ID of the data encryption key the event was encrypted with.
+        :param details: WAMP event details.
+        """
+        stats = self._stats.get(topic, None)
+        if stats is None:
+            stats = self._stats[topic] = {
+                'events': 0,
+                'unhandled': 0,
+                'keys': 0,
+                'key_id': None,
+                'publication': None,
+            }
+        stats['events'] += 1
+        stats['publication'] = details.publication if details else None
+        if key_id != stats['key_id']:
+            stats['keys'] += 1
+            stats['key_id'] = key_id
+
+        handler = self.resolve(topic)
+        if handler is None:
+            stats['unhandled'] += 1
+        else:
+            handler(payload, key_id, details)
+
+    def stats(self):
+        """
+        :return: Map of topic to events received, events with no handler, number of keys used, current
+            key ID and last publication ID.
+        """
+        return {topic: dict(stats, key_id=str(UUID(bytes=stats['key_id'])) if stats['key_id'] else None)
+                for topic, stats in self._stats.items()}
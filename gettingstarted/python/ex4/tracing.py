@@ -0,0 +1,162 @@
+# coding=utf8
+
+# end-to-end tracing of XBR encrypted events: sellers publish trace metadata with every event (a stream ID,
+# sequence number and timestamps of encrypting it), from which buyers measure the latency of every stage
+# between the seller and the application, and detect events lost, reordered or duplicated on the way
+
+import os
+from collections import OrderedDict
+
+import txaio
+txaio.use_twisted()
+
+from txaio import make_logger
+
+from metrics import MetricsRegistry
+
+
+def new_stream():
+    """
+    :return: A random ID for the events published by one publisher (sequence numbers are per stream).
+    """
+    return int.from_bytes(os.urandom(4), 'big')
+
+
+class _Sequence(object):
+    __slots__ = ('next_seq', 'missing')
+
+    def __init__(self, seq):
+        self.next_seq = seq + 1
+        # sequence numbers skipped (lost, unless received later, out of order)
+        self.missing = OrderedDict()
+
+
+class EventTracer(object):
+    """
+    Measures the latency of traced events per topic and stage, and tracks sequence numbers per topic and
+    publisher stream. Traces are ``[stream, seq, started_ns, wrapped_ns]``, published by the seller (as
+    the keyword argument ``trace``) with the (wall clock) time it started and finished encrypting the event.
+
+    The stages are
+
+    * ``encrypt``: serializing and encrypting the event (seller),
+    * ``transit``: from the seller to the buyer receiving the event (includes the difference of the clocks of
+      the seller and buyer hosts),
+    * ``queue``: waiting in the receive queue of the buyer,
+    * ``key_fetch``: decrypting events whose key was not bought yet (buying, or loading, the key),
+    * ``decrypt``: decrypting and deserializing events whose key was bought already,
+    * ``total``: from the seller starting to encrypt the event until the buyer decrypted it.
+
+    Events are counted ``lost`` when their sequence number was skipped (and not received out of order later),
+    ``reordered`` when received after an event with a higher sequence number, and ``duplicated`` when received
+    again. A new stream (a seller reconnecting) starts new sequence numbers, so events lost while switching
+    streams are not detected (buyers catch up on those from the seller's history).
+    """
+    log = make_logger()
+
+    STAGES = ('encrypt', 'transit', 'queue', 'key_fetch', 'decrypt', 'total')
+
+    def __init__(self, metrics=None, max_streams=16, max_missing=1024):
+        """
+
+        :param metrics: optional :class:`metrics.MetricsRegistry` to keep the latency histograms and sequence
+            counters in (per topic).
+        :param max_streams: Maximum number of publisher streams tracked per topic (the oldest are forgotten).
+        :param max_missing: Maximum number of missing sequence numbers remembered per stream (to recognize
+            events received out of order).
+        """
+        self._metrics = metrics or MetricsRegistry()
+        self._max_streams = max_streams
+        self._max_missing = max_missing
+        # topic -> (stage histograms, skipped, reordered, duplicated counters, streams: stream -> _Sequence)
+        self._topics = {}
+
+    def _topic(self, topic):
+        entry = self._topics.get(topic, None)
+        if entry is None:
+            labels = {'topic': topic}
+            histograms = tuple(self._metrics.histogram('xbr_buyer_trace_seconds',
+                                                       'Latency of traced events per stage.',
+                                                       labels=dict(labels, stage=stage)) for stage in self.STAGES)
+            entry = self._topics[topic] = (
+                histograms,
+                self._metrics.counter('xbr_buyer_trace_skipped_total', 'Sequence numbers of traced events '
+                                      'skipped (events lost, or received out of order later).', labels=labels),
+                self._metrics.counter('xbr_buyer_trace_reordered_total', 'Traced events received out of order.',
+                                      labels=labels),
+                self._metrics.counter('xbr_buyer_trace_duplicated_total', 'Traced events received again.',
+                                      labels=labels),
+                OrderedDict(),
+            )
+        return entry
+
+    def received(self, topic, trace):
+        """
+        Track the sequence number of a traced event, in the order events are received.
+
+        :param topic: The topic the event was received on.
+        :param trace: The trace ``[stream, seq, started_ns, wrapped_ns]``.
+        """
+        _, skipped, reordered, duplicated, streams = self._topic(topic)
+        stream, seq = trace[0], trace[1]
+
+        sequence = streams.get(stream, None)
+        if sequence is None:
+            streams[stream] = _Sequence(seq)
+            if len(streams) > self._max_streams:
+                streams.popitem(last=False)
+            return
+
+        if seq == sequence.next_seq:
+            sequence.next_seq += 1
+        elif seq > sequence.next_seq:
+            skipped.inc(seq - sequence.next_seq)
+            for missing in range(max(sequence.next_seq, seq - self._max_missing), seq):
+                sequence.missing[missing] = None
+            while len(sequence.missing) > self._max_missing:
+                sequence.missing.popitem(last=False)
+            sequence.next_seq = seq + 1
+        elif seq in sequence.missing:
+            del sequence.missing[seq]
+            reordered.inc()
+        else:
+            duplicated.inc()
+
+    def decrypted(self, topic, trace, received_ns, dequeued_ns, decrypted_ns, key_fetched):
+        """
+        Record the latency of the stages of a traced event.
+
+        :param topic: The topic the event was received on.
+        :param trace: The trace ``[stream, seq, started_ns, wrapped_ns]``.
+        :param received_ns: Time (``time.time_ns()``) the event was received.
+        :param dequeued_ns: Time the event was taken from the receive queue for decrypting.
+        :param decrypted_ns: Time the event was decrypted.
+        :param key_fetched: Whether the key of the event had to be bought (or loaded) first.
+        """
+        encrypt, transit, queue, key_fetch, decrypt, total = self._topic(topic)[0]
+        started_ns, wrapped_ns = trace[2], trace[3]
+        encrypt.observe((wrapped_ns - started_ns) / 1e9)
+        transit.observe((received_ns - wrapped_ns) / 1e9)
+        queue.observe((dequeued_ns - received_ns) / 1e9)
+        (key_fetch if key_fetched else decrypt).observe((decrypted_ns - dequeued_ns) / 1e9)
+        total.observe((decrypted_ns - started_ns) / 1e9)
+
+    def stats(self):
+        """
+        :return: Per topic, the number of events and the estimated median and 99th percentile latency (in
+            milliseconds) per stage, and the sequence counters.
+        """
+        result = {}
+        for topic, (histograms, skipped, reordered, duplicated, streams) in self._topics.items():
+            stats = result[topic] = {
+                'streams': len(streams),
+                'lost': skipped.value - reordered.value,
+                'reordered': reordered.value,
+                'duplicated': duplicated.value,
+            }
+            for stage, histogram in zip(self.STAGES, histograms):
+                if histogram.count:
+                    stats[stage] = {'count': histogram.count,
+                                    'p50_ms': histogram.quantile(.5) * 1000.,
+                                    'p99_ms': histogram.quantile(.99) * 1000.}
+        return result